@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Offline benchmark of plugins, ingest, thumbnail and views.
+
+Pages on the corpus folder are parsed instead of fetched,
+so the result only depend on the code and the machine.
+Database for view benchmark is created once for every scale and database schema,
+and kept on the work folder.
+
+Usage:
+    python -m benchmarks.bench run --output result.json
+    python -m benchmarks.bench run --scale 10000 --only 'view:*' --output result.json
+    python -m benchmarks.bench compare base.json result.json
+"""
+from collections import OrderedDict
+from fnmatch import fnmatch
+from types import SimpleNamespace
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bs4 import BeautifulSoup
+from flask import _app_ctx_stack
+from PIL import Image
+from requests_html import HTML
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+import click
+
+import gbooru_images_download
+from gbooru_images_download import api, models, views
+from gbooru_images_download.__main__ import create_app
+from gbooru_images_download.plugin import mode_a_tag, mode_absolute_links, mode_google_image
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS_FOLDER = os.path.join(BENCH_DIR, 'corpus')
+DEFAULT_WORK_FOLDER = os.path.join(BENCH_DIR, 'work')
+DEFAULT_SCALES = (10000, 100000, 1000000)
+# base url of the page on corpus folder, used to resolve relative link
+CORPUS_URL = 'https://example.com/gallery/'
+# number of match results committed on each transaction when the view database is filled
+FILL_CHUNK_SIZE = 10000
+BENCHMARKS = OrderedDict()
+
+
+class Timer:
+    """Context manager which add elapsed time of its block."""
+
+    def __init__(self):
+        self.elapsed = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed += time.perf_counter() - self._start
+
+
+def benchmark(name, scaled=False):
+    """Register benchmark function.
+
+    Benchmark function is called with context, scale and timer,
+    only the block on the timer is measured and it return the number of processed row.
+    Scaled benchmark is run for every scale, the other is run once with None as scale.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, scaled)
+        return func
+    return decorator
+
+
+def read_corpus(ctx, name):
+    with open(os.path.join(ctx.corpus_folder, name)) as f:
+        return f.read()
+
+
+def get_app(db_path):
+    """Create app for database path, its app context is not kept."""
+    models.db.session.remove()
+    app = create_app('sqlite:///' + db_path)
+    _app_ctx_stack.top.pop()
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app
+
+
+def iter_scaled_items(ctx, scale):
+    """Iterate (url, thumbnails, tags) item of scale match results from google image corpus.
+
+    Every item have its own url, thumbnail and id tag, other tags are shared.
+    """
+    text = read_corpus(ctx, 'google_image.html')
+    items = list(mode_google_image.ModePlugin.iter_match_results(text=text))
+    for idx in range(scale):
+        url, thumbnails, tags = items[idx % len(items)]
+        yield (
+            '{}?n={}'.format(url, idx),
+            ['{}&n={}'.format(x, idx) for x in thumbnails],
+            [x for x in tags if x[0] != 'gi id'] + [('gi id', 'id{}'.format(idx))])
+
+
+@benchmark('get_match_results_dict:google_image')
+def bench_google_image(ctx, scale, timer):
+    text = read_corpus(ctx, 'google_image.html')
+    with timer:
+        res = mode_google_image.ModePlugin.get_match_results_dict(text=text)
+    return len(res['url'])
+
+
+@benchmark('get_match_results_dict:a_tag')
+def bench_a_tag(ctx, scale, timer):
+    text = read_corpus(ctx, 'a_tag.html')
+    with timer:
+        res = mode_a_tag.ModePlugin.get_match_results_dict(text=text, url=CORPUS_URL)
+    return len(res['url'])
+
+
+@benchmark('get_match_results_dict:absolute_links')
+def bench_absolute_links(ctx, scale, timer):
+    text = read_corpus(ctx, 'absolute_links.html')
+    with timer:
+        response = SimpleNamespace(html=HTML(html=text, url=CORPUS_URL))
+        res = mode_absolute_links.ModePlugin.get_match_results_dict(
+            text=text, response=response)
+    return len(res['url'])
+
+
+@benchmark('parse_img_search_html')
+def bench_parse_img_search_html(ctx, scale, timer):
+    text = read_corpus(ctx, 'img_search.html')
+    with timer:
+        res = api.parse_img_search_html(BeautifulSoup(text, api.get_html_parser()))
+    return len(res['MainSimilarResult']) + len(res['TextMatch'])
+
+
+@benchmark('match_results_models_from_dict', scaled=True)
+def bench_match_results_models_from_dict(ctx, scale, timer):
+    mr_dict = {'url': OrderedDict(), 'tag': []}
+    for url, thumbnails, tags in iter_scaled_items(ctx, scale):
+        mr_dict['url'][url] = {'thumbnail': thumbnails, 'tag': tags}
+    folder = tempfile.mkdtemp(dir=ctx.work_folder)
+    try:
+        app = get_app(os.path.join(folder, 'ingest.db'))
+        with app.app_context():
+            session = models.db.session
+            with timer:
+                res = models.ModePlugin.match_results_models_from_dict(mr_dict, session)
+                session.commit()
+            session.remove()
+    finally:
+        shutil.rmtree(folder)
+    return len(res)
+
+
+def get_image_paths(ctx, count):
+    """Get path of generated image, image is created once on the work folder."""
+    folder = os.path.join(ctx.work_folder, 'images')
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(folder, '{}.png'.format(idx))
+        if not os.path.isfile(path):
+            img = Image.new('RGB', (640 + idx % 7 * 64, 480), (idx % 256, idx * 7 % 256, 90))
+            img.paste((255, 255, 255), (idx % 320, 0, idx % 320 + 160, 240))
+            img.save(path)
+        paths.append(path)
+    return paths
+
+
+@benchmark('create_thumbnails')
+def bench_create_thumbnails(ctx, scale, timer):
+    paths = get_image_paths(ctx, ctx.images)
+    folder = tempfile.mkdtemp(dir=ctx.work_folder)
+    try:
+        app = get_app(os.path.join(folder, 'thumbnail.db'))
+        with app.app_context():
+            session = models.db.session
+            with timer:
+                res = api.get_or_create_image_files_with_thumbnail(
+                    paths, session=session, thumb_folder=os.path.join(folder, 'thumb'),
+                    max_workers=ctx.max_workers, disable_cache=True)
+                session.commit()
+            session.remove()
+    finally:
+        shutil.rmtree(folder)
+    return len([x for x in res if not isinstance(x, Exception)])
+
+
+def get_schema_digest():
+    """Get digest of database schema, so database of older schema is not used."""
+    dialect = sqlite.dialect()
+    digest = hashlib.sha1()
+    for table in models.db.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode('utf8'))
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode('utf8'))
+    return digest.hexdigest()[:12]
+
+
+def create_view_db(ctx, scale, db_path):
+    """Create database with scale match results on temporary path, then move it to db_path."""
+    tmp_path = db_path + '.tmp'
+    # leftover of interrupted run, including sqlite wal files
+    for path in (tmp_path, tmp_path + '-wal', tmp_path + '-shm'):
+        if os.path.isfile(path):
+            os.remove(path)
+    app = get_app(tmp_path)
+    with app.app_context():
+        session = models.db.session
+        items = iter_scaled_items(ctx, scale)
+        for idx in range(0, scale, FILL_CHUNK_SIZE):
+            models.bulk_create_match_results(
+                session, (next(items) for _ in range(min(FILL_CHUNK_SIZE, scale - idx))))
+            session.commit()
+        session.remove()
+        models.db.get_engine(app).dispose()
+    os.replace(tmp_path, db_path)
+
+
+def get_view_app(ctx, scale):
+    """Get app with scale match results and the views.
+
+    Database is kept on work folder, app is created once for every scale on the run.
+    """
+    app = ctx.view_apps.get(scale)
+    if app is not None:
+        return app
+    db_path = os.path.join(
+        ctx.work_folder, 'view-{}-{}.db'.format(scale, get_schema_digest()))
+    if not os.path.isfile(db_path):
+        create_view_db(ctx, scale, db_path)
+    app = ctx.view_apps[scale] = get_app(db_path)
+    with app.app_context():
+        session = models.db.session
+        admin = app.extensions['admin'][0]
+        admin.add_view(views.MatchResultView(models.MatchResult, session))
+        admin.add_view(views.TagView(models.Tag, session))
+        admin.add_view(views.UrlView(models.Url, session))
+    return app
+
+
+def bench_view(ctx, scale, timer, url):
+    app = get_view_app(ctx, scale)
+    client = app.test_client()
+    with app.app_context():
+        # warm up connection, template and query cache, only the next request is measured
+        resp = client.get(url)
+        assert resp.status_code == 200, 'Status code: {}, url: {}'.format(resp.status_code, url)
+        with timer:
+            resp = client.get(url)
+        models.db.session.remove()
+    assert resp.status_code == 200, 'Status code: {}, url: {}'.format(resp.status_code, url)
+    return scale
+
+
+@benchmark('view:matchresult', scaled=True)
+def bench_match_result_view(ctx, scale, timer):
+    return bench_view(ctx, scale, timer, '/matchresult/')
+
+
+@benchmark('view:tag', scaled=True)
+def bench_tag_view(ctx, scale, timer):
+    return bench_view(ctx, scale, timer, '/tag/')
+
+
+def run_benchmark(ctx, name, scale, repeat):
+    func = BENCHMARKS[name][0]
+    times = []
+    rows = None
+    for _ in range(repeat):
+        timer = Timer()
+        rows = func(ctx, scale, timer)
+        times.append(timer.elapsed)
+    median = statistics.median(times)
+    return OrderedDict([
+        ('name', name),
+        ('scale', scale),
+        ('repeat', repeat),
+        ('rows', rows),
+        ('min', min(times)),
+        ('median', median),
+        ('mean', statistics.mean(times)),
+        ('max', max(times)),
+        ('rows_per_second', rows / median if rows and median else None),
+    ])
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    """Offline benchmark for gbooru-images-download."""
+
+
+@cli.command()
+@click.option(
+    '--scale', 'scales', type=int, multiple=True,
+    help='Row scale, can be repeated. Default to 10000, 100000 and 1000000.')
+@click.option(
+    '--repeat', default=3, show_default=True, help='Run every benchmark this many times.')
+@click.option(
+    '--only', 'patterns', multiple=True,
+    help="Only run benchmark matching this pattern, e.g. 'view:*'.")
+@click.option(
+    '--images', default=100, show_default=True,
+    help='Number of image for thumbnail benchmark.')
+@click.option(
+    '--max-workers', type=int, help='Number of thumbnail process, default to number of cpu.')
+@click.option(
+    '--corpus-folder', default=DEFAULT_CORPUS_FOLDER,
+    type=click.Path(exists=True, file_okay=False))
+@click.option(
+    '--work-folder', default=DEFAULT_WORK_FOLDER, type=click.Path(file_okay=False),
+    help='Folder for generated database and image.')
+@click.option(
+    '--output', type=click.Path(dir_okay=False), help='Write result as json to this file.')
+def run(scales, repeat, patterns, images, max_workers, corpus_folder, work_folder, output):
+    """Run benchmarks."""
+    scales = scales if scales else DEFAULT_SCALES
+    os.makedirs(work_folder, exist_ok=True)
+    ctx = SimpleNamespace(
+        corpus_folder=corpus_folder, work_folder=work_folder, images=images,
+        max_workers=max_workers, view_apps={})
+    results = []
+    for name, (_, scaled) in BENCHMARKS.items():
+        if patterns and not any(fnmatch(name, x) for x in patterns):
+            continue
+        for scale in (scales if scaled else [None]):
+            res = run_benchmark(ctx, name, scale, repeat)
+            results.append(res)
+            click.echo('{name}\t{scale}\trows: {rows}\tmedian: {median:.4f}s'.format(**res))
+    data = OrderedDict([
+        ('created_at', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('version', gbooru_images_download.__version__),
+        ('commit', get_git_commit()),
+        ('python', sys.version.split()[0]),
+        ('platform', platform.platform()),
+        ('results', results),
+    ])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+@cli.command()
+@click.argument('base', type=click.File('r'))
+@click.argument('result', type=click.File('r'))
+@click.option(
+    '--threshold', default=1.1, show_default=True,
+    help='Ratio of median time which is reported as regression.')
+def compare(base, result, threshold):
+    """Compare median time of RESULT to BASE, exit with error on regression."""
+    base_data = {(x['name'], x['scale']): x for x in json.load(base)['results']}
+    regressions = 0
+    for res in json.load(result)['results']:
+        key = (res['name'], res['scale'])
+        if key not in base_data:
+            click.echo('{}\t{}\tnew\t{:.4f}s'.format(key[0], key[1], res['median']))
+            continue
+        base_median = base_data[key]['median']
+        ratio = res['median'] / base_median if base_median else float('inf')
+        mark = ''
+        if ratio > threshold:
+            mark = '\tREGRESSION'
+            regressions += 1
+        click.echo('{}\t{}\t{:.4f}s -> {:.4f}s\t{:.2f}x{}'.format(
+            key[0], key[1], base_median, res['median'], ratio, mark))
+    if regressions:
+        raise click.ClickException('Regression: {}'.format(regressions))
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 """Server module."""
 from logging.handlers import TimedRotatingFileHandler
+from collections import Counter
+import multiprocessing
 import logging
 import os
+import time
 
 from appdirs import user_data_dir
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import FlaskGroup
 from flask_admin import Admin
 from flask_admin._compat import text_type
@@ -14,22 +17,48 @@ from flask_migrate import Migrate
 from sqlalchemy.orm.util import identity_key
 import click
 
-from gbooru_images_download import models, views
+from gbooru_images_download import (
+    api, download, fetch, imghash, jobs, metrics, models, views, writer)
 
 
 APP_DATA_DIR = user_data_dir('gbooru_images_download', 'rachmadaniharyono')
 
 
-def create_app(db_uri="sqlite:///:memory:"):
+def create_app(db_uri=None):
     """create app."""
+    if db_uri is None:
+        db_uri = os.environ.get('GBOORU_IMAGES_DOWNLOAD_DB_URI', 'sqlite:///:memory:')
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.urandom(24)
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # memory database can't be shared with worker process and writer thread,
+    # so search is run and committed on the request instead
+    shared_db = db_uri not in ('sqlite://', 'sqlite:///:memory:')
+    # job queue need worker command, so it is only used when it is enabled
+    job_queue = os.environ.get('GBOORU_IMAGES_DOWNLOAD_JOB_QUEUE', '').lower()
+    app.config['JOB_QUEUE'] = shared_db and job_queue in ('1', 'true', 'yes')
+    # single writer for sqlite, other database don't have database wide write lock
+    app.config['WRITE_BEHIND'] = shared_db and db_uri.startswith('sqlite:')
+    app.config['SQLITE_PRAGMAS'] = models.SQLITE_PRAGMAS
+    slow_request = os.environ.get('GBOORU_IMAGES_DOWNLOAD_SLOW_REQUEST_SECONDS')
+    app.config['SLOW_REQUEST_SECONDS'] = float(slow_request) if slow_request else None
     # app and db
     models.db.init_app(app)
     app.app_context().push()
+    models.set_sqlite_pragmas(models.db.engine, app.config['SQLITE_PRAGMAS'])
+    metrics.init_app(app, models.db.engine)
     models.db.create_all()
+    with models.db.engine.connect() as connection:
+        missing_columns, missing_indexes = models.get_missing_schema(connection)
+    if missing_columns or missing_indexes:
+        app.logger.warning(
+            'Database schema is outdated, run upgrade-db command. '
+            'Missing columns: %s, missing indexes: %s',
+            ', '.join(str(x) for x in missing_columns),
+            ', '.join(x.name for x in missing_indexes))
+    if app.config['WRITE_BEHIND']:
+        writer.init_app(app)
 
     @app.shell_context_processor
     def shell_context():
@@ -50,5 +79,322 @@ def cli():
     pass
 
 
+@cli.command()
+def reload_plugins():
+    """Reload plugins and update plugin records."""
+    manager = models.get_plugin_manager(reload=True)
+    for model in models.update_plugin_models(models.db.session, manager):
+        click.echo('{0.category}\t{0.name}\t{0.version}'.format(model))
+    models.db.session.commit()
+
+
+@cli.command()
+@click.argument('input_file', type=click.File('r'), default='-')
+@click.option('--mode', default='Google image', show_default=True, help='Default mode plugin.')
+@click.option(
+    '--chunk-size', default=models.SEARCH_QUERY_CHUNK_SIZE, show_default=True,
+    help='Queries per commit, at most {}.'.format(models.SEARCH_QUERY_CHUNK_SIZE))
+@click.option('--max-workers', default=fetch.MAX_WORKERS, show_default=True)
+@click.option('--per-host-limit', default=fetch.PER_HOST_LIMIT, show_default=True)
+@click.option('--disable-cache', is_flag=True, help='Fetch page even if cached response exist.')
+def batch_search(input_file, mode, chunk_size, max_workers, per_host_limit, disable_cache):
+    """Run search queries from INPUT_FILE or stdin.
+
+    Every line is tab separated search term, page and mode plugin name.
+    Page and mode are optional.
+    """
+    session = models.db.session
+    plugin_models = {x.name: x for x in models.update_plugin_models(session)}
+    session.commit()
+    queries = []
+    for line in input_file:
+        parts = line.rstrip('\n').split('\t')
+        if not parts[0].strip():
+            continue
+        page = int(parts[1]) if len(parts) > 1 and parts[1].strip() else 1
+        mode_name = parts[2] if len(parts) > 2 and parts[2].strip() else mode
+        if mode_name not in plugin_models:
+            raise click.BadParameter('Unknown mode: {}'.format(mode_name))
+        queries.append((parts[0], page, plugin_models[mode_name]))
+    start = time.time()
+    ok_count = mr_count = 0
+    progressbar = click.progressbar(
+        length=len(queries), label='Search', file=click.get_text_stream('stderr'))
+    with progressbar as bar:
+        for model in models.SearchQuery.create_many(
+                queries, session, chunk_size=chunk_size, use_cache=not disable_cache,
+                max_workers=max_workers, per_host_limit=per_host_limit):
+            if model:
+                ok_count += 1
+                mr_count += len(model.match_results)
+            bar.update(1)
+    elapsed = time.time() - start
+    click.echo('queries: {}, ok: {}, failed: {}, match results: {}'.format(
+        len(queries), ok_count, len(queries) - ok_count, mr_count))
+    click.echo('elapsed: {:.2f}s, {:.2f} queries/s'.format(
+        elapsed, len(queries) / elapsed if elapsed else 0))
+
+
+@cli.command()
+@click.option(
+    '--chunk-size', default=models.BULK_CHUNK_SIZE, show_default=True, help='Urls per commit.')
+def backfill_url_info(chunk_size):
+    """Fill url width, height and mimetype from url tags."""
+    session = models.db.session
+    url_count = 0
+    for count in models.backfill_url_info(session, chunk_size=chunk_size):
+        session.commit()
+        url_count += count
+    click.echo('urls: {}'.format(url_count))
+
+
+@cli.command()
+@click.option(
+    '--chunk-size', default=models.BULK_CHUNK_SIZE, show_default=True, help='Urls per commit.')
+def rebuild_netlocs(chunk_size):
+    """Link every url to its netloc and count netloc urls again."""
+    session = models.db.session
+    url_count = 0
+    for count in models.rebuild_netlocs(session, chunk_size=chunk_size):
+        session.commit()
+        url_count += count
+    session.commit()
+    click.echo('urls: {}, netlocs: {}'.format(url_count, session.query(models.Netloc).count()))
+
+
+@cli.command()
+def recount_tags():
+    """Count tags of every namespace and urls of every tag again."""
+    models.recount_tags(models.db.session)
+    models.db.session.commit()
+    click.echo('namespaces: {}, tags: {}'.format(
+        models.db.session.query(models.Namespace).count(),
+        models.db.session.query(models.Tag).count()))
+
+
+@cli.command()
+def upgrade_db():
+    """Add columns and indexes of new version to existing database."""
+    session = models.db.session
+    columns, indexes, merged = models.upgrade_schema(session)
+    if columns or merged:
+        models.recount_tags(session)
+    session.commit()
+    click.echo('columns: {}, indexes: {}, merged rows: {}'.format(
+        len(columns), len(indexes), merged))
+    if columns:
+        click.echo('run rebuild-netlocs, backfill-url-info and migrate-response-bodies '
+                   'to fill the new columns')
+
+
+@cli.command()
+@click.option(
+    '--chunk-size', default=models.BULK_CHUNK_SIZE, show_default=True,
+    help='Responses per commit.')
+@click.option('--vacuum', is_flag=True, help='Run VACUUM to shrink sqlite database file.')
+def migrate_response_bodies(chunk_size, vacuum):
+    """Move response body of old record from database to response store."""
+    session = models.db.session
+    response_count = 0
+    for count in models.migrate_response_bodies(session, chunk_size=chunk_size):
+        session.commit()
+        session.expunge_all()
+        response_count += count
+    click.echo('responses: {}'.format(response_count))
+    if vacuum and models.db.engine.dialect.name == 'sqlite':
+        with models.db.engine.connect() as connection:
+            connection.execute('VACUUM')
+
+
+@cli.command()
+@click.option(
+    '--min-age', default=3600, show_default=True,
+    help='Seconds since the body is stored, newer body is kept.')
+def clean_response_store(min_age):
+    """Remove response body which is not used by any response, e.g. deleted response."""
+    count = models.remove_unused_response_blobs(models.db.session, min_age=min_age)
+    click.echo('removed: {}'.format(count))
+
+
+def iter_image_paths(paths):
+    """Iterate image file path from file and folder paths."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for stat in api.iter_image_file_stats(path):
+            yield stat[0]
+
+
+@cli.command()
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--thumb-folder', type=click.Path(file_okay=False), help='Thumbnail folder.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Images per commit.')
+@click.option('--max-workers', type=int, help='Number of process, default to number of cpu.')
+@click.option('--disable-cache', is_flag=True, help='Read info of existing image file again.')
+def create_thumbnails(paths, thumb_folder, chunk_size, max_workers, disable_cache):
+    """Create image file records with thumbnail for image on PATHS."""
+    session = models.db.session
+    image_paths = list(iter_image_paths(paths))
+    ok_count = failed_count = 0
+    start = time.time()
+    progressbar = click.progressbar(
+        length=len(image_paths), label='Thumbnail', file=click.get_text_stream('stderr'))
+    with progressbar as bar:
+        for idx in range(0, len(image_paths), chunk_size):
+            res = api.get_or_create_image_files_with_thumbnail(
+                image_paths[idx:idx + chunk_size], session=session, thumb_folder=thumb_folder,
+                max_workers=max_workers, disable_cache=disable_cache)
+            session.commit()
+            failed = [x for x in res if isinstance(x, Exception)]
+            ok_count += len(res) - len(failed)
+            failed_count += len(failed)
+            bar.update(len(res))
+    elapsed = time.time() - start
+    click.echo('images: {}, ok: {}, failed: {}'.format(
+        ok_count + failed_count, ok_count, failed_count))
+    click.echo('elapsed: {:.2f}s, {:.2f} images/s'.format(
+        elapsed, (ok_count + failed_count) / elapsed if elapsed else 0))
+
+
+@cli.command()
+@click.argument('folders', nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('--chunk-size', default=1000, show_default=True, help='Files per commit.')
+@click.option('--max-workers', type=int, help='Number of process, default to number of cpu.')
+@click.option('--retry-failed', is_flag=True, help='Index unchanged failed file again.')
+def index_folder(folders, chunk_size, max_workers, retry_failed):
+    """Index image files on FOLDERS, unchanged file since last index is skipped."""
+    session = models.db.session
+    counter = Counter()
+    start = time.time()
+    for folder in folders:
+        for chunk_counter in api.index_image_folder(
+                folder, session=session, chunk_size=chunk_size, max_workers=max_workers,
+                retry_failed=retry_failed):
+            session.commit()
+            counter.update(chunk_counter)
+    click.echo(
+        'files: {0[files]}, indexed: {0[indexed]}, failed: {0[failed]}, removed: {0[removed]}'
+        .format(counter))
+    click.echo('elapsed: {:.2f}s'.format(time.time() - start))
+
+
+@cli.command()
+@click.option('--thumb-folder', type=click.Path(file_okay=False), help='Thumbnail folder.')
+@click.option(
+    '--chunk-size', default=models.BULK_CHUNK_SIZE, show_default=True,
+    help='Image files per commit.')
+def backfill_dhash(thumb_folder, chunk_size):
+    """Set dhash of image file from its thumbnail or indexed path."""
+    session = models.db.session
+    img_file_count = 0
+    for count in models.backfill_image_file_dhash(
+            session, thumb_folder=thumb_folder, chunk_size=chunk_size):
+        session.commit()
+        img_file_count += count
+    click.echo('image files: {}'.format(img_file_count))
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--max-distance', default=imghash.DEFAULT_MAX_DISTANCE, show_default=True,
+    help='Maximum hamming distance.')
+def find_duplicates(path, max_distance):
+    """Find image file and url which is near duplicate of image on PATH."""
+    session = models.db.session
+    value = imghash.dhash_file(path)
+    for column in (models.ImageFile.dhash, models.Url.dhash):
+        for distance, model in models.find_near_duplicates(session, column, value, max_distance):
+            click.echo('{}\t{}'.format(distance, model))
+
+
+@cli.command('download')
+@click.option('--search-term', help='Only download match results of this search term.')
+@click.option('--page', type=int, help='Page of the search term.')
+@click.option('--netloc', help='Only download url on this netloc.')
+@click.option('--min-width', type=int, help='Minimum url image width.')
+@click.option('--min-height', type=int, help='Minimum url image height.')
+@click.option('--no-original', is_flag=True, help="Don't download match result url.")
+@click.option('--no-thumbnail', is_flag=True, help="Don't download match result thumbnail url.")
+@click.option('--folder', type=click.Path(file_okay=False), help='Download folder.')
+@click.option('--chunk-size', default=100, show_default=True, help='Urls per commit.')
+@click.option('--max-workers', default=fetch.MAX_WORKERS, show_default=True)
+@click.option('--per-host-limit', default=fetch.PER_HOST_LIMIT, show_default=True)
+def download_match_results(
+        search_term, page, netloc, min_width, min_height, no_original, no_thumbnail, folder,
+        chunk_size, max_workers, per_host_limit):
+    """Download match result urls, interrupted download is resumed on next run."""
+    session = models.db.session
+    query = session.query(models.MatchResult)
+    if search_term is not None:
+        sq_filter = {'search_term': search_term}
+        if page is not None:
+            sq_filter['page'] = page
+        query = query.filter(models.MatchResult.search_queries.any(**sq_filter))
+    if netloc is not None or min_width is not None or min_height is not None:
+        query = query.join(models.MatchResult.url)
+    if netloc is not None:
+        query = query.join(models.Url.netloc).filter(models.Netloc.value == netloc)
+    if min_width is not None:
+        query = query.filter(models.Url.width >= min_width)
+    if min_height is not None:
+        query = query.filter(models.Url.height >= min_height)
+    urls = download.get_match_result_urls(
+        session, query=query, original=not no_original, thumbnail=not no_thumbnail)
+    counter = Counter()
+    start = time.time()
+    progressbar = click.progressbar(
+        length=len(urls), label='Download', file=click.get_text_stream('stderr'))
+    with progressbar as bar:
+        for chunk_counter in download.download_urls(
+                session, urls, folder=folder, chunk_size=chunk_size,
+                max_workers=max_workers, per_host_limit=per_host_limit):
+            session.commit()
+            counter.update(chunk_counter)
+            bar.update(sum(chunk_counter.values()))
+    click.echo('urls: {}, downloaded: {}, skipped: {}, failed: {}'.format(
+        len(urls), counter['downloaded'], counter['skipped'], counter['failed']))
+    click.echo('elapsed: {:.2f}s'.format(time.time() - start))
+
+
+def run_worker_process(db_uri, **kwargs):
+    """Run job worker on new app, target of worker process."""
+    create_app(db_uri)
+    jobs.run_worker(models.db.session, **kwargs)
+
+
+@cli.command()
+@click.option('--processes', default=1, show_default=True, help='Number of worker process.')
+@click.option(
+    '--poll-interval', default=jobs.POLL_INTERVAL, show_default=True,
+    help='Seconds to wait when the queue is empty.')
+@click.option('--max-jobs', type=int, help='Stop each worker after this number of job.')
+@click.option('--burst', is_flag=True, help='Stop when the queue is empty.')
+def worker(processes, poll_interval, max_jobs, burst):
+    """Run queued background jobs, e.g. search from the index page."""
+    kwargs = {'poll_interval': poll_interval, 'max_jobs': max_jobs, 'stop_when_empty': burst}
+    if processes == 1:
+        count = jobs.run_worker(models.db.session, **kwargs)
+        click.echo('jobs: {}'.format(count))
+        return
+    # spawn, so every worker create its own database connection and browser
+    ctx = multiprocessing.get_context('spawn')
+    procs = [
+        ctx.Process(
+            target=run_worker_process,
+            args=(current_app.config['SQLALCHEMY_DATABASE_URI'], ), kwargs=kwargs)
+        for _ in range(processes)]
+    for proc in procs:
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,95 @@
+"""Ajax module.
+
+Model loader for flask-admin ajax lookup, used by select field and filter.
+"""
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader
+from flask_admin.model.ajax import DEFAULT_PAGE_SIZE
+from sqlalchemy import and_, orm, or_
+from sqlalchemy.sql.expression import type_coerce
+from sqlalchemy.types import String
+
+from . import models
+
+
+MAX_PAGE_SIZE = 50
+# filter type on the list template which turn the filter input into ajax select
+FILTER_DATA_TYPE_PREFIX = 'ajax-lookup:'
+
+
+def prefix_filter(column, term):
+    """Filter column value which start with term.
+
+    Range comparison is used instead of LIKE, so any index on the column can be used.
+    """
+    column = type_coerce(column, String)
+    return and_(column >= term, column < term + '\uffff')
+
+
+class PrefixAjaxModelLoader(QueryAjaxModelLoader):
+    """Ajax model loader which match start of fields value.
+
+    Result size is limited by MAX_PAGE_SIZE.
+    Additional options:
+
+    - joins: relationships joined to the query, so fields can be column of other model
+    - load_options: query options for loaded model, e.g. `orm.joinedload`
+    - formatter: function to get text of the model
+    """
+
+    def __init__(self, name, session, model, **options):
+        super().__init__(name, session, model, **options)
+        self.joins = options.get('joins', ())
+        self.load_options = options.get('load_options', ())
+        self.formatter = options.get('formatter')
+
+    def format(self, model):
+        if not model or self.formatter is None:
+            return super().format(model)
+        return getattr(model, self.pk), self.formatter(model)
+
+    def get_query(self):
+        query = super().get_query()
+        for item in self.joins:
+            query = query.join(item)
+        return query.options(*self.load_options)
+
+    def get_list(self, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+        query = self.get_query()
+        term = (term or '').strip()
+        if term:
+            filters = [prefix_filter(x, term) for x in self._cached_fields]
+            if term.isdigit():
+                filters.append(getattr(self.model, self.pk) == int(term))
+            query = query.filter(or_(*filters))
+        if self.order_by is not None:
+            query = query.order_by(self.order_by)
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        return query.offset(offset or 0).limit(limit).all()
+
+
+def get_filter_data_type(loader):
+    """Get filter data type which use the loader for its options."""
+    return FILTER_DATA_TYPE_PREFIX + loader.name
+
+
+response_loader = PrefixAjaxModelLoader(
+    'response', models.db.session, models.Response,
+    fields=[models.Url.value], joins=[models.Response.url],
+    load_options=[
+        orm.contains_eager(models.Response.url),
+        orm.defer(models.Response.text_inline), orm.defer(models.Response.json_inline)],
+    formatter='id:{0.id} url:{0.url.value}'.format,
+    order_by=models.Response.id.desc(),
+    placeholder='Response id or url',
+)
+search_query_loader = PrefixAjaxModelLoader(
+    'search_queries', models.db.session, models.SearchQuery,
+    fields=['search_term'], formatter="'{0.search_term}' page:{0.page}".format,
+    placeholder='Search term',
+)
+tag_loader = PrefixAjaxModelLoader(
+    'tags', models.db.session, models.Tag,
+    fields=['value'], load_options=[orm.joinedload(models.Tag.namespace)],
+    formatter=lambda x: x.as_string,
+    placeholder='Tag',
+)
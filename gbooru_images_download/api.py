@@ -1,29 +1,29 @@
 #!/usr/bin/python3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from functools import lru_cache, partial
 from urllib.parse import urlparse, urlencode, parse_qs, urljoin, quote_plus
 import hashlib
+import io
 import json
 import logging
 import os
-import shutil
 import tempfile
 
 from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+from flask import current_app, has_app_context
 from PIL import Image
-import requests
-try:
-    from selenium import webdriver
-    from selenium.webdriver.firefox.options import Options
-    SELENIUM_ENABLED = True
-except ImportError:
-    SELENIUM_ENABLED = False
-
-import gbooru_images_download as gid
-from . import models, exceptions
+
+from . import browser, models, exceptions, fetch, imghash, singleflight
+from .browser import SELENIUM_ENABLED
 from .models import get_plugin_manager
+from .sha256 import sha256_mmap
 
 
 log = logging.getLogger(__name__)
+THUMBNAIL_SIZE = (256, 256)
 
 
 class Namespace(Enum):
@@ -44,6 +44,26 @@ class Namespace(Enum):
     title = 'title'
 
 
+@lru_cache()
+def get_default_html_parser():
+    """Get the fastest html parser available for BeautifulSoup."""
+    for features in ('lxml', 'html.parser'):
+        if builder_registry.lookup(features):
+            return features
+
+
+def get_html_parser():
+    """Get html parser from HTML_PARSER app config or the default one."""
+    if has_app_context() and current_app.config.get('HTML_PARSER'):
+        return current_app.config['HTML_PARSER']
+    return get_default_html_parser()
+
+
+def get_soup(markup, features=None):
+    """Parse markup with features or configured html parser."""
+    return BeautifulSoup(markup, features if features else get_html_parser())
+
+
 def sha256_checksum(filename, block_size=65536):
     """sha256 checksum."""
     sha256 = hashlib.sha256()
@@ -62,7 +82,7 @@ def get_json_response(query, page=1):
     parsed_url = urlparse('https://www.google.com/search')
     query_url = parsed_url._replace(query=urlencode(url_query)).geturl()
     log.debug('query url', url=query_url)
-    resp = requests.get(query_url)
+    resp = fetch.fetch(query_url, requests_lib='requests')
     return resp.json()
 
 
@@ -92,7 +112,8 @@ def get_data(html_tag):
     res['img_url'] = {
         'value': url_from_img_url,
         'width': img_url_width,
-        'height': img_url_height
+        'height': img_url_height,
+        'mimetype': json_data.get('ity'),
     }
     # thumbnail url
     res['thumbnail_url'] = {
@@ -108,14 +129,14 @@ def get_or_create_image_url(dict_input, session=None):
 
     Example dict_input:
 
-        {'value': 'example.com/1.jpg', 'height': 100, 'width':100}
+        {'value': 'example.com/1.jpg', 'height': 100, 'width':100, 'mimetype': 'jpg'}
     """
     session = models.db.session if session is None else session
     m, created = models.get_or_create(session, models.Url, value=dict_input['value'])
-    for item in ('width', 'height'):
-        value = dict_input.get(item, None)
-        if value:
-            setattr(m, item, value)
+    url_info = models.get_url_info(
+        [(x, dict_input.get(x)) for x in models.URL_INFO_NAMESPACES])
+    for key, value in url_info.items():
+        setattr(m, key, value)
     session.add(m)
     return m, created
 
@@ -125,15 +146,13 @@ def get_or_create_match_result(data, session=None):
     session = models.db.session if session is None else session
     img_url = get_or_create_image_url(dict_input=data['img_url'], session=session)[0]
     thumbnail_url = get_or_create_image_url(dict_input=data['thumbnail_url'], session=session)[0]
+    # json data is kept as url tags
     model, created = models.get_or_create(
-        session, models.MatchResult, img_url=img_url, thumbnail_url=thumbnail_url)
-    json_data_m = models.get_or_create(
-        session, models.JsonData, value=data['json_data'])[0]
-    if json_data_m not in model.json_data:
-        model.json_data.append(json_data_m)
+        session, models.MatchResult, url=img_url, thumbnail_url=thumbnail_url)
     manager = get_plugin_manager()
-    for plug in manager.getPluginsOfCategory('tag_preprocessor'):
-        data['tag'] = list(plug.plugin_object.run_tag_preprocessor(data['tag']))
+    if 'tag_preprocessor' in manager.getCategories():
+        for plug in manager.getPluginsOfCategory('tag_preprocessor'):
+            data['tag'] = list(plug.plugin_object.run_tag_preprocessor(data['tag']))
     for nm_val, tag_val in data['tag']:
         tag_kwargs = {'value': str(tag_val)}
         if nm_val:
@@ -141,7 +160,8 @@ def get_or_create_match_result(data, session=None):
                 session, models.Namespace, value=nm_val)[0]
             tag_kwargs['namespace'] = namespace
         tag = models.get_or_create(session, models.Tag, **tag_kwargs)[0]
-        model.img_url.tags.append(tag)
+        if tag not in img_url.tags:
+            img_url.tags.append(tag)
     session.add(model)
     return model, created
 
@@ -151,7 +171,7 @@ def get_match_results(json_response=None, session=None):
     session = models.db.session if session is None else session
     if json_response is not None:
         html = json_response[1][1]
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = get_soup(html)
         for html_tag in soup.select('.rg_bx'):
             data = get_data(html_tag=html_tag)
             model = get_or_create_match_result(session=session, data=data)[0]
@@ -214,18 +234,12 @@ def get_html_text(search_url):
 
     """
     def get_html_text_with_selenium(url):
-        options = Options()
-        options.add_argument("--headless")
-        wd = webdriver.Firefox(firefox_options=options)
         new_su = parse_qs(urlparse(url).query).get('continue', [None])[0]
         if not new_su:
             raise ValueError('Unknown format: {}'.format(url))
         else:
             search_url_res = new_su
-        wd.get(search_url_res)
-        html_text = wd.page_source
-        wd.close()
-        log.debug('webdriver closed')
+        html_text = browser.get_page_source(search_url_res)
         return html_text, search_url_res
 
     user_agent = 'Mozilla/5.0 (Windows NT 6.2; Win64; x64; rv:16.0.1) Gecko/20121011 Firefox/16.0.1'  # NOQA
@@ -238,15 +252,20 @@ def get_html_text(search_url):
         log.debug('Use selenium')
         html_text, search_url = get_html_text_with_selenium(url=search_url)
     elif search_url:
-        resp = requests.get(search_url, headers=headers, timeout=10)
-        parsed_su = urlparse(resp.url)
-        su_redirected = (parsed_su.netloc, parsed_su.path) == ('ipv4.google.com', '/sorry/index')
-        html_text = resp.text
-        keyword_text = 'Our systems have detected unusual traffic from your computer network.'
-        if keyword_text in html_text and su_redirected and SELENIUM_ENABLED:
-            html_text, search_url = get_html_text_with_selenium(url=resp.url)
-        elif keyword_text in html_text:
-            raise ValueError('Unusual traffic detected')
+        try:
+            resp = fetch.fetch(search_url, requests_lib='requests', headers=headers, timeout=10)
+        except exceptions.HostThrottled as err:
+            # unusual traffic page
+            if err.response is None or not SELENIUM_ENABLED:
+                raise
+            parsed_su = urlparse(err.response.url)
+            su_redirected = \
+                (parsed_su.netloc, parsed_su.path) == ('ipv4.google.com', '/sorry/index')
+            if not su_redirected:
+                raise
+            html_text, search_url = get_html_text_with_selenium(url=err.response.url)
+        else:
+            html_text = resp.text
     else:
         raise ValueError('Unknown condition, search url: {}'.format(search_url))
     return html_text
@@ -257,15 +276,19 @@ def get_search_url(file_path=None, img_url=None):
         raise ValueError('image url or file path only')
     if file_path:
         search_url = 'http://www.google.com/searchbyimage/upload'
-        multipart = {'encoded_image': (file_path, open(file_path, 'rb')), 'image_content': ''}
-        response = requests.post(search_url, files=multipart, allow_redirects=False)
+        with open(file_path, 'rb') as f:
+            # file content instead of file object, so throttled request can be sent again
+            multipart = {'encoded_image': (file_path, f.read()), 'image_content': ''}
+        response = fetch.fetch(
+            search_url, 'post', requests_lib='requests', files=multipart, allow_redirects=False)
         return response.headers['Location']
     elif img_url:
         url_templ = 'https://www.google.com/searchbyimage?image_url={}&safe=off'
         search_url_from_image = url_templ.format(quote_plus(img_url))
         user_agent = 'Mozilla/5.0 (Windows NT 6.2; Win64; x64; rv:16.0.1) Gecko/20121011 Firefox/16.0.1'  # NOQA
         headers = {'User-Agent': user_agent}
-        resp = requests.get(search_url_from_image, headers=headers, timeout=10)
+        resp = fetch.fetch(
+            search_url_from_image, requests_lib='requests', headers=headers, timeout=10)
         return resp.url
     else:
         raise ValueError('Unknown condition, file path:{} url:{}'.format(file_path, img_url))
@@ -326,6 +349,9 @@ def parse_img_search_html(html):
 def get_or_create_search_image(file_path=None, url=None, search_url=None, **kwargs):
     """get match result from file.
 
+    Concurrent call for the same image checksum or url run one at a time
+    and the record is committed before the next call, so it is not searched again.
+
     Args:
         file_path: path to image file
         url: image url
@@ -334,6 +360,21 @@ def get_or_create_search_image(file_path=None, url=None, search_url=None, **kwar
         **thumb_folder: thumbnail folder
         **base_url: base url for google url
     """
+    checksum = sha256_mmap(file_path) if file_path else None
+    if file_path:
+        key = 'search_image:checksum:{}'.format(checksum)
+    else:
+        key = 'search_image:url:{}'.format(url if url else search_url)
+    with singleflight.lock(key, timeout=singleflight.LOCK_TIMEOUT):
+        res = _get_or_create_search_image(
+            file_path=file_path, url=url, search_url=search_url, checksum=checksum, **kwargs)
+        session = kwargs.get('session', None)
+        (models.db.session if session is None else session).commit()
+    return res
+
+
+def _get_or_create_search_image(
+        file_path=None, url=None, search_url=None, checksum=None, **kwargs):
     # kwargs
     disable_cache = kwargs.get('disable_cache', False)
     session = kwargs.get('session', None)
@@ -345,7 +386,7 @@ def get_or_create_search_image(file_path=None, url=None, search_url=None, **kwar
         raise ValueError('input url or file path only')
     html_text = None
     if file_path:
-        checksum = sha256_checksum(file_path)
+        checksum = sha256_checksum(file_path) if checksum is None else checksum
         model = models.SearchImage.query.filter_by(img_checksum=checksum).first()
         created = True if not model else False
     elif url:
@@ -385,7 +426,7 @@ def get_or_create_search_image(file_path=None, url=None, search_url=None, **kwar
                 raise ValueError('Unknown format: {}'.format(search_url))
         model.search_url = search_url
         # parsing
-        search_page = BeautifulSoup(html_text, 'lxml')
+        search_page = get_soup(html_text)
         data = parse_img_search_html(search_page)
         msr_kwargs = data.pop('MainSimilarResult')
         tm_kwargs = data.pop('TextMatch')
@@ -477,9 +518,10 @@ def get_or_create_search_image_page(file_path=None, url=None, **kwargs):
         raise ValueError('input url or file_path only')
 
     session = models.db.session if session is None else session
-    sm_model = get_or_create_search_image(file_path=file_path, url=url, disable_cache=disable_cache, session=session)[0]  # NOQA
+    sm_model = get_or_create_search_image(
+        file_path=file_path, url=url, disable_cache=disable_cache, session=session)[0]
     kwargs = {'search_img': sm_model, 'search_type': search_type, 'page': page}
-    model, created = models.get_or_create(session, models.SearchImagePage, **kwargs)  # NOQA
+    model, created = models.get_or_create(session, models.SearchImagePage, **kwargs)
     if created or disable_cache:
         gr_url = None
         if models.SearchImagePage.TYPE_SIMILAR == search_type:
@@ -493,8 +535,9 @@ def get_or_create_search_image_page(file_path=None, url=None, **kwargs):
             session.commit()
             raise exceptions.NoResultFound('No url found for search type: {}'.format(search_type))  # NOQA
         user_agent = 'Mozilla/5.0 (Windows NT 6.2; Win64; x64; rv:16.0.1) Gecko/20121011 Firefox/16.0.1'  # NOQA
-        resp = requests.get(gr_url, headers={'User-Agent': user_agent}, timeout=10)
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        resp = fetch.fetch(
+            gr_url, requests_lib='requests', headers={'User-Agent': user_agent}, timeout=10)
+        soup = get_soup(resp.text)
         for html_tag in soup.select('.rg_bx'):
             data = get_data(html_tag)
             mr_model = get_or_create_match_result(session=session, data=data)[0]
@@ -503,72 +546,256 @@ def get_or_create_search_image_page(file_path=None, url=None, **kwargs):
     return model, created
 
 
-def get_or_create_image_file_with_thumbnail(file_path, **kwargs):
-    """Get or create image file with thumbnail.
+def _call(func, item):
+    try:
+        return func(item)
+    except Exception as err:  # pylint: disable=broad-except
+        return err
+
+
+def map_in_process_pool(func, items, max_workers=None):
+    """Call func for every item on process pool.
 
     Args:
-        file_path: path to image file
+        func: module level function, so it can be pickled
+        items: list of argument for func
+        max_workers: number of process, default to number of cpu
+    Returns:
+        list: result or exception for each item, on the same order.
+    """
+    items = list(items)
+    max_workers = max_workers if max_workers else os.cpu_count() or 1
+    if max_workers == 1 or len(items) < 2:
+        return [_call(func, x) for x in items]
+    chunksize = max(1, len(items) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(_call, func), items, chunksize=chunksize))
+
+
+def get_image_info(file_path, checksum=None, dhash=False):
+    """Get checksum, file size, image size and format of image file.
+
+    Image size and format are read from the image header, so the image is not decoded.
+    The image is only decoded when dhash is requested, JPEG image on reduced size.
+    Image file with thumbnail get its dhash from the thumbnail instead,
+    see `get_or_create_image_files_with_thumbnail`.
+    The file is not hashed again when its checksum is given.
+    """
+    with Image.open(file_path) as img:
+        res = {'width': img.size[0], 'height': img.size[1], 'img_format': img.format}
+        if dhash:
+            res['dhash'] = imghash.to_signed(imghash.dhash(img))
+    res['checksum'] = checksum if checksum else sha256_mmap(file_path)
+    res['size'] = os.path.getsize(file_path)
+    return res
+
+
+def get_thumbnail_data(file_path, size=THUMBNAIL_SIZE):
+    """Get JPEG thumbnail data of image file.
+
+    JPEG image is downscaled while it is decoded with `Image.draft`,
+    so the full size image is never decoded.
+
+    Returns:
+        tuple: thumbnail data and thumbnail (width, height)
+    """
+    with Image.open(file_path) as img:
+        img.draft('RGB', size)
+        img.thumbnail(size)
+        buf = io.BytesIO()
+        try:
+            img.save(buf, 'JPEG')
+        except OSError as err:
+            log.warning('Error create thumbnail, convert to jpg first: %s', err)
+            buf = io.BytesIO()
+            img.convert('RGB').save(buf, 'JPEG')
+        return buf.getvalue(), img.size
+
+
+def write_thumbnail(data, thumbnail_folder):
+    """Write thumbnail data on thumbnail folder, named with its checksum.
+
+    Returns:
+        tuple: thumbnail path and checksum
+    """
+    checksum = hashlib.sha256(data).hexdigest()
+    thumbnail_path = os.path.join(thumbnail_folder, checksum + '.jpg')
+    if not os.path.isfile(thumbnail_path):
+        fd, temp_path = tempfile.mkstemp(dir=thumbnail_folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                temp.write(data)
+            os.replace(temp_path, thumbnail_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+    return thumbnail_path, checksum
+
+
+def create_thumbnail(file_path, thumbnail_folder):
+    data, _ = get_thumbnail_data(file_path)
+    return write_thumbnail(data, thumbnail_folder)[0]
+
+
+def _create_thumbnail_info(args):
+    file_path, thumbnail_folder = args
+    data, (width, height) = get_thumbnail_data(file_path)
+    thumbnail_path, checksum = write_thumbnail(data, thumbnail_folder)
+    with Image.open(io.BytesIO(data)) as img:
+        value = imghash.dhash(img)
+    return {
+        'checksum': checksum,
+        'size': len(data),
+        'width': width,
+        'height': height,
+        'img_format': 'JPEG',
+        'dhash': imghash.to_signed(value),
+        'path': thumbnail_path,
+    }
+
+
+def get_or_create_image_files_with_thumbnail(file_paths, **kwargs):
+    """Get or create image files with thumbnail.
+
+    Image files are hashed and the thumbnails are created on process pool.
+    Failed file is logged and its exception is returned instead of the model.
+
+    Args:
+        file_paths: list of path to image file
         **disable_cache: disable cache
+        **max_workers: number of process, default to number of cpu
         **session: database session
         **thumb_folder: thumbnail folder
+    Returns:
+        list: (model, created) or exception for each file path
     """
     # kwargs
     disable_cache = kwargs.get('disable_cache', False)
+    max_workers = kwargs.get('max_workers', None)
     session = kwargs.get('session', None)
     thumb_folder = kwargs.get('thumb_folder', None)
 
     session = models.db.session if session is None else session
     thumb_folder = thumb_folder if thumb_folder else models.DEFAULT_THUMB_FOLDER
-    img_file, img_file_created = \
-        get_or_create_image_file(file_path, disable_cache=disable_cache, session=session)
-    is_thumbnail_exist = False
-    file_path_eq_thumb_path = False
-    if img_file.thumbnail:
-        thumbnail_path = os.path.join(thumb_folder, img_file.thumbnail.checksum + '.jpg')
-        is_thumbnail_exist = os.path.isfile(thumbnail_path)
-        file_path_eq_thumb_path = file_path == thumbnail_path
-    if not is_thumbnail_exist and file_path_eq_thumb_path:
-        img_file.thumbnail = img_file
-    elif not is_thumbnail_exist:
-        thumbnail_file = create_thumbnail(file_path, thumb_folder)
-        log.debug('thumbnail created', m=thumbnail_file)
-        thumbnail_file_model, _ = \
-            get_or_create_image_file(thumbnail_file, disable_cache=disable_cache, session=session)
-        thumbnail_file_model.thumbnail = thumbnail_file_model
-        img_file.thumbnail = thumbnail_file_model
-    return img_file, img_file_created
+    os.makedirs(thumb_folder, exist_ok=True)
+    file_paths = list(file_paths)
+    res = map_in_process_pool(get_image_info, file_paths, max_workers=max_workers)
+    ok_idxs = [idx for idx, x in enumerate(res) if not isinstance(x, Exception)]
+    img_files = models.get_or_create_image_files(
+        session, [res[x] for x in ok_idxs], disable_cache=disable_cache)
+    thumb_idxs = []
+    for idx, (img_file, created) in zip(ok_idxs, img_files):
+        res[idx] = (img_file, created)
+        if file_paths[idx] == os.path.join(thumb_folder, img_file.checksum + '.jpg'):
+            img_file.thumbnail = img_file
+        elif not img_file.thumbnail or not os.path.isfile(
+                os.path.join(thumb_folder, img_file.thumbnail.checksum + '.jpg')):
+            thumb_idxs.append(idx)
+    thumb_res = map_in_process_pool(
+        _create_thumbnail_info, [(file_paths[x], thumb_folder) for x in thumb_idxs],
+        max_workers=max_workers)
+    thumb_ok = [(idx, x) for idx, x in zip(thumb_idxs, thumb_res) if not isinstance(x, Exception)]
+    thumb_files = models.get_or_create_image_files(
+        session, [x[1] for x in thumb_ok], disable_cache=disable_cache)
+    for (idx, _), (thumb_file, _) in zip(thumb_ok, thumb_files):
+        log.debug('thumbnail created: %s', thumb_file)
+        thumb_file.thumbnail = thumb_file
+        res[idx][0].thumbnail = thumb_file
+        # thumbnail is small, so image file get its dhash from the thumbnail
+        if res[idx][0].dhash is None:
+            res[idx][0].dhash = thumb_file.dhash
+    for idx, item in zip(thumb_idxs, thumb_res):
+        if isinstance(item, Exception):
+            res[idx] = item
+    for file_path, item in zip(file_paths, res):
+        if isinstance(item, Exception):
+            log.error('Failed to create image file: %s, %s', file_path, item)
+    return res
 
 
-def get_or_create_image_file(file_path, disable_cache=False, session=None):
-    """Get image file."""
+def get_or_create_image_file_with_thumbnail(file_path, **kwargs):
+    """Get or create image file with thumbnail.
+
+    Args:
+        file_path: path to image file
+        **disable_cache: disable cache
+        **session: database session
+        **thumb_folder: thumbnail folder
+    """
+    kwargs.setdefault('max_workers', 1)
+    res = get_or_create_image_files_with_thumbnail([file_path], **kwargs)[0]
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+
+def iter_image_file_stats(folder):
+    """Iterate (path, size, mtime_ns) of every image file under folder.
+
+    Image file is recognized by file extension registered on PIL.
+    """
+    exts = set(Image.registered_extensions())
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            entries = sorted(entries, key=lambda x: x.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts:
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def index_image_folder(
+        folder, session=None, chunk_size=1000, max_workers=None, retry_failed=False):
+    """Index image files under folder.
+
+    File with the same size and modification time as the last index is skipped,
+    other files are hashed on process pool and inserted in bulk.
+    Failed file is recorded with its error, so it is also skipped until it is changed.
+    Path record of removed file is deleted after the whole folder is indexed.
+
+    Args:
+        folder: image folder
+        session: database session
+        chunk_size: number of files on each chunk
+        max_workers: number of process, default to number of cpu
+        retry_failed: index unchanged file which is failed on the last index again
+    Yields:
+        Counter: files, indexed, failed and removed count of each chunk
+    """
     session = models.db.session if session is None else session
-    checksum = sha256_checksum(file_path)
-    model, created = models.get_or_create(
-        session, models.ImageFile, checksum=checksum)
-    if created or disable_cache:
-        kwargs = {}
-        img = Image.open(file_path)
-        kwargs['width'] = img.size[0]
-        kwargs['height'] = img.size[1]
-        kwargs['img_format'] = img.format
-        kwargs['size'] = os.path.getsize(file_path)
-        for key, value in kwargs.items():
-            setattr(model, key, value)
-    return model, created
+    folder = os.path.abspath(folder)
+    paths = set()
+    stats = []
+
+    def index_chunk():
+        changed = models.get_changed_image_file_paths(session, stats, retry_failed=retry_failed)
+        infos = map_in_process_pool(get_image_info, [x[0] for x in changed], max_workers)
+        items = list(zip(changed, infos))
+        failed_count = 0
+        for stat, info in items:
+            if isinstance(info, Exception):
+                log.error('Failed to index image file: %s, %s', stat[0], info)
+                failed_count += 1
+        models.update_image_file_paths(session, items)
+        return Counter(
+            files=len(stats), indexed=len(items) - failed_count, failed=failed_count)
+
+    for stat in iter_image_file_stats(folder):
+        paths.add(stat[0])
+        stats.append(stat)
+        if len(stats) >= chunk_size:
+            yield index_chunk()
+            stats = []
+    if stats:
+        yield index_chunk()
+    yield Counter(removed=models.remove_missing_image_file_paths(session, folder, paths))
 
 
-def create_thumbnail(file_path, thumbnail_folder):
-    with tempfile.NamedTemporaryFile() as temp:
-        img = Image.open(file_path)
-        size = (256, 256)
-        img.thumbnail(size)
-        try:
-            img.save(temp.name, 'JPEG')
-        except OSError as err:
-            log.warning('Error create thumbnail, convert to jpg first', error=err)
-            img.convert('RGB').save(temp.name, 'JPEG')
-        thumb_checksum = gid.sha256.sha256_checksum(temp.name)
-        thumbnail_path = os.path.join(thumbnail_folder, thumb_checksum + '.jpg')
-        if not os.path.isfile(thumbnail_path):
-            shutil.copyfile(temp.name, thumbnail_path)
-        return thumbnail_path
+def get_or_create_image_file(file_path, disable_cache=False, session=None):
+    """Get image file."""
+    session = models.db.session if session is None else session
+    return models.get_or_create_image_files(
+        session, [get_image_info(file_path)], disable_cache=disable_cache)[0]
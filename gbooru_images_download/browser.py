@@ -0,0 +1,238 @@
+"""Browser module.
+
+Pool of warm headless browser for selenium and requests_html render,
+so the browser is not started for every page.
+"""
+from contextlib import contextmanager
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    SELENIUM_ENABLED = True
+except ImportError:
+    SELENIUM_ENABLED = False
+
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+MAX_BROWSERS = 2
+MAX_PAGES = 50
+LEASE_TIMEOUT = 300
+HEALTH_CHECK_TIMEOUT = 5
+RENDER_BROWSER_ARGS = ['--no-sandbox']
+
+
+class BrowserPool:
+    """Pool of browser instance with lease and return api.
+
+    - at most max_size browser exist at a time, lease wait for returned browser after that
+    - browser is checked before it is leased, unhealthy browser is closed and replaced
+    - browser is closed after it is leased max_pages times, or when the lease raise error
+
+    Args:
+        create: function to create browser
+        close: function to close browser
+        check: function which return False or raise error when browser is not usable
+        max_size: maximum number of browser
+        max_pages: number of lease before the browser is recycled
+    """
+
+    def __init__(self, create, close, check=None, max_size=MAX_BROWSERS, max_pages=MAX_PAGES):
+        self.create = create
+        self.close_browser = close
+        self.check = check
+        self.max_size = max_size
+        self.max_pages = max_pages
+        self.created = 0
+        self.recycled = 0
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _is_healthy(self, browser):
+        if self.check is None:
+            return True
+        try:
+            return bool(self.check(browser))
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Browser health check failed: %s', err)
+            return False
+
+    def _discard(self, browser):
+        try:
+            self.close_browser(browser)
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Failed to close browser: %s', err)
+        with self._cond:
+            self._size -= 1
+            self.recycled += 1
+            self._cond.notify()
+
+    def _acquire(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while not self._closed and not self._idle and self._size >= self.max_size:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('No browser is available')
+                    self._cond.wait(remaining)
+                if self._closed:
+                    raise RuntimeError('Browser pool is closed')
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+                    entry = None
+            if entry is None:
+                try:
+                    browser = self.create()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self.created += 1
+                return [browser, 0]
+            if self._is_healthy(entry[0]):
+                return entry
+            self._discard(entry[0])
+
+    def _release(self, entry, broken=False):
+        entry[1] += 1
+        with self._cond:
+            recycle = broken or self._closed or entry[1] >= self.max_pages
+            if not recycle:
+                self._idle.append(entry)
+                self._cond.notify()
+        if recycle:
+            self._discard(entry[0])
+
+    @contextmanager
+    def lease(self, timeout=LEASE_TIMEOUT):
+        """Lease browser, it is returned to the pool when the context exit."""
+        entry = self._acquire(timeout)
+        broken = True
+        try:
+            yield entry[0]
+            broken = False
+        finally:
+            self._release(entry, broken=broken)
+
+    def close(self):
+        """Close idle browser, leased browser is closed when it is returned."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for entry in idle:
+            self._discard(entry[0])
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'max_size': self.max_size,
+                'created': self.created,
+                'recycled': self.recycled,
+            }
+
+
+def create_firefox():
+    options = Options()
+    options.add_argument("--headless")
+    return webdriver.Firefox(firefox_options=options)
+
+
+def check_webdriver(driver):
+    # raise error when the browser process is gone
+    return driver.current_url is not None
+
+
+class RenderBrowser:
+    """Launched pyppeteer browser with its own event loop.
+
+    It has the loop and browser attribute which `requests_html.HTML.render` use from its session,
+    so it is used as the session while rendering.
+    Every browser have its own loop, so it can be used from any thread.
+    """
+
+    def __init__(self, loop, browser):
+        self.loop = loop
+        self.browser = browser
+
+
+def create_render_browser():
+    # pyppeteer is only imported when the browser is launched
+    import pyppeteer
+    loop = asyncio.new_event_loop()
+    try:
+        browser = loop.run_until_complete(pyppeteer.launch(
+            headless=True, args=RENDER_BROWSER_ARGS,
+            # signal handler can only be set on main thread
+            handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False))
+    except Exception:
+        loop.close()
+        raise
+    return RenderBrowser(loop, browser)
+
+
+def check_render_browser(render_browser):
+    return render_browser.loop.run_until_complete(
+        asyncio.wait_for(render_browser.browser.version(), HEALTH_CHECK_TIMEOUT))
+
+
+def close_render_browser(render_browser):
+    try:
+        render_browser.loop.run_until_complete(render_browser.browser.close())
+    finally:
+        render_browser.loop.close()
+
+
+selenium_pool = BrowserPool(create_firefox, lambda x: x.quit(), check=check_webdriver)
+render_pool = BrowserPool(
+    create_render_browser, close_render_browser, check=check_render_browser)
+metrics.registry.register(metrics.GaugeFunc(
+    'gbooru_browser_pool', 'Browser pool stats.', ('pool', 'stat'),
+    func=lambda: {
+        (name, k): v for name, pool in (('selenium', selenium_pool), ('render', render_pool))
+        for k, v in pool.stats().items()}))
+
+
+def get_page_source(url, timeout=LEASE_TIMEOUT):
+    """Get page source of url with pooled selenium browser."""
+    with selenium_pool.lease(timeout=timeout) as driver:
+        driver.get(url)
+        return driver.page_source
+
+
+def render(html, timeout=LEASE_TIMEOUT, **kwargs):
+    """Render requests_html HTML with pooled browser.
+
+    Args:
+        html: `requests_html.HTML`, e.g. `resp.html`
+        timeout: timeout to wait for available browser
+        **kwargs: keyword arguments for `HTML.render`
+    """
+    original_session = html.session
+    with render_pool.lease(timeout=timeout) as render_browser:
+        html.session = render_browser
+        try:
+            return html.render(**kwargs)
+        finally:
+            html.session = original_session
+
+
+@atexit.register
+def close_pools():
+    for pool in (selenium_pool, render_pool):
+        pool.close()
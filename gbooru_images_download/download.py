@@ -0,0 +1,240 @@
+"""Download module.
+
+Download image of match result url to disk and register it as image file.
+
+Every url have `models.Download` record for its status.
+Data is streamed into part file while it is hashed, so unfinished download
+is resumed with range request on the next run.
+"""
+from collections import Counter
+import hashlib
+import json
+import logging
+import os
+
+from appdirs import user_data_dir
+
+from . import api, fetch, models
+
+
+log = logging.getLogger(__name__)
+DEFAULT_DOWNLOAD_FOLDER = os.path.join(
+    user_data_dir('gbooru_images_download', 'rachmadaniharyono'), 'download')
+STREAM_CHUNK_SIZE = 1 << 16
+# image format with different extension from its name
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'MPO': '.jpg'}
+
+
+def get_part_path(folder, url):
+    """Get path of partial data of url, it stays the same between runs."""
+    return os.path.join(
+        folder, 'part', hashlib.sha1(url.encode('utf8')).hexdigest() + '.part')
+
+
+def get_file_path(folder, checksum, img_format):
+    """Get path of downloaded file, named with its checksum."""
+    ext = FORMAT_EXTENSIONS.get(img_format, '.' + (img_format or 'bin').lower())
+    return os.path.join(folder, checksum[:2], checksum + ext)
+
+
+def _read_part_meta(part_path):
+    try:
+        with open(part_path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_part_meta(part_path, resp):
+    meta = {x: resp.headers.get(x) for x in ('ETag', 'Last-Modified') if resp.headers.get(x)}
+    with open(part_path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def _remove_part(part_path):
+    for path in (part_path, part_path + '.json'):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _get_range_start(resp):
+    """Get start of content range from 206 response, e.g. 'bytes 100-199/200'."""
+    content_range = resp.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def stream_to_part_file(url, part_path, timeout=fetch.DEFAULT_TIMEOUT):
+    """Stream url into part file and hash it.
+
+    When the part file exists, its data is hashed and the rest is requested with range request.
+    If-Range header with the previous ETag or Last-Modified make the server send the whole file
+    when it is changed.
+
+    Returns:
+        str: sha256 checksum of the whole file
+    """
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    hasher = hashlib.sha256()
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {}
+    if offset:
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        headers['Range'] = 'bytes={}-'.format(offset)
+        meta = _read_part_meta(part_path)
+        validator = meta.get('ETag', meta.get('Last-Modified'))
+        if validator:
+            headers['If-Range'] = validator
+    with fetch.fetch(
+            url, requests_lib='requests', stream=True, headers=headers, timeout=timeout) as resp:
+        if resp.status_code == 416 and offset:
+            # part file is not valid for current file, e.g. file is replaced with smaller one
+            _remove_part(part_path)
+            return stream_to_part_file(url, part_path, timeout=timeout)
+        resp.raise_for_status()
+        if offset and (resp.status_code != 206 or _get_range_start(resp) != offset):
+            log.debug('Range request is not used, download from start: %s', url)
+            offset = 0
+            hasher = hashlib.sha256()
+        _write_part_meta(part_path, resp)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                f.write(chunk)
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def download_url(url, folder, timeout=fetch.DEFAULT_TIMEOUT):
+    """Download url into folder.
+
+    Returns:
+        dict: image info with path key, see `api.get_image_info`
+    """
+    part_path = get_part_path(folder, url)
+    checksum = stream_to_part_file(url, part_path, timeout=timeout)
+    try:
+        # url dhash is taken from downloaded file, see `set_url_dhash`
+        info = api.get_image_info(part_path, checksum=checksum, dhash=True)
+    except OSError:
+        # not an image, don't resume it
+        _remove_part(part_path)
+        raise
+    info['path'] = get_file_path(folder, checksum, info['img_format'])
+    os.makedirs(os.path.dirname(info['path']), exist_ok=True)
+    os.replace(part_path, info['path'])
+    _remove_part(part_path)
+    return info
+
+
+def get_match_result_urls(session, search_query=None, query=None, original=True, thumbnail=True):
+    """Get url of match results.
+
+    Args:
+        session: database session
+        search_query: only get match results of this search query
+        query: match result query, e.g. filtered query from match result view
+        original: include match result url
+        thumbnail: include match result thumbnail url
+    Returns:
+        list: url models, thumbnail url come before original url
+    """
+    query = session.query(models.MatchResult) if query is None else query
+    if search_query is not None:
+        query = query.filter(models.MatchResult.search_queries.any(id=search_query.id))
+    columns = []
+    if thumbnail:
+        columns.append(models.MatchResult.thumbnail_url_id)
+    if original:
+        columns.append(models.MatchResult.url_id)
+    res = []
+    for column in columns:
+        url_ids = query.with_entities(column).filter(column.isnot(None)).subquery()
+        res.extend(session.query(models.Url).filter(models.Url.id.in_(url_ids))
+                   .order_by(models.Url.id))
+    return list(dict.fromkeys(res))
+
+
+def set_url_dhash(session, downloads):
+    """Set dhash of downloaded url and the original url of downloaded thumbnail url.
+
+    So original url can be compared with `models.find_near_duplicates` before it is downloaded.
+    """
+    dhashes = {}
+    for download in downloads:
+        if download.image_file is None or download.image_file.dhash is None:
+            continue
+        dhashes[download.url_id] = download.image_file.dhash
+        if download.url.dhash is None:
+            download.url.dhash = download.image_file.dhash
+    url_ids = list(dhashes)
+    for idx in range(0, len(url_ids), models.BULK_CHUNK_SIZE):
+        chunk = url_ids[idx:idx + models.BULK_CHUNK_SIZE]
+        query = session.query(models.MatchResult.thumbnail_url_id, models.Url) \
+            .join(models.Url, models.Url.id == models.MatchResult.url_id) \
+            .filter(models.MatchResult.thumbnail_url_id.in_(chunk)) \
+            .filter(models.Url.dhash.is_(None))
+        for thumbnail_url_id, url in query:
+            if url.dhash is None:
+                url.dhash = dhashes[thumbnail_url_id]
+
+
+def download_urls(session, urls, folder=None, chunk_size=100, **kwargs):
+    """Download urls concurrently with per host limit.
+
+    Url which is already downloaded is skipped when its file still exists.
+    Download of every chunk is committed by the caller, see `download` command.
+
+    Args:
+        session: database session
+        urls: list of url models
+        folder: download folder
+        chunk_size: number of url on each chunk
+        **max_workers: maximum number of concurrent download
+        **per_host_limit: maximum number of concurrent download from single host
+        **timeout: request timeout
+    Yields:
+        Counter: number of downloaded, skipped and failed url on each chunk
+    """
+    folder = folder if folder else DEFAULT_DOWNLOAD_FOLDER
+    map_kwargs = {x: kwargs[x] for x in ('max_workers', 'per_host_limit') if x in kwargs}
+    timeout = kwargs.get('timeout', fetch.DEFAULT_TIMEOUT)
+    urls = list(urls)
+    for idx in range(0, len(urls), chunk_size):
+        chunk = urls[idx:idx + chunk_size]
+        downloads = models.get_or_create_downloads(session, [x.id for x in chunk])
+        counter = Counter()
+        todo = []
+        for url in chunk:
+            download = downloads[url.id]
+            if download.status == models.Download.STATUS_DONE and download.path and \
+                    os.path.isfile(download.path):
+                counter['skipped'] += 1
+            else:
+                todo.append(download)
+        res = fetch.map_many(
+            download_url,
+            [{'url': str(x.url.value), 'folder': folder, 'timeout': timeout} for x in todo],
+            **map_kwargs)
+        ok = []
+        for download, item in zip(todo, res):
+            download.attempts += 1
+            if isinstance(item, Exception):
+                log.warning('Failed to download: %s, %s', download.url.value, item)
+                download.status = models.Download.STATUS_FAILED
+                download.error = str(item)
+                counter['failed'] += 1
+            else:
+                ok.append((download, item))
+        img_files = models.get_or_create_image_files(session, [x[1] for x in ok])
+        for (download, info), (img_file, _) in zip(ok, img_files):
+            download.status = models.Download.STATUS_DONE
+            download.path = info['path']
+            download.error = None
+            download.image_file = img_file
+            counter['downloaded'] += 1
+        set_url_dhash(session, [x[0] for x in ok])
+        yield counter
@@ -1,2 +1,10 @@
 class NoResultFound(ValueError):
     pass
+
+
+class HostThrottled(Exception):
+    """Host throttle the request, response is the last throttled response if any."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
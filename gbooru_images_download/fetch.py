@@ -0,0 +1,364 @@
+"""Fetch module.
+
+Shared HTTP sessions with connection pool, per host rate limit
+and concurrent fetch with per host limit.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import partial
+from urllib.parse import urlparse
+import asyncio
+import datetime
+import logging
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests_html import HTMLResponse, HTMLSession
+import requests
+
+from . import exceptions, metrics
+
+
+log = logging.getLogger(__name__)
+DEFAULT_TIMEOUT = 30
+MAX_WORKERS = 16
+PER_HOST_LIMIT = 4
+POOL_MAXSIZE = 32
+REQUESTS_LIBS = ('requests', 'requests_html')
+# (requests per second, burst) of host and its subdomain, other host is not limited
+# until it is throttled
+HOST_RATES = {'google.com': (0.5, 1)}
+MAX_RETRIES = 5
+# maximum seconds a single fetch call wait for the host, including the retry
+MAX_WAIT = 1800
+# backoff when host is throttled, doubled on every throttled request in a row
+BASE_BACKOFF = 30
+MAX_BACKOFF = 900
+BACKOFF_FACTOR = 0.5
+RECOVERY_FACTOR = 1.05
+MIN_RATE = 1 / 60
+# rate of not limited host after it is throttled
+THROTTLED_RATE = 1
+THROTTLED_STATUS_CODES = (429, )
+# host and its subdomain which use 503 for throttled request instead of server error
+THROTTLED_503_HOSTS = ('google.com', )
+UNUSUAL_TRAFFIC_TEXT = b'Our systems have detected unusual traffic from your computer network.'
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(requests_lib='requests_html'):
+    """Get process-wide session for requests lib.
+
+    The session keep the connection alive, so next request to the same host
+    don't need new TCP connection and TLS handshake.
+    """
+    assert requests_lib in REQUESTS_LIBS, 'Unknown requests lib: {}'.format(requests_lib)
+    with _sessions_lock:
+        session = _sessions.get(requests_lib)
+        if session is None:
+            session = HTMLSession() if requests_lib == 'requests_html' else requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[requests_lib] = session
+        return session
+
+
+class TokenBucket:
+    """Token bucket of a host with adaptive backoff.
+
+    Rate is lowered and the host is blocked for a while when it is throttled,
+    then the rate is raised slowly on every successful request.
+    Rate None mean the host is not limited.
+    """
+
+    def __init__(self, rate=None, burst=1, clock=time.monotonic):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+        self.throttle_count = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # token is not added while the host is blocked
+        if now > self.updated:
+            if self.rate is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self):
+        """Take a token and get seconds to wait before the request is sent.
+
+        Token can go below zero, so concurrent request is queued one after another.
+        """
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            delay = max(0., self.updated - now)
+            if self.rate is None:
+                return delay
+            self.tokens -= 1
+            if self.tokens < 0:
+                delay += -self.tokens / self.rate
+            return delay
+
+    def throttled(self, retry_after=None):
+        """Lower the rate and block the host, return seconds the host is blocked."""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            if retry_after is None:
+                backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** self.throttle_count)
+            else:
+                backoff = retry_after
+            self.throttle_count += 1
+            self.rate = max(MIN_RATE, (self.rate or THROTTLED_RATE) * BACKOFF_FACTOR)
+            self.updated = max(self.updated, now + backoff)
+            self.tokens = 1.
+            return backoff
+
+    def get_blocked_seconds(self):
+        """Get seconds until the host is not blocked."""
+        with self._lock:
+            return max(0., self.updated - self.clock())
+
+    def succeeded(self):
+        with self._lock:
+            self.throttle_count = 0
+            if self.rate is None or self.rate == self.base_rate:
+                return
+            self.rate *= RECOVERY_FACTOR
+            limit = self.base_rate if self.base_rate is not None else THROTTLED_RATE
+            if self.rate >= limit:
+                self.rate = self.base_rate
+
+
+def get_retry_after(resp, now=None):
+    """Get seconds on Retry-After header or None.
+
+    The header value is either seconds or http date.
+    """
+    value = resp.headers.get('Retry-After', '').strip()
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc) if now is None else now
+    return max(0, int((date - now).total_seconds()))
+
+
+def iter_parent_domains(netloc):
+    """Iterate host of netloc and its parent domains."""
+    parts = netloc.split(':')[0].lower().split('.')
+    for idx in range(len(parts)):
+        yield '.'.join(parts[idx:])
+
+
+def is_throttled(resp, stream=False):
+    """Check if the host throttle the request.
+
+    Body of streamed response is not checked, so it can still be read by the caller.
+    """
+    if resp.status_code in THROTTLED_STATUS_CODES:
+        return True
+    if resp.status_code == 503 and \
+            not set(iter_parent_domains(urlparse(resp.url).netloc)).isdisjoint(
+                THROTTLED_503_HOSTS):
+        return True
+    if urlparse(resp.url).path.startswith('/sorry/'):
+        return True
+    if not stream and 'html' in resp.headers.get('Content-Type', ''):
+        return UNUSUAL_TRAFFIC_TEXT in resp.content
+    return False
+
+
+class HostScheduler:
+    """Shared token bucket scheduler for every host."""
+
+    def __init__(self, rates=None, clock=time.monotonic, sleep=time.sleep):
+        self.rates = dict(HOST_RATES if rates is None else rates)
+        self.clock = clock
+        self.sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get_rate(self, netloc):
+        """Get (rate, burst) of host, from the host or its parent domain."""
+        for domain in iter_parent_domains(netloc):
+            rate = self.rates.get(domain)
+            if rate is not None:
+                return rate
+        return None, 1
+
+    def get_bucket(self, url):
+        netloc = urlparse(url).netloc.lower()
+        with self._lock:
+            bucket = self._buckets.get(netloc)
+            if bucket is None:
+                rate, burst = self.get_rate(netloc)
+                bucket = self._buckets[netloc] = TokenBucket(rate, burst, clock=self.clock)
+            return bucket
+
+    def wait(self, url):
+        """Wait until request to url can be sent, return waited seconds."""
+        delay = self.get_bucket(url).reserve()
+        if delay > 0:
+            log.debug('Wait %.2fs for %s', delay, url)
+            self.sleep(delay)
+        return delay
+
+    def report(self, url, resp, stream=False):
+        """Update bucket of url host with the response.
+
+        Returns:
+            bool: True if the request is throttled
+        """
+        bucket = self.get_bucket(url)
+        if is_throttled(resp, stream=stream):
+            backoff = bucket.throttled(get_retry_after(resp))
+            log.warning('Throttled by host, backoff %ss: %s', backoff, url)
+            return True
+        bucket.succeeded()
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+scheduler = HostScheduler()
+
+
+def fetch(
+        url, method='get', requests_lib='requests_html', max_retries=MAX_RETRIES,
+        max_wait=MAX_WAIT, **kwargs):
+    """Fetch url with shared session.
+
+    Request is scheduled with the host token bucket.
+    Throttled request is sent again after the backoff, up to max_retries times
+    and as long as the total wait is not longer than max_wait.
+
+    Args:
+        url: url
+        method: http method
+        requests_lib: 'requests' or 'requests_html'
+        max_retries: maximum retry of throttled request, 0 for interactive request
+        max_wait: maximum seconds to wait for the host
+        **kwargs: keyword arguments for session request
+    Returns:
+        response which is not throttled
+    Raises:
+        exceptions.HostThrottled: the request is still throttled when the retry is exhausted
+            or the host is blocked longer than max_wait, with the last throttled response
+    """
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    session = get_session(requests_lib)
+    bucket = scheduler.get_bucket(url)
+    waited = 0.
+    resp = None
+    for _ in range(max_retries + 1):
+        blocked = bucket.get_blocked_seconds()
+        if waited + blocked > max_wait:
+            if resp is not None:
+                resp.close()
+            raise exceptions.HostThrottled(
+                'Host is throttled for {:.0f}s after {:.0f}s wait: {}'.format(
+                    blocked, waited, url),
+                response=resp)
+        if resp is not None:
+            resp.close()
+        waited += scheduler.wait(url)
+        start = time.perf_counter()
+        try:
+            resp = session.request(method.upper(), url, **kwargs)
+        except Exception:
+            metrics.observe_fetch(url, time.perf_counter() - start)
+            raise
+        metrics.observe_fetch(url, time.perf_counter() - start, resp)
+        if not scheduler.report(url, resp, stream=kwargs.get('stream', False)):
+            return resp
+    resp.close()
+    raise exceptions.HostThrottled(
+        'Request is throttled after {} retries: {}'.format(max_retries, url), response=resp)
+
+
+def build_response(
+        content, status_code, headers, url, encoding=None, reason=None,
+        requests_lib='requests_html'):
+    """Build response from stored data without request."""
+    resp = requests.Response()
+    resp._content = content
+    resp.status_code = status_code
+    resp.headers = CaseInsensitiveDict(headers)
+    resp.url = url
+    resp.encoding = encoding
+    resp.reason = reason
+    if requests_lib == 'requests_html':
+        resp = HTMLResponse._from_response(resp, get_session(requests_lib))
+    return resp
+
+
+async def _map_all(func, requests_kwargs, executor, per_host_limit):
+    loop = asyncio.get_event_loop()
+    semaphores = defaultdict(lambda: asyncio.Semaphore(per_host_limit))
+
+    async def call_one(kwargs):
+        async with semaphores[urlparse(kwargs['url']).netloc]:
+            return await loop.run_in_executor(executor, partial(func, **kwargs))
+
+    return await asyncio.gather(
+        *[call_one(x) for x in requests_kwargs], return_exceptions=True)
+
+
+def map_many(func, requests_kwargs, max_workers=MAX_WORKERS, per_host_limit=PER_HOST_LIMIT):
+    """Call func for many url concurrently with per host limit.
+
+    Args:
+        func: function which is called with every item on requests_kwargs as keyword arguments
+        requests_kwargs: list of keyword arguments for func, each must have url key
+        max_workers: maximum number of concurrent call
+        per_host_limit: maximum number of concurrent call for a single host
+    Returns:
+        list: result or exception for each item on requests_kwargs, on the same order.
+    """
+    requests_kwargs = list(requests_kwargs)
+    if not requests_kwargs:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return loop.run_until_complete(
+                _map_all(func, requests_kwargs, executor, per_host_limit))
+    finally:
+        loop.close()
+
+
+def fetch_many(requests_kwargs, max_workers=MAX_WORKERS, per_host_limit=PER_HOST_LIMIT):
+    """Fetch many url concurrently.
+
+    Args:
+        requests_kwargs: list of keyword arguments for `fetch`, each must have url key
+        max_workers: maximum number of concurrent request
+        per_host_limit: maximum number of concurrent request to a single host
+    Returns:
+        list: response or exception for each item on requests_kwargs, on the same order.
+    """
+    return map_many(
+        fetch, requests_kwargs, max_workers=max_workers, per_host_limit=per_host_limit)
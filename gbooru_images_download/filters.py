@@ -1,23 +1,27 @@
 """filter module."""
 from flask_admin.contrib.sqla.filters import BaseSQLAFilter
 
-from . import models
+from . import ajax, models
 
 
 class MatchResultSearchQueryFilter(BaseSQLAFilter):
+    """Filter by search query, the options are loaded with `ajax.search_query_loader`."""
+
+    def __init__(self, column, name, options=None, data_type=None):
+        super().__init__(
+            column, name, options=options,
+            data_type=data_type or ajax.get_filter_data_type(ajax.search_query_loader))
+
     def apply(self, query, value, alias=None):
         res = query.filter(
-            self.column.search_queries.contains(models.SearchQuery.query.get(value)))
+            self.column.search_queries.any(models.SearchQuery.id == value))
         return res
 
     def operation(self):
         return 'equal'
 
-    def get_options(self, view):
-        return [
-            (str(x.id), "'{}' page:{}".format(x.search_term.value, x.page))
-            for x in models.SearchQuery.query.all()
-        ]
+    def clean(self, value):
+        return int(value)
 
 
 class MatchResultFilteredUrlFilter(BaseSQLAFilter):
@@ -57,14 +61,18 @@ class FilteredImageUrl(BaseSQLAFilter):
 
 
 class TagFilter(BaseSQLAFilter):
+    """Filter by tag, the options are loaded with `ajax.tag_loader`."""
+
+    def __init__(self, column, name, options=None, data_type=None):
+        super().__init__(
+            column, name, options=options,
+            data_type=data_type or ajax.get_filter_data_type(ajax.tag_loader))
+
     def apply(self, query, value, alias=None):
-        pass
+        return query.filter(self.column.tags.any(models.Tag.id == value))
 
     def operation(self):
         return 'contain'
 
-    def get_options(self, view):
-        return [
-            (str(x.id), x.as_string)
-            for x in models.Tag.query.all()
-        ]
+    def clean(self, value):
+        return int(value)
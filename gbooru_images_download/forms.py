@@ -1,9 +1,10 @@
 """Forms module."""
+from flask_admin.model.fields import AjaxSelectField
 from flask_wtf import FlaskForm
 from wtforms.validators import DataRequired, Optional
 import wtforms
 
-from gbooru_images_download import models
+from gbooru_images_download import ajax, models
 
 
 class IndexForm(FlaskForm):  # pylint: disable=too-few-public-methods
@@ -11,8 +12,9 @@ class IndexForm(FlaskForm):  # pylint: disable=too-few-public-methods
     search_term = wtforms.StringField('search term', validators=[DataRequired()])
     page = wtforms.IntegerField('page', default=1)
     disable_cache = wtforms.BooleanField(validators=[Optional()])
+    mode = wtforms.HiddenField('mode', default='Google image')
 
 
 class ResponseParserForm(FlaskForm):
-    response = wtforms.SelectField()
+    response = AjaxSelectField(ajax.response_loader)
     parser = wtforms.SelectField()
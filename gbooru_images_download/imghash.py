@@ -0,0 +1,105 @@
+"""Image hash module.
+
+Perceptual hash of image to find resized or re-encoded copy of the same picture,
+with BK-tree to search hash under hamming distance.
+"""
+from PIL import Image
+
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DEFAULT_MAX_DISTANCE = 10
+
+
+def dhash(img, hash_size=HASH_SIZE):
+    """Get difference hash of PIL image.
+
+    Image is resized into (hash_size + 1, hash_size) grayscale image,
+    and every bit is whether a pixel is brighter than its right neighbour.
+
+    Returns:
+        int: unsigned hash with hash_size * hash_size bits
+    """
+    img.draft('L', (hash_size + 1, hash_size))
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = img.tobytes()
+    res = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            idx = row * (hash_size + 1) + col
+            res = (res << 1) | (pixels[idx] > pixels[idx + 1])
+    return res
+
+
+def dhash_file(file_path, hash_size=HASH_SIZE):
+    """Get difference hash of image file."""
+    with Image.open(file_path) as img:
+        return dhash(img, hash_size=hash_size)
+
+
+def to_signed(value, bits=HASH_BITS):
+    """Convert unsigned hash to signed integer, so it fit on signed 64 bit column."""
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+def to_unsigned(value, bits=HASH_BITS):
+    """Convert signed integer from database back to unsigned hash."""
+    return value + (1 << bits) if value < 0 else value
+
+
+def hamming_distance(value1, value2):
+    """Number of different bits between two hashes."""
+    return bin(value1 ^ value2).count('1')
+
+
+class BKTree:
+    """BK-tree of hash with hamming distance.
+
+    Every child of a node is keyed by its distance to the node,
+    so on search only child with distance in [d - max_distance, d + max_distance]
+    need to be visited (triangle inequality).
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        """Add item with its hash value."""
+        self.size += 1
+        if self.root is None:
+            # node is [value, items, children]
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def find(self, value, max_distance=DEFAULT_MAX_DISTANCE):
+        """Find items with hash under max_distance from value.
+
+        Returns:
+            list: (distance, hash value, items) sorted by distance
+        """
+        res = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                res.append((distance, node[0], list(node[1])))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return sorted(res, key=lambda x: (x[0], x[1]))
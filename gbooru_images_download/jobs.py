@@ -0,0 +1,186 @@
+"""Job module.
+
+Background job which is too slow to run on web request, e.g. search query which is not cached.
+
+Job is queued on the database with `models.enqueue_job` and run by worker process,
+see `worker` command.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import os
+import socket
+import threading
+import time
+
+from flask import current_app
+
+from . import models, singleflight, writer
+
+
+log = logging.getLogger(__name__)
+POLL_INTERVAL = 1
+# seconds between heartbeat of running job
+HEARTBEAT_INTERVAL = 60
+# running job without heartbeat for this long is from killed worker
+STALE_TIMEOUT = 600
+# seconds between stale job check of the worker
+REQUEUE_INTERVAL = 60
+# queued job is run on the request when no worker is seen for this long
+WORKER_TIMEOUT = 120
+MAX_ATTEMPTS = 3
+JOB_HANDLERS = {}
+
+
+def handler(kind):
+    """Register function as handler of job kind.
+
+    Handler is called with database session and job args as keyword arguments,
+    its return value is the job result and must be json serializable.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+@handler('search_query')
+def run_search_query(session, search_term, page, mode_id, use_cache=True):
+    """Run search query, see `models.SearchQuery.run`."""
+    mode = session.query(models.Plugin).get(mode_id)
+    if mode is None:
+        raise ValueError('Unknown mode plugin id: {}'.format(mode_id))
+    model = models.SearchQuery.run(session, search_term, page, mode, use_cache=use_cache)
+    return {
+        'search_query_id': model.id,
+        'search_term': model.search_term,
+        'page': model.page,
+        'match_result_count': len(model.match_results),
+    }
+
+
+def enqueue_search_query(session, search_term, page, mode, use_cache=True):
+    """Queue search query job, the caller commit the session.
+
+    Returns:
+        tuple: job model and True if it is created, see `models.enqueue_job`
+    """
+    if mode.id is None:
+        session.flush()
+    return models.enqueue_job(
+        session, 'search_query', key=singleflight.get_search_query_key(search_term, page, mode),
+        search_term=search_term, page=page, mode_id=mode.id, use_cache=use_cache)
+
+
+def get_worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+@contextmanager
+def heartbeat(engine, job_id, interval=HEARTBEAT_INTERVAL):
+    """Update heartbeat of running job on other thread while the context is running.
+
+    Heartbeat use its own connection, so it is not committed with the job session.
+    """
+    table = models.Job.__table__
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        table.update()
+                        .where(table.c.id == job_id)
+                        .where(table.c.status == models.Job.STATUS_RUNNING)
+                        .values(updated_at=datetime.now()))
+            except Exception as err:  # pylint: disable=broad-except
+                log.warning('Failed to update job heartbeat: %s', err)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(session, job, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """Run claimed job and save its result or error with write-behind writer."""
+    func = JOB_HANDLERS.get(job.kind)
+    job_id = job.id
+    try:
+        if func is None:
+            raise ValueError('Unknown job kind: {}'.format(job.kind))
+        with heartbeat(session.get_bind(), job_id, interval=heartbeat_interval):
+            result = func(session, **(job.args or {}))
+    except Exception as err:  # pylint: disable=broad-except
+        log.exception('Job failed: %s', job)
+        session.rollback()
+        values = {'status': models.Job.STATUS_FAILED, 'error': str(err)}
+    else:
+        values = {'status': models.Job.STATUS_DONE, 'result': result, 'error': None}
+    values['finished_at'] = values['updated_at'] = datetime.now()
+    writer.write(session, models.update_job, job_id, values)
+    session.commit()
+    session.expire(job)
+    return job
+
+
+def requeue_stale_jobs(session):
+    """Queue stale job again and commit it, see `models.requeue_stale_jobs`."""
+    count = models.requeue_stale_jobs(session, STALE_TIMEOUT, MAX_ATTEMPTS)
+    session.commit()
+    if count:
+        log.info('Stale job is queued again: %s', count)
+    return count
+
+
+def is_enabled(session):
+    """Check if search should be queued, see `JOB_QUEUE` app config.
+
+    Job is run on the request instead when queued job is not claimed by any worker.
+    """
+    if not current_app.config.get('JOB_QUEUE'):
+        return False
+    if models.is_job_queue_stalled(session, WORKER_TIMEOUT):
+        log.warning('No worker is running, run job on the request.')
+        return False
+    return True
+
+
+def run_worker(
+        session, poll_interval=POLL_INTERVAL, max_jobs=None, stop_when_empty=False,
+        kinds=None, worker=None):
+    """Claim and run queued job until stopped.
+
+    Stale job of killed worker is queued again every `REQUEUE_INTERVAL` seconds.
+
+    Args:
+        session: database session
+        poll_interval: seconds to wait when the queue is empty
+        max_jobs: stop after this number of job
+        stop_when_empty: stop when the queue is empty
+        kinds: only run job of these kinds
+        worker: worker name, default to host name and process id
+    Returns:
+        int: number of job which is run
+    """
+    worker = worker if worker else get_worker_name()
+    count = 0
+    requeued_at = None
+    while max_jobs is None or count < max_jobs:
+        if requeued_at is None or time.monotonic() - requeued_at >= REQUEUE_INTERVAL:
+            requeue_stale_jobs(session)
+            requeued_at = time.monotonic()
+        job = models.claim_job(session, worker, kinds=kinds)
+        if job is None:
+            if stop_when_empty:
+                break
+            time.sleep(poll_interval)
+            continue
+        log.debug('Run job: %s', job)
+        run_job(session, job)
+        count += 1
+    return count
@@ -0,0 +1,324 @@
+"""Metrics module.
+
+Request, sql, fetch, plugin and view formatter timing, exposed as prometheus text on `/metrics`.
+
+Metrics are kept per process, every worker process have its own value.
+"""
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import bisect
+import logging
+import threading
+import time
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+
+
+log = logging.getLogger(__name__)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+SQL_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of metric with labels."""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('Labels of {}: {}'.format(self.name, self.label_names))
+        return tuple(str(labels[x]) for x in self.label_names)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Iterate (suffix, label values, extra labels, value) of every sample."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(self.label_names, values, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield '_total' if not self.name.endswith('_total') else '', key, (), value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # bucket counts, sum and count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe elapsed time of the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Get (count, sum) of labels."""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return (entry[2], entry[1]) if entry else (0, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, ([x for x in v[0]], v[1], v[2])) for k, v in self._values.items())
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'), ), bucket_counts):
+                cumulative += bucket_count
+                yield '_bucket', key, (('le', _format_value(float(bound))), ), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+
+class GaugeFunc(Metric):
+    """Gauge which value is taken from function when it is rendered.
+
+    The function return dict of label values tuple and value.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), func=None):
+        super().__init__(name, documentation, label_names)
+        self.func = func
+
+    def samples(self):
+        try:
+            items = sorted(self.func().items())
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Failed to get gauge %s: %s', self.name, err)
+            return
+        for key, value in items:
+            yield '', tuple(str(x) for x in key), (), value
+
+
+class Registry:
+    """Collection of metric which is rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def clear(self):
+        """Clear value of every metric, gauge function is kept."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return '\n'.join(x[1].render() for x in metrics) + '\n'
+
+
+class IterTimer:
+    """Iterator which add time spent on getting each item of the iterable.
+
+    Used for lazy parser, so its time can be measured apart from the consumer.
+    """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.elapsed = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+registry = Registry()
+REQUEST_DURATION = registry.register(Histogram(
+    'gbooru_http_request_duration_seconds', 'Wall time of http request.',
+    ('method', 'endpoint', 'status')))
+REQUEST_SQL_QUERIES = registry.register(Histogram(
+    'gbooru_http_request_sql_queries', 'Number of sql query on http request.',
+    ('endpoint', ), buckets=COUNT_BUCKETS))
+SQL_DURATION = registry.register(Histogram(
+    'gbooru_sql_query_duration_seconds', 'Sql query time.', ('statement', )))
+FETCH_DURATION = registry.register(Histogram(
+    'gbooru_fetch_duration_seconds', 'Time of fetched url until the header is received.',
+    ('host', 'status')))
+PLUGIN_DURATION = registry.register(Histogram(
+    'gbooru_plugin_duration_seconds', 'Time of mode plugin fetch, parse and ingest stage.',
+    ('plugin', 'stage')))
+FORMATTER_DURATION = registry.register(Histogram(
+    'gbooru_view_formatter_duration_seconds', 'Time of admin view column formatter.',
+    ('view', 'column'), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)))
+INGEST_ROWS = registry.register(Counter(
+    'gbooru_ingest_rows_total', 'Rows passed to bulk insert or update.', ('table', )))
+INGEST_INSERTED_ROWS = registry.register(Counter(
+    'gbooru_ingest_inserted_rows_total', 'Rows inserted by bulk insert.', ('table', )))
+INGEST_UPDATED_ROWS = registry.register(Counter(
+    'gbooru_ingest_updated_rows_total', 'Rows updated by bulk update.', ('table', )))
+PLUGIN_MANAGER_DURATION = registry.register(Histogram(
+    'gbooru_plugin_manager_duration_seconds', 'Time to get plugin manager.', ('collected', )))
+
+
+def get_host(url):
+    return urlparse(url).hostname or ''
+
+
+def observe_fetch(url, elapsed, resp=None):
+    FETCH_DURATION.observe(
+        elapsed, host=get_host(url), status=resp.status_code if resp is not None else 'error')
+
+
+def get_statement_name(statement):
+    name = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return name if name in SQL_STATEMENTS else 'OTHER'
+
+
+def listen_engine(engine):
+    """Measure sql query of engine."""
+    if getattr(engine, '_gbooru_metrics', False):
+        return
+    engine._gbooru_metrics = True
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('gbooru_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['gbooru_query_start'].pop()
+        SQL_DURATION.observe(elapsed, statement=get_statement_name(statement))
+        request_sql = g.get('gbooru_sql') if has_app_context() else None
+        if request_sql is not None:
+            request_sql[0] += 1
+            request_sql[1] += elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('gbooru_query_start') \
+            if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def metrics_view():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app, engine):
+    """Measure request and sql query of app and add `/metrics` endpoint.
+
+    Request slower than SLOW_REQUEST_SECONDS app config is logged with its sql query time.
+    """
+    listen_engine(engine)
+
+    @app.before_request
+    def start_request_timer():
+        g.gbooru_request_start = time.perf_counter()
+        g.gbooru_sql = [0, 0]
+
+    @app.after_request
+    def observe_request(resp):
+        # app context may be kept between requests, e.g. the one pushed by `create_app`
+        start = g.pop('gbooru_request_start', None)
+        sql_count, sql_time = g.pop('gbooru_sql', (0, 0))
+        if start is None:
+            return resp
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or ''
+        REQUEST_DURATION.observe(
+            elapsed, method=request.method, endpoint=endpoint, status=resp.status_code)
+        REQUEST_SQL_QUERIES.observe(sql_count, endpoint=endpoint)
+        slow = app.config.get('SLOW_REQUEST_SECONDS')
+        if slow is not None and elapsed >= slow:
+            log.warning(
+                'Slow request: %s %s %s %.3fs, sql: %s queries %.3fs',
+                request.method, request.full_path, resp.status_code, elapsed,
+                sql_count, sql_time)
+        return resp
+
+    @app.teardown_request
+    def clear_request_timer(exc=None):
+        g.pop('gbooru_request_start', None)
+        g.pop('gbooru_sql', None)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,26 +1,73 @@
 #!/usr/bin/env python3
 """Model module."""
-from datetime import datetime
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 import json
 import logging
+import mimetypes
 import os
+import threading
+import time
+import weakref
 
-from flask import flash
+from appdirs import user_data_dir
+from flask import current_app, flash, has_app_context
 from flask_admin.babel import gettext
 from flask_sqlalchemy import SQLAlchemy
-from requests_html import HTMLSession
+from furl import furl
+from sqlalchemy import and_, event, func, inspect, literal, orm, or_, select, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import attributes as orm_attributes, relationship
+from sqlalchemy.sql.expression import bindparam, type_coerce
 from sqlalchemy.types import TIMESTAMP
 from sqlalchemy_utils.types import ChoiceType, JSONType, ScalarListType, URLType
-import requests
+from yapsy.IPlugin import IPlugin
+from yapsy.PluginManager import PluginManager
 
-from . import plugin
+from . import (
+    browser, exceptions, fetch, imghash, metrics, plugin, singleflight, store, writer)
 
 
 log = logging.getLogger(__name__)
 db = SQLAlchemy()
+# sqlite limit the number of host parameters on single query
+BULK_CHUNK_SIZE = 500
+# maximum search queries on a chunk of `SearchQuery.create_many`, the queries are locked
+# until the chunk is committed, so other search on the same lock stripe don't wait long
+SEARCH_QUERY_CHUNK_SIZE = 10
+# latest response records checked for throttled page, see `Response.get_latest`
+LATEST_RESPONSE_LIMIT = 5
+DEFAULT_RESPONSE_FOLDER = os.path.join(
+    user_data_dir('gbooru_images_download', 'rachmadaniharyono'), 'response')
+DEFAULT_THUMB_FOLDER = os.path.join(
+    user_data_dir('gbooru_images_download', 'rachmadaniharyono'), 'thumb')
+# namespace of url tag which hold url info, namespace alias is also checked
+URL_INFO_NAMESPACES = {
+    'width': ('width', 'gi ow'),
+    'height': ('height', 'gi oh'),
+    'mimetype': ('mimetype', 'gi ity'),
+}
+# namespace of url tag which hold info of its thumbnail url
+THUMBNAIL_INFO_NAMESPACES = {
+    'width': ('gi tw', ),
+    'height': ('gi th', ),
+}
+# pragma of every sqlite connection, see `set_sqlite_pragmas`
+SQLITE_PRAGMAS = OrderedDict([
+    # reader don't block writer and writer don't block reader
+    ('journal_mode', 'WAL'),
+    # on wal mode, only checkpoint is synced to disk
+    ('synchronous', 'NORMAL'),
+    # negative value is in KiB
+    ('cache_size', -64000),
+    ('temp_store', 'MEMORY'),
+    # wait for other writer instead of raising 'database is locked'
+    ('busy_timeout', 30000),
+])
+# image file column which is filled from `api.get_image_info`
+IMAGE_FILE_INFO_KEYS = ('width', 'height', 'img_format', 'size', 'dhash')
 
 match_result_tags = db.Table(
     'match_result_tags',
@@ -54,18 +101,113 @@ class SingleStringModel(Base):
 # {{{ db model
 
 
+class Download(Base):
+    """Download state of url, see `download` module.
+
+    Partial data of unfinished download is kept on the download folder,
+    so it is resumed on the next run.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    url_id = db.Column(db.Integer, db.ForeignKey('url.id'), unique=True, nullable=False)
+    url = db.relationship(
+        'Url', foreign_keys='Download.url_id', lazy=True,
+        backref=db.backref('download', lazy=True, uselist=False, cascade='delete'))
+    status = db.Column(db.String, default=STATUS_PENDING, nullable=False, index=True)
+    path = db.Column(db.String)
+    error = db.Column(db.String)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(TIMESTAMP, default=datetime.now, onupdate=datetime.now)
+    image_file_id = db.Column(db.Integer, db.ForeignKey('image_file.id'), index=True)
+    image_file = db.relationship(
+        'ImageFile', foreign_keys='Download.image_file_id', lazy=True,
+        backref=db.backref('downloads', lazy=True))
+
+    def __repr__(self):
+        return '<Download:{0.id} url:{0.url_id} {0.status}>'.format(self)
+
+
+class ImageFile(Base):
+    """Image file, identified by its sha256 checksum."""
+    checksum = db.Column(db.String, unique=True, nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    img_format = db.Column(db.String)
+    size = db.Column(db.BigInteger)
+    # signed difference hash, see `imghash.dhash`
+    dhash = db.Column(db.BigInteger, index=True)
+    thumbnail_id = db.Column(db.Integer, db.ForeignKey('image_file.id'))
+    # thumbnail of a thumbnail is itself
+    thumbnail = db.relationship(
+        'ImageFile', foreign_keys='ImageFile.thumbnail_id', remote_side='ImageFile.id',
+        lazy=True, post_update=True)
+
+    def __repr__(self):
+        templ = '<ImageFile:{0.id} {0.checksum} {0.width}x{0.height} {0.img_format}>'
+        return templ.format(self)
+
+
+class ImageFilePath(Base):
+    """Local path of image file, used to skip unchanged file when the folder is indexed."""
+    path = db.Column(db.String, unique=True, nullable=False)
+    size = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+    # error of file which can't be read as image, so it is skipped until it is changed
+    error = db.Column(db.String)
+    image_file_id = db.Column(db.Integer, db.ForeignKey('image_file.id'), index=True)
+    image_file = db.relationship(
+        'ImageFile', foreign_keys='ImageFilePath.image_file_id', lazy=True,
+        backref=db.backref('paths', lazy=True, cascade='delete'))
+
+    def __repr__(self):
+        return '<ImageFilePath:{0.id} {0.path}>'.format(self)
+
+
+class Job(Base):
+    """Background job, see `jobs` module.
+
+    Job is kept on the database, so it is shared with worker process and
+    queued job is not lost when the worker is restarted.
+    updated_at is the heartbeat, it is updated when the job is queued, claimed,
+    finished and periodically while it is running.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    kind = db.Column(db.String, nullable=False)
+    key = db.Column(db.String, index=True)
+    args = db.Column(JSONType)
+    status = db.Column(db.String, default=STATUS_QUEUED, nullable=False, index=True)
+    result = db.Column(JSONType)
+    error = db.Column(db.String)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    worker = db.Column(db.String)
+    started_at = db.Column(TIMESTAMP)
+    finished_at = db.Column(TIMESTAMP)
+    updated_at = db.Column(TIMESTAMP, default=datetime.now)
+
+    def __repr__(self):
+        return '<Job:{0.id} {0.kind} {0.status}>'.format(self)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+
 class MatchResult(Base):
     """Match result."""
     url_id = db.Column(db.Integer, db.ForeignKey('url.id'))
     url = db.relationship(
-        'Url', foreign_keys='MatchResult.url_id', lazy='subquery',
+        'Url', foreign_keys='MatchResult.url_id', lazy=True,
         backref=db.backref('match_results', lazy=True, cascade='delete'))
     thumbnail_url_id = db.Column(db.Integer, db.ForeignKey('url.id'))
     thumbnail_url = relationship(
-        'Url', foreign_keys='MatchResult.thumbnail_url_id', lazy='subquery',
+        'Url', foreign_keys='MatchResult.thumbnail_url_id', lazy=True,
         backref=db.backref('thumbnail_match_results', lazy=True, cascade='delete'))
     tags = db.relationship(
-        'Tag', secondary=match_result_tags, lazy='subquery',
+        'Tag', secondary=match_result_tags, lazy=True,
         backref=db.backref('match_results', lazy=True))
 
     def __repr__(self):
@@ -80,6 +222,8 @@ class Namespace(Base):
     value = db.Column(db.String, unique=True, nullable=False)
     alias = db.Column(db.String)
     hidden = db.Column(db.Boolean, default=False)
+    # maintained counter, see `update_tag_counters` and `recount_tags`
+    tag_count = db.Column(db.Integer, default=0, nullable=False, index=True)
 
     def __repr__(self):
         return '<Namespace:{0.id} {0.value}>'.format(self)
@@ -88,17 +232,15 @@ class Namespace(Base):
     def displayed_value(self):
         return self.alias if self.alias else self.value
 
-    @hybrid_property
-    def tag_count(self):
-        try:
-            return len(self.tags) if self.tags else 0
-        except TypeError:
-            return 0
-
 
 class Netloc(Base):
     value = db.Column(db.String, unique=True, nullable=False)
     hidden = db.Column(db.Boolean, default=False)
+    # maintained counter, see `set_new_url_netloc`, `link_url_netlocs` and `rebuild_netlocs`
+    url_count = db.Column(db.Integer, default=0, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<Netloc:{0.id} {0.value}>'.format(self)
 
 
 class Plugin(Base):
@@ -127,7 +269,7 @@ class Response(Base):
     method = db.Column(ChoiceType(METHODS), nullable=False)
     url_id = db.Column(db.Integer, db.ForeignKey('url.id'), nullable=False)
     url = db.relationship(
-        'Url', foreign_keys='Response.url_id', lazy='subquery',
+        'Url', foreign_keys='Response.url_id', lazy=True,
         backref=db.backref('responses', lazy=True))
     kwargs_json = db.Column(JSONType)
     # request result
@@ -135,10 +277,14 @@ class Response(Base):
     reason = db.Column(db.String)
     final_url_id = db.Column(db.Integer, db.ForeignKey('url.id'))
     final_url = db.relationship(
-        'Url', foreign_keys='Response.final_url_id', lazy='subquery',
+        'Url', foreign_keys='Response.final_url_id', lazy=True,
         backref=db.backref('on_final_responses', lazy=True))
-    text = db.Column(db.String)
-    json = db.Column(JSONType)
+    # body is kept on response store, old record may still have it on text column
+    text_inline = db.Column('text', db.String)
+    text_digest = db.Column(db.String, index=True)
+    text_size = db.Column(db.Integer)
+    encoding = db.Column(db.String)
+    json_inline = db.Column('json', JSONType)
     links = db.Column(JSONType)
     headers = db.Column(JSONType)
     # requests_html
@@ -148,54 +294,149 @@ class Response(Base):
     #  next_url_id = db.relationship()
     #  next_url = db.relationship
 
+    @staticmethod
+    def get_request_kwargs(url, kwargs_json=None):
+        """Check url and get keyword arguments for the request from kwargs_json."""
+        url_scheme = urlparse(url).scheme
+        err_msg = 'Unknown scheme: {}'.format(url_scheme)
+        assert url_scheme in ('http', 'https'), err_msg
+        kwargs = {}
+        if kwargs_json and kwargs_json.strip():
+            kwargs = json.loads(kwargs_json)
+        return kwargs
+
+    @staticmethod
+    def get_row(resp, url, method, kwargs=None):
+        """Get plain row data of requests response, see `insert_response_rows`.
+
+        Body is put on the response store, the row only keep its digest.
+        """
+        text_digest, text_size = get_response_store().put(resp.content)
+        return {
+            'url': url, 'final_url': resp.url, 'method': method,
+            'kwargs_json': kwargs if kwargs else {}, 'headers': resp.headers._store,
+            'status_code': resp.status_code, 'reason': resp.reason,
+            'text_digest': text_digest, 'text_size': text_size,
+            'encoding': resp.encoding or resp.apparent_encoding, 'links': resp.links,
+        }
+
+    def get_not_modified_row(self, resp, kwargs=None):
+        """Get plain row data of 304 response with the body of this record."""
+        headers = dict(self.headers) if hasattr(self.headers, 'items') else {}
+        headers.update(resp.headers._store)
+        return {
+            'url': str(self.url.value),
+            'final_url': str(self.final_url.value) if self.final_url else None,
+            'method': self.method, 'kwargs_json': kwargs if kwargs else {}, 'headers': headers,
+            'status_code': resp.status_code, 'reason': resp.reason,
+            'text_digest': self.text_digest, 'text_size': self.text_size,
+            'encoding': self.encoding, 'links': self.links,
+        }
+
+    @classmethod
+    def get_latest(cls, url, method, session):
+        """Get latest response record of url which have the body on the store.
+
+        Throttled page with 200 status, e.g. unusual traffic page saved before
+        it is checked, is skipped.
+        """
+        query = session.query(cls).join(Url, cls.url_id == Url.id).filter(
+            Url.value == url, cls.method == method, cls.text_digest.isnot(None),
+            cls.status_code.in_((200, 304))
+        ).order_by(cls.created_at.desc(), cls.id.desc())
+        for model in query.limit(LATEST_RESPONSE_LIMIT):
+            if not fetch.is_throttled(model.to_response('requests')):
+                return model
+        return None
+
+    @staticmethod
+    def get_cache_ttl(url, cache_ttl=None):
+        """Get cache ttl in seconds for url.
+
+        Explicit cache_ttl is used first, e.g. from the plugin,
+        then host and 'default' key of RESPONSE_CACHE_TTL app config.
+        """
+        if cache_ttl is not None:
+            return cache_ttl
+        config = current_app.config.get('RESPONSE_CACHE_TTL', {}) if has_app_context() else {}
+        return config.get(urlparse(url).netloc, config.get('default', 0))
+
+    @classmethod
+    def prepare_request(cls, url, method, session, kwargs, use_cache=True, cache_ttl=None):
+        """Find fresh cached record or add conditional headers to request kwargs.
+
+        Returns:
+            tuple: fresh record which can be used without request or None,
+            latest record to revalidate or None,
+            and keyword arguments for the request.
+        """
+        if not use_cache or method.lower() != 'get':
+            return None, None, kwargs
+        latest = cls.get_latest(url, method, session)
+        if latest is None:
+            return None, None, kwargs
+        ttl = cls.get_cache_ttl(url, cache_ttl)
+        if ttl and latest.created_at >= datetime.now() - timedelta(seconds=ttl):
+            return latest, latest, kwargs
+        conditional_headers = latest.get_conditional_headers()
+        if conditional_headers:
+            kwargs = dict(kwargs)
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **conditional_headers)
+        return None, latest, kwargs
+
+    @classmethod
+    def _get_fetch_result_row(cls, resp, url, method, kwargs, latest, requests_lib, render):
+        """Get plain row data of fetched response.
+
+        Returns:
+            tuple: row and the response, None for 304 response,
+            it is built from the record with the body of latest record.
+        """
+        if resp.status_code == 304 and latest is not None:
+            return latest.get_not_modified_row(resp, kwargs=kwargs), None
+        if fetch.is_throttled(resp):
+            raise exceptions.HostThrottled(
+                'Throttled response is not saved: {}'.format(url), response=resp)
+        if requests_lib == 'requests_html' and render:
+            browser.render(resp.html)
+        return cls.get_row(resp, url, method, kwargs=kwargs), resp
+
     @classmethod
     def create(
             cls, url, method, session, kwargs_json=None, requests_lib='requests_html',
-            render=False, return_response=False,
-            on_model_change_func=None, handle_view_exception=None, after_model_change_func=None):
+            render=False, return_response=False, use_cache=True, cache_ttl=None,
+            on_model_change_func=None, handle_view_exception=None, after_model_change_func=None,
+            max_retries=fetch.MAX_RETRIES):
+        """Create response record.
+
+        When use_cache is True, fresh record is used without request
+        and stale record is revalidated with conditional request.
+        Throttled request is retried max_retries times, see `fetch.fetch`.
+        Record is written with write-behind writer, see `writer.write`.
+        """
         assert_msg = 'Unknown requests lib: {}'.format(requests_lib)
-        assert requests_lib in ('requests', 'requests_html'), assert_msg
+        assert requests_lib in fetch.REQUESTS_LIBS, assert_msg
         try:
-            url_scheme = urlparse(url).scheme
-            err_msg = 'Unknown scheme: {}'.format(url_scheme)
-            assert urlparse(url).scheme in ('http', 'https'), err_msg
-            url_model = get_or_create(session, Url, value=url)[0]
-            model = cls(url=url_model, method=method)
-            kwargs = {}
-            if kwargs_json and kwargs_json.strip():
-                kwargs = json.loads(kwargs_json)
-            model.kwargs_json = kwargs
-            if requests_lib == 'requests_html':
-                requests_session = HTMLSession()
-                resp = getattr(requests_session, method.lower())(url, **kwargs)
-            else:
-                resp = requests.request(method, url, **kwargs)
-            if requests_lib == 'requests_html' and render:
-                resp.html.render()
-            # resp to model
-            model.headers = resp.headers._store
-            model.status_code = resp.status_code
-            if resp.url == url:
-                final_url_model = url_model
+            kwargs = cls.get_request_kwargs(url, kwargs_json)
+            cached, latest, request_kwargs = cls.prepare_request(
+                url, method, session, kwargs, use_cache=use_cache, cache_ttl=cache_ttl)
+            if cached is not None:
+                model, resp = cached, cached.to_response(requests_lib)
             else:
-                with session.no_autoflush:
-                    final_url_model = get_or_create(session, Url, value=resp.url)[0]
-            model.final_url = final_url_model
-            model.text = resp.text
-            try:
-                model.json = resp.json()
-            except json.decoder.JSONDecodeError:
-                pass
-            model.links = resp.links
-            model.reason = resp.reason
-            # populate_obj finished
-            session.add(model)
+                resp = fetch.fetch(
+                    url, method, requests_lib=requests_lib, max_retries=max_retries,
+                    **request_kwargs)
+                row, resp = cls._get_fetch_result_row(
+                    resp, url, method, kwargs, latest, requests_lib, render)
+                model = session.query(cls).get(
+                    writer.write(session, insert_response_rows, [row])[0])
+                if resp is None:
+                    resp = model.to_response(requests_lib)
             if on_model_change_func:
                 on_model_change_func(model)
             session.commit()
         except Exception as ex:
-            log.exception('Failed to create record.')
-            log.exception('Failed.', url=url, ex=ex)
+            log.exception('Failed to create record, url: {}'.format(url))
             if handle_view_exception:
                 if not handle_view_exception(ex):
                     flash(gettext('Failed to create record. %(error)s', error=str(ex)), 'error')
@@ -211,6 +452,125 @@ class Response(Base):
             return model
         return model, resp
 
+    @classmethod
+    def create_many(
+            cls, urls, method, session, kwargs_json=None, requests_lib='requests_html',
+            render=False, use_cache=True, cache_ttl=None, **fetch_kwargs):
+        """Fetch urls concurrently and create response record for each of them.
+
+        Records are written together with write-behind writer, see `writer.write`.
+
+        Args:
+            urls: list of url
+            method: http method
+            session: database session
+            kwargs_json: json text of keyword arguments for every request
+            requests_lib: 'requests' or 'requests_html'
+            render: render the page, only for requests_html
+            use_cache: use fresh record and revalidate stale one, see `create`
+            cache_ttl: cache ttl in seconds, see `get_cache_ttl`
+            **fetch_kwargs: keyword arguments for `fetch.fetch_many`
+        Returns:
+            list: (model, response) for each url, (False, None) if failed.
+        """
+        assert_msg = 'Unknown requests lib: {}'.format(requests_lib)
+        assert requests_lib in fetch.REQUESTS_LIBS, assert_msg
+        res = [(False, None)] * len(urls)
+        requests_kwargs = []
+        for idx, url in enumerate(urls):
+            try:
+                kwargs = cls.get_request_kwargs(url, kwargs_json)
+            except (AssertionError, ValueError):
+                log.exception('Failed to create record, url: {}'.format(url))
+                continue
+            cached, latest, request_kwargs = cls.prepare_request(
+                url, method, session, kwargs, use_cache=use_cache, cache_ttl=cache_ttl)
+            if cached is not None:
+                res[idx] = (cached, cached.to_response(requests_lib))
+                continue
+            requests_kwargs.append((idx, kwargs, latest, dict(
+                url=url, method=method, requests_lib=requests_lib, **request_kwargs)))
+        responses = fetch.fetch_many([x[3] for x in requests_kwargs], **fetch_kwargs)
+        rows = []
+        for (idx, kwargs, latest, _), resp in zip(requests_kwargs, responses):
+            url = urls[idx]
+            if isinstance(resp, Exception):
+                log.error('Failed to fetch url: {}, error: {}'.format(url, resp))
+                continue
+            try:
+                rows.append((idx, ) + cls._get_fetch_result_row(
+                    resp, url, method, kwargs, latest, requests_lib, render))
+            except Exception:
+                log.exception('Failed to create record, url: {}'.format(url))
+        try:
+            ids = writer.write(session, insert_response_rows, [x[1] for x in rows])
+        except Exception:
+            log.exception('Failed to create records, urls: {}'.format([urls[x[0]] for x in rows]))
+            session.rollback()
+            return res
+        records = {x.id: x for x in session.query(cls).filter(cls.id.in_(ids))} if ids else {}
+        for (idx, _, resp), id_ in zip(rows, ids):
+            model = records[id_]
+            res[idx] = (model, model.to_response(requests_lib) if resp is None else resp)
+        session.commit()
+        return res
+
+    def get_conditional_headers(self):
+        """Get conditional request headers from ETag and Last-Modified header."""
+        res = {}
+        if not hasattr(self.headers, 'get'):
+            return res
+        etag = self.headers.get('etag', [None, None])[1]
+        if etag:
+            res['If-None-Match'] = etag
+        last_modified = self.headers.get('last-modified', [None, None])[1]
+        if last_modified:
+            res['If-Modified-Since'] = last_modified
+        return res
+
+    def to_response(self, requests_lib='requests_html'):
+        """Build requests response from the record, so it can be used like fetched one."""
+        headers = dict(self.headers.values()) if hasattr(self.headers, 'values') else {}
+        final_url = self.final_url if self.final_url else self.url
+        return fetch.build_response(
+            content=b''.join(self.iter_content()),
+            status_code=200 if self.status_code == 304 else self.status_code,
+            headers=headers, url=str(final_url.value), encoding=self.encoding,
+            reason=self.reason, requests_lib=requests_lib)
+
+    def set_content(self, content, encoding=None):
+        """Put response body to response store."""
+        self.text_digest, self.text_size = get_response_store().put(content)
+        self.encoding = encoding
+        self.text_inline = None
+
+    def iter_content(self):
+        """Iterate chunk of response body."""
+        if self.text_digest is None:
+            if self.text_inline:
+                yield self.text_inline.encode(self.encoding or 'utf-8')
+            return
+        yield from get_response_store().iter_chunks(self.text_digest)
+
+    @property
+    def text(self):
+        if self.text_digest is None:
+            return self.text_inline
+        content = get_response_store().get(self.text_digest)
+        return content.decode(self.encoding or 'utf-8', errors='replace')
+
+    @property
+    def json(self):
+        if self.json_inline is not None:
+            return self.json_inline
+        text = self.text
+        if not text:
+            return
+        try:
+            return json.loads(text)
+        except json.decoder.JSONDecodeError:
+            pass
+
     @hybrid_property
     def content_type(self):
         if not hasattr(self.headers, 'get'):
@@ -225,40 +585,97 @@ class Response(Base):
 
 class SearchQuery(Base):
     """Search query."""
-    search_term = db.Column(db.String, nullable=False)
+    search_term = db.Column(db.String, nullable=False, index=True)
     page = db.Column(db.Integer, nullable=False, default=1)
     match_results = db.relationship(
-        'MatchResult', secondary=search_query_match_results, lazy='subquery',
+        'MatchResult', secondary=search_query_match_results, lazy=True,
         backref=db.backref('search_queries', lazy=True))
     mode_id = db.Column(db.Integer, db.ForeignKey('plugin.id'))
     mode = db.relationship(
-        'Plugin', foreign_keys='SearchQuery.mode_id', lazy='subquery',
+        'Plugin', foreign_keys='SearchQuery.mode_id', lazy=True,
         backref=db.backref('search_queries', lazy=True, cascade='delete'))
+    # None unless loaded, see `search_query_match_result_count`
+    match_result_count = orm.query_expression()
 
     def __repr__(self):
         templ = \
             '<SearchQuery:{0.id} q:[{0.search_term}] p:{0.page} mode:{1}>'
         return templ.format(self, self.mode.name if self.mode else '')
 
+    @classmethod
+    def get_finished(cls, session, search_term, page, mode):
+        """Get search query record which already have match results.
+
+        Pending record on the session is not flushed.
+        """
+        with session.no_autoflush:
+            return session.query(cls) \
+                .filter_by(search_term=search_term, page=page, mode=mode) \
+                .filter(cls.match_results.any()).order_by(cls.id).first()
+
+    @classmethod
+    def run(
+            cls, session, search_term, page, mode, use_cache=True, before_commit=None,
+            max_retries=fetch.MAX_RETRIES):
+        """Get or create search query record with its match results and commit it.
+
+        Concurrent call with the same search term, page and mode run one at a time,
+        and later call use the finished record instead of fetching the page again,
+        unless the cache is disabled.
+        Waiting call raise TimeoutError after `singleflight.LOCK_TIMEOUT` seconds.
+
+        Args:
+            session: database session
+            search_term: search term
+            page: page
+            mode: mode plugin record
+            use_cache: use finished record and cached response
+            before_commit: function called with the record before it is committed
+            max_retries: maximum retry of throttled request, see `fetch.fetch`
+        Returns:
+            search query record
+        """
+        key = singleflight.get_search_query_key(search_term, page, mode)
+        with singleflight.lock(key, timeout=singleflight.LOCK_TIMEOUT):
+            model = cls.get_finished(session, search_term, page, mode) if use_cache else None
+            if model is not None:
+                # drop pending duplicate, e.g. from `HomeView.index`
+                for obj in [x for x in session.new if isinstance(x, SearchQuery)]:
+                    if (obj.search_term, obj.page, obj.mode) == (search_term, page, mode):
+                        session.expunge(obj)
+            else:
+                model = get_or_create(
+                    session, SearchQuery, search_term=search_term, page=page, mode=mode)[0]
+                pm = get_plugin_manager()
+                plugin = pm.getPluginByName(model.mode.name, model.mode.category)
+                mrs = list(set(plugin.plugin_object.get_match_results(
+                    search_term=model.search_term, page=model.page, session=session,
+                    use_cache=use_cache, max_retries=max_retries)))
+                model.match_results.extend(mrs)
+                session.add(model)
+            if before_commit:
+                before_commit(model)
+            session.commit()
+        return model
+
     @classmethod
     def create(
             cls, form, session,
-            on_model_change_func=None, handle_view_exception=None, after_model_change_func=None
+            on_model_change_func=None, handle_view_exception=None, after_model_change_func=None,
+            max_retries=fetch.MAX_RETRIES
     ):
+        """Create search query record from form, see `run`."""
         try:
-            model = get_or_create(
-                session, SearchQuery,
-                search_term=form.search_term.data, page=form.page.data, mode=form.mode.data
-            )[0]
-            pm = get_plugin_manager()
-            plugin = pm.getPluginByName(model.mode.name, model.mode.category)
-            mrs = list(set(plugin.plugin_object.get_match_results(
-                search_term=model.search_term, page=model.page, session=session)))
-            model.match_results.extend(mrs)
-            session.add(model)
-            if on_model_change_func:
-                on_model_change_func(form, model, True)
-            session.commit()
+            disable_cache = getattr(form, 'disable_cache', None)
+
+            def before_commit(model):
+                if on_model_change_func:
+                    on_model_change_func(form, model, True)
+
+            model = cls.run(
+                session, form.search_term.data, form.page.data, form.mode.data,
+                use_cache=not (disable_cache and disable_cache.data), before_commit=before_commit,
+                max_retries=max_retries)
         except Exception as ex:
             if handle_view_exception and handle_view_exception(ex):
                 flash(gettext('Failed to create record. %(error)s', error=str(ex)), 'error')
@@ -270,15 +687,89 @@ class SearchQuery(Base):
                 after_model_change_func(form, model, True)
         return model
 
+    @classmethod
+    def create_many(
+            cls, queries, session, chunk_size=SEARCH_QUERY_CHUNK_SIZE, use_cache=True,
+            **fetch_kwargs):
+        """Create search queries and get their match results, chunk by chunk.
+
+        Pages of every chunk are fetched concurrently
+        and match result items of each chunk are written with write-behind writer,
+        see `writer.write`. Failed query don't create any record.
+        Other caller with the same query wait until the chunk is committed,
+        so it can use the cached response.
+
+        Args:
+            queries: iterable of (search_term, page, mode) with plugin record as mode
+            session: database session
+            chunk_size: number of queries on each chunk, at most `SEARCH_QUERY_CHUNK_SIZE`
+            use_cache: use cached response, see `Response.create`
+            **fetch_kwargs: keyword arguments for `fetch.fetch_many`
+        Yields:
+            search query record or False if failed, for each query on the same order.
+        """
+        pm = get_plugin_manager()
+        for chunk in _chunks(queries, min(chunk_size, SEARCH_QUERY_CHUNK_SIZE)):
+            keys = [singleflight.get_search_query_key(*x) for x in chunk]
+            try:
+                with singleflight.lock_many(keys, timeout=singleflight.LOCK_TIMEOUT):
+                    res = [False] * len(chunk)
+                    mode_queries = OrderedDict()
+                    for idx, (_, _, mode) in enumerate(chunk):
+                        mode_queries.setdefault(mode, []).append(idx)
+                    for mode, idxs in mode_queries.items():
+                        if mode.id is None:
+                            session.flush()
+                        plugin = pm.getPluginByName(mode.name, mode.category).plugin_object
+                        items_list = plugin.get_match_items_many(
+                            [chunk[x][:2] for x in idxs], session, use_cache=use_cache,
+                            **fetch_kwargs)
+                        rows = [
+                            (idx, {
+                                'search_term': chunk[idx][0], 'page': chunk[idx][1],
+                                'mode_id': mode.id, 'items': items})
+                            for idx, items in zip(idxs, items_list) if items is not None]
+                        with plugin.timer('ingest'):
+                            ids = writer.write(
+                                session, insert_search_query_rows, [x[1] for x in rows])
+                        for (idx, _), id_ in zip(rows, ids):
+                            res[idx] = id_
+                    ids = [x for x in res if x]
+                    records = {}
+                    if ids:
+                        # loaded record don't know the match results from the writer
+                        records = {x.id: x for x in session.query(SearchQuery).populate_existing()
+                                   .filter(SearchQuery.id.in_(ids))}
+                        for model in records.values():
+                            session.expire(model, ['match_results'])
+                    res = [records[x] if x else False for x in res]
+                    session.commit()
+            except Exception:
+                log.exception('Failed to create records.')
+                session.rollback()
+                res = [False] * len(chunk)
+            yield from res
+
+
+# load with `orm.with_expression(SearchQuery.match_result_count, search_query_match_result_count)`
+search_query_match_result_count = select(
+    [func.count(search_query_match_results.c.match_result_id)]
+).where(
+    search_query_match_results.c.search_query_id == SearchQuery.id
+).correlate_except(search_query_match_results).as_scalar()
+
 
 class Tag(SingleStringModel):
     """Tag model."""
+    value = db.Column(db.String, index=True)
     namespace_id = db.Column(db.Integer, db.ForeignKey('namespace.id'))
     namespace = db.relationship(
-        'Namespace', foreign_keys='Tag.namespace_id', lazy='subquery',
+        'Namespace', foreign_keys='Tag.namespace_id', lazy=True,
         backref=db.backref('tags', lazy=True, cascade='delete'))
     alias = db.Column(db.String)
     hidden = db.Column(db.Boolean, default=False)
+    # maintained counter, see `update_tag_counters` and `recount_tags`
+    url_count = db.Column(db.Integer, default=0, nullable=False, index=True)
 
     def __repr__(self):
         templ = '<Tag:{0.id} {0.as_string}>'
@@ -305,8 +796,18 @@ class Tag(SingleStringModel):
 
 class Url(Base):
     value = db.Column(URLType, unique=True, nullable=False)
+    # filled from url tags, see `get_url_info`
+    width = db.Column(db.Integer, index=True)
+    height = db.Column(db.Integer, index=True)
+    mimetype = db.Column(db.String, index=True)
+    # signed difference hash of the url image or its thumbnail
+    dhash = db.Column(db.BigInteger, index=True)
+    netloc_id = db.Column(db.Integer, db.ForeignKey('netloc.id'), index=True)
+    netloc = db.relationship(
+        'Netloc', foreign_keys='Url.netloc_id', lazy=True,
+        backref=db.backref('urls', lazy='dynamic'))
     tags = db.relationship(
-        'Tag', secondary=url_tags, lazy='subquery',
+        'Tag', secondary=url_tags, lazy=True,
         backref=db.backref('urls', lazy=True))
     #  hidden = db.Column(db.Boolean, default=False)
 
@@ -322,30 +823,6 @@ class Url(Base):
     def filename(self):
         return os.path.splitext(self.value.path.segments[-1])[0]
 
-    @hybrid_property
-    def height(self):
-        size_name = 'height'
-        tags = self.tags
-        if not isinstance(tags, orm_attributes.InstrumentedAttribute):
-            tags = list(filter(
-                lambda x: x.namespace.alias == size_name or x.namespace.value == size_name,
-                tags
-            ))
-            if tags:
-                return tags[0].value
-
-    @hybrid_property
-    def width(self):
-        size_name = 'width'
-        tags = self.tags
-        if not isinstance(tags, orm_attributes.InstrumentedAttribute):
-            tags = list(filter(
-                lambda x: x.namespace.alias == size_name or x.namespace.value == size_name,
-                tags
-            ))
-            if tags:
-                return tags[0].value
-
     @hybrid_property
     def content_type(self):
         res = []
@@ -360,13 +837,280 @@ class Url(Base):
         return templ.format(self)
 
 
+# natural key of bulk inserted model, so concurrent worker can't insert duplicate.
+# null is distinct on unique index, so it is compared as 0
+db.Index(
+    'uq_tag_namespace_id_value', func.coalesce(Tag.namespace_id, 0), Tag.value, unique=True)
+db.Index(
+    'uq_match_result_url_id_thumbnail_url_id',
+    MatchResult.url_id, func.coalesce(MatchResult.thumbnail_url_id, 0), unique=True)
+
+
 # }}}
 # {{{ db model func
 
 
+def set_sqlite_pragmas(engine, pragmas=None):
+    """Set pragmas on every new connection of sqlite engine.
+
+    Args:
+        engine: sqlalchemy engine, non sqlite engine is skipped
+        pragmas: dict of pragma name and value, default to SQLITE_PRAGMAS
+    Returns:
+        bool: True if the engine is sqlite
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for key, value in pragmas.items():
+                cursor.execute('PRAGMA {}={}'.format(key, value))
+        finally:
+            cursor.close()
+
+    return True
+
+
+def get_response_store():
+    """Get store for response body from RESPONSE_FOLDER and RESPONSE_COMPRESSION app config."""
+    folder, compression = DEFAULT_RESPONSE_FOLDER, None
+    if has_app_context():
+        folder = current_app.config.get('RESPONSE_FOLDER', folder)
+        compression = current_app.config.get('RESPONSE_COMPRESSION', compression)
+    return store.BlobStore(folder, compression=compression)
+
+
+class IdentityCache:
+    """Bounded cache of model primary key by its natural key.
+
+    The cache is kept per engine, so different databases don't share the key.
+    Only primary key is stored,
+    instance is taken from session identity map or loaded by primary key.
+
+    Instance is kept on the session until the transaction end,
+    so on the same transaction it is returned without query.
+    Expired instance (e.g. after commit) is still loaded by primary key.
+    The natural key of the instance is checked on every hit,
+    so reused primary key of deleted record don't return other record.
+
+    Bulk insert only need the primary key, so `get_ids` return it without query.
+    Key which is added on rolled back transaction is removed, see `discard_session_keys`.
+    """
+
+    def __init__(self, models, maxsize=10000):
+        self.models = models
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get_key(self, model, kwargs):
+        """Get cache key or None if the model or kwargs can't be cached."""
+        if model not in self.models:
+            return
+        items = []
+        for key, value in sorted(kwargs.items()):
+            if isinstance(value, Base):
+                if value.id is None:
+                    return
+                value = (value.__class__, value.id)
+            try:
+                hash(value)
+            except TypeError:
+                return
+            items.append((key, value))
+        return model, tuple(items)
+
+    def get(self, session, model, kwargs):
+        """Get instance from cache or None if not found."""
+        key = self.get_key(model, kwargs)
+        if key is None:
+            return
+        engine = session.get_bind()
+        with self._lock:
+            data = self._data.get(engine, {})
+            pk = data.get(key)
+            if pk is None:
+                self.misses += 1
+                return
+            data.move_to_end(key)
+        instance = session.query(model).get(pk)
+        if instance is not None and not self.match(instance, kwargs):
+            instance = None
+        with self._lock:
+            if instance is None:
+                # the record is deleted
+                data.pop(key, None)
+                self.misses += 1
+            else:
+                self.hits += 1
+        if instance is not None:
+            self.keep(session, instance)
+        return instance
+
+    def _add(self, session, engine, key, pk):
+        """Add key to cache, the caller hold the lock."""
+        data = self._data.setdefault(engine, OrderedDict())
+        data[key] = pk
+        data.move_to_end(key)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+        session.info.setdefault('identity_cache_keys', []).append((engine, key))
+
+    def get_ids(self, session, model, column_key, values):
+        """Get cached primary key of records with column value, without query.
+
+        Primary key of deleted record is removed when it is deleted on this process.
+
+        Returns:
+            dict: value as key and primary key as value, for cached value only
+        """
+        if model not in self.models:
+            return {}
+        engine = session.get_bind()
+        res = {}
+        with self._lock:
+            data = self._data.get(engine, {})
+            for value in values:
+                pk = data.get((model, ((column_key, value), )))
+                if pk is None:
+                    self.misses += 1
+                else:
+                    res[value] = pk
+                    self.hits += 1
+        return res
+
+    def set_ids(self, session, model, column_key, ids):
+        """Add primary key of records with column value, see `get_ids`."""
+        if model not in self.models:
+            return
+        engine = session.get_bind()
+        with self._lock:
+            for value, pk in ids.items():
+                self._add(session, engine, (model, ((column_key, value), )), pk)
+
+    def discard_session_keys(self, session):
+        """Remove key which is added on the session transaction."""
+        keys = session.info.pop('identity_cache_keys', None)
+        if not keys:
+            return
+        with self._lock:
+            for engine, key in keys:
+                data = self._data.get(engine)
+                if data is not None:
+                    data.pop(key, None)
+
+    def keep(self, session, instance):
+        """Keep strong reference of instance until the transaction end.
+
+        Session identity map only keep weak reference,
+        so unreferenced instance is dropped and loaded again on the next hit.
+        """
+        refs = session.info.setdefault('identity_cache_refs', set())
+        if len(refs) >= self.maxsize:
+            refs.clear()
+        refs.add(instance)
+
+    @staticmethod
+    def match(instance, kwargs):
+        """Check if natural key of instance is still equal to kwargs."""
+        mapper = orm.object_mapper(instance)
+        for key, value in kwargs.items():
+            if key in mapper.relationships:
+                # compare foreign key, so related instance is not loaded
+                columns = list(mapper.relationships[key].local_columns)
+                values = [getattr(value, 'id', None)]
+            else:
+                columns, values = [mapper.c[key]], [value]
+            for column, value in zip(columns, values):
+                instance_value = getattr(instance, mapper.get_property_by_column(column).key)
+                if instance_value != value and str(instance_value) != str(value):
+                    return False
+        return True
+
+    def discard(self, instances):
+        """Remove cache of deleted instances."""
+        ids = set((type(x), x.id) for x in instances if isinstance(x, self.models))
+        if not ids:
+            return
+        with self._lock:
+            for data in self._data.values():
+                for key in [k for k, v in data.items() if (k[0], v) in ids]:
+                    del data[key]
+
+    def discard_model(self, model):
+        """Remove cache of every instance of model."""
+        with self._lock:
+            for data in self._data.values():
+                for key in [x for x in data if x[0] is model]:
+                    del data[key]
+
+    def set(self, session, model, kwargs, instance):
+        key = self.get_key(model, kwargs)
+        if key is None or instance.id is None:
+            return
+        engine = session.get_bind()
+        with self._lock:
+            self._add(session, engine, key, instance.id)
+        self.keep(session, instance)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': sum(len(x) for x in self._data.values()),
+                'maxsize': self.maxsize,
+            }
+
+
+identity_cache = IdentityCache(models=(MatchResult, Namespace, Tag, Url))
+metrics.registry.register(metrics.GaugeFunc(
+    'gbooru_identity_cache', 'Identity cache stats.', ('stat', ),
+    func=lambda: {(k, ): v for k, v in identity_cache.stats().items()}))
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def discard_rolled_back_identity_cache(session):
+    """Record of rolled back transaction may be in cache, so remove its key."""
+    identity_cache.discard_session_keys(session)
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def release_identity_cache_refs(session, transaction):
+    """Instance is expired after the transaction, so it don't need to be kept."""
+    if transaction.parent is None:
+        session.info.pop('identity_cache_refs', None)
+        session.info.pop('identity_cache_keys', None)
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def discard_deleted_identity_cache(session, flush_context):
+    """Deleted record primary key can be reused, so remove it from cache."""
+    identity_cache.discard(session.deleted)
+
+
+@event.listens_for(orm.Session, 'after_bulk_delete')
+def discard_bulk_deleted_identity_cache(delete_context):
+    identity_cache.discard_model(delete_context.mapper.class_)
+
+
 def get_or_create(session, model, **kwargs):
     """Creates an object or returns the object if exists."""
-    instance = session.query(model).filter_by(**kwargs).first()
+    instance = identity_cache.get(session, model, kwargs)
+    if instance is None:
+        instance = session.query(model).filter_by(**kwargs).first()
+        if instance is not None:
+            identity_cache.set(session, model, kwargs, instance)
     created = False
     if not instance:
         instance = model(**kwargs)
@@ -386,19 +1130,1390 @@ def get_or_create_match_result(session, url, thumbnail_url=None, **kwargs):
     # NOTE may create redundant match result with empty thumbnail
     return instance, created
 
+
+def _chunks(iterable, size):
+    """Split iterable into lists with maximum length of size."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _execute_chunks(session, stmt, rows, table, counter):
+    """Execute statement with rows chunk by chunk and count them on ingest metrics.
+
+    Args:
+        counter: metrics counter of affected rows, e.g. `metrics.INGEST_INSERTED_ROWS`
+    Returns:
+        int: number of affected rows
+    """
+    count = 0
+    for chunk in _chunks(rows, BULK_CHUNK_SIZE):
+        res = session.execute(stmt, chunk)
+        metrics.INGEST_ROWS.inc(len(chunk), table=table.name)
+        if res.rowcount is not None and res.rowcount >= 0:
+            counter.inc(res.rowcount, table=table.name)
+            count += res.rowcount
+    return count
+
+
+def insert_ignore(session, table, rows):
+    """Insert rows into table and skip rows which conflict with existing unique key.
+
+    Use `INSERT ... ON CONFLICT DO NOTHING` on postgresql,
+    `INSERT OR IGNORE` on sqlite and `INSERT IGNORE` on mysql.
+
+    Returns:
+        int: number of inserted rows
+    """
+    if not rows:
+        return 0
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect_name == 'sqlite':
+        stmt = table.insert().prefix_with('OR IGNORE')
+    elif dialect_name == 'mysql':
+        stmt = table.insert().prefix_with('IGNORE')
+    else:
+        raise NotImplementedError('Unsupported dialect: {}'.format(dialect_name))
+    return _execute_chunks(session, stmt, rows, table, metrics.INGEST_INSERTED_ROWS)
+
+
+def get_or_insert_ids(session, column, values):
+    """Get id of each value on unique column, insert missing value in bulk.
+
+    Id of model on `identity_cache` is taken from the cache first.
+
+    Returns:
+        dict: value as key and id as value.
+    """
+    table = column.table
+    model = next((x for x in identity_cache.models if x.__table__ is table), None)
+    # compare raw string, so custom type (e.g. URLType) don't change the key
+    value_col = type_coerce(column, db.String)
+    res = identity_cache.get_ids(session, model, column.key, values)
+    cached = set(res)
+
+    def update_res(values):
+        for chunk in _chunks(values, BULK_CHUNK_SIZE):
+            query = session.query(table.c.id, value_col).filter(value_col.in_(chunk))
+            res.update((value, id_) for id_, value in query)
+
+    update_res([x for x in values if x not in res])
+    missing = [x for x in values if x not in res]
+    if missing:
+        insert_ignore(
+            session, table,
+            [{column.key: x, 'created_at': datetime.now()} for x in missing])
+        update_res(missing)
+    identity_cache.set_ids(
+        session, model, column.key, {k: v for k, v in res.items() if k not in cached})
+    return res
+
+
+def get_or_insert_tag_ids(session, keys):
+    """Get id of each (namespace_id, value) tag key, insert missing tag in bulk.
+
+    Returns:
+        dict: tag key as key and tag id as value.
+    """
+    res = {}
+
+    def update_res(keys):
+        values = list(set(x[1] for x in keys))
+        for chunk in _chunks(values, BULK_CHUNK_SIZE):
+            query = session.query(Tag.id, Tag.namespace_id, Tag.value) \
+                .filter(Tag.value.in_(chunk)).order_by(Tag.id)
+            for id_, namespace_id, value in query:
+                res.setdefault((namespace_id, value), id_)
+
+    update_res(keys)
+    missing = [x for x in keys if x not in res]
+    if missing:
+        now = datetime.now()
+        nm_rows = OrderedDict()
+        for namespace_id, value in missing:
+            nm_rows.setdefault(namespace_id, []).append(
+                {'namespace_id': namespace_id, 'value': value, 'created_at': now})
+        # tag inserted by other worker is skipped and not counted
+        nm_counts = Counter()
+        for namespace_id, rows in nm_rows.items():
+            count = insert_ignore(session, Tag.__table__, rows)
+            if namespace_id is not None:
+                nm_counts[namespace_id] += count
+        increase_count(session, Namespace.tag_count, nm_counts)
+        update_res(missing)
+    return res
+
+
+def get_or_insert_match_result_ids(session, keys):
+    """Get id of each (url_id, thumbnail_url_id) match result key, insert missing one in bulk.
+
+    Just like `get_or_create_match_result`,
+    key without thumbnail url will match any match result with same url.
+
+    Returns:
+        dict: match result key as key and match result id as value.
+    """
+    res = {}
+
+    def update_res(keys):
+        url_ids = list(set(x[0] for x in keys))
+        keys = set(keys)
+        for chunk in _chunks(url_ids, BULK_CHUNK_SIZE):
+            query = session.query(
+                MatchResult.id, MatchResult.url_id, MatchResult.thumbnail_url_id
+            ).filter(MatchResult.url_id.in_(chunk)).order_by(MatchResult.id)
+            for id_, url_id, thumbnail_url_id in query:
+                for key in ((url_id, thumbnail_url_id), (url_id, None)):
+                    if key in keys:
+                        res.setdefault(key, id_)
+
+    update_res(keys)
+    missing = [x for x in keys if x not in res]
+    if missing:
+        now = datetime.now()
+        insert_ignore(session, MatchResult.__table__, [
+            {'url_id': x[0], 'thumbnail_url_id': x[1], 'created_at': now} for x in missing])
+        update_res(missing)
+    return res
+
+
+def get_or_create_downloads(session, url_ids):
+    """Get download model of every url id, insert missing one in bulk.
+
+    Returns:
+        dict: url id as key and download model as value
+    """
+    res = {}
+
+    def update_res(values):
+        for chunk in _chunks(values, BULK_CHUNK_SIZE):
+            query = session.query(Download).filter(Download.url_id.in_(chunk)) \
+                .options(orm.joinedload(Download.url))
+            res.update((x.url_id, x) for x in query)
+
+    url_ids = list(set(url_ids))
+    update_res(url_ids)
+    missing = [x for x in url_ids if x not in res]
+    if missing:
+        now = datetime.now()
+        insert_ignore(session, Download.__table__, [{
+            'url_id': x, 'status': Download.STATUS_PENDING, 'attempts': 0,
+            'created_at': now, 'updated_at': now} for x in missing])
+        update_res(missing)
+    return res
+
+
+def enqueue_job(session, kind, key=None, **kwargs):
+    """Add job to the queue, the caller commit the session.
+
+    When key is given and queued or running job with the same key exists,
+    that job is returned instead.
+
+    Returns:
+        tuple: job model and True if it is created
+    """
+    if key is not None:
+        job = session.query(Job).filter_by(kind=kind, key=key) \
+            .filter(Job.status.in_([Job.STATUS_QUEUED, Job.STATUS_RUNNING])) \
+            .order_by(Job.id).first()
+        if job is not None:
+            return job, False
+    job = Job(kind=kind, key=key, args=kwargs, status=Job.STATUS_QUEUED, attempts=0)
+    session.add(job)
+    return job, True
+
+
+def claim_job(session, worker, kinds=None):
+    """Mark the oldest queued job as running and commit it.
+
+    Job is claimed with conditional update, so two workers never claim the same job.
+
+    Returns:
+        job model or None if the queue is empty
+    """
+    table = Job.__table__
+    while True:
+        query = session.query(Job.id).filter(Job.status == Job.STATUS_QUEUED)
+        if kinds is not None:
+            query = query.filter(Job.kind.in_(kinds))
+        job_id = query.order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            session.commit()
+            return None
+        res = session.execute(
+            table.update()
+            .where(table.c.id == job_id).where(table.c.status == Job.STATUS_QUEUED)
+            .values(
+                status=Job.STATUS_RUNNING, worker=worker, started_at=datetime.now(),
+                updated_at=datetime.now(), attempts=table.c.attempts + 1))
+        session.commit()
+        if res.rowcount:
+            job = session.query(Job).get(job_id)
+            session.refresh(job)
+            return job
+        log.debug('Job is claimed by other worker: %s', job_id)
+
+
+def update_job(session, job_id, values):
+    """Update job row with plain values, write function for `writer.write`.
+
+    Returns:
+        int: number of updated row
+    """
+    table = Job.__table__
+    res = session.execute(table.update().where(table.c.id == job_id).values(**values))
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Job) and obj.id == job_id:
+            session.expire(obj)
+    return res.rowcount
+
+
+def requeue_stale_jobs(session, timeout, max_attempts):
+    """Queue running job again when its heartbeat is older than timeout seconds.
+
+    Job from worker which is killed stays running, so it is queued again.
+    Job which already failed max_attempts times is marked as failed instead.
+
+    Returns:
+        int: number of queued job
+    """
+    table = Job.__table__
+    # job from database before upgrade-db don't have heartbeat
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    stale = (table.c.status == Job.STATUS_RUNNING) & \
+        (func.coalesce(table.c.updated_at, table.c.started_at) < cutoff)
+    session.execute(
+        table.update().where(stale).where(table.c.attempts >= max_attempts)
+        .values(
+            status=Job.STATUS_FAILED, error='Worker is gone', finished_at=datetime.now(),
+            updated_at=datetime.now()))
+    res = session.execute(
+        table.update().where(stale).values(status=Job.STATUS_QUEUED, updated_at=datetime.now()))
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Job):
+            session.expire(obj)
+    return res.rowcount
+
+
+def is_job_queue_stalled(session, timeout):
+    """Check if queued job is waiting and no worker is seen for timeout seconds.
+
+    Running worker claim queued job and update the heartbeat of its running job,
+    so queued job only wait that long when no worker is running.
+    """
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    updated_at = func.coalesce(Job.updated_at, Job.created_at)
+    waiting = session.query(Job.id) \
+        .filter(Job.status == Job.STATUS_QUEUED, updated_at < cutoff).first()
+    if waiting is None:
+        return False
+    return session.query(Job.id) \
+        .filter(Job.worker.isnot(None), updated_at >= cutoff).first() is None
+
+
+def get_or_create_image_files(session, infos, disable_cache=False):
+    """Get or create image file models in bulk.
+
+    Args:
+        session: database session
+        infos: list of dict with checksum key and other ImageFile column
+        disable_cache: update existing model with the info
+    Returns:
+        list: (model, created) for each info
+    """
+    existing = {}
+    checksums = list(set(x['checksum'] for x in infos))
+    for chunk in _chunks(checksums, BULK_CHUNK_SIZE):
+        existing.update(
+            (x.checksum, x) for x in session.query(ImageFile)
+            .filter(ImageFile.checksum.in_(chunk))
+            .options(orm.selectinload(ImageFile.thumbnail)))
+    res = []
+    for info in infos:
+        model = existing.get(info['checksum'])
+        created = model is None
+        if created:
+            model = existing[info['checksum']] = ImageFile(checksum=info['checksum'])
+            session.add(model)
+        if created or disable_cache:
+            for key in IMAGE_FILE_INFO_KEYS:
+                if key in info:
+                    setattr(model, key, info[key])
+        elif model.dhash is None and info.get('dhash') is not None:
+            # image file created before dhash is added
+            model.dhash = info['dhash']
+        res.append((model, created))
+    return res
+
+
+def get_changed_image_file_paths(session, stats, retry_failed=False):
+    """Get stat of file which is new or changed since it is indexed.
+
+    Args:
+        session: database session
+        stats: list of (path, size, mtime_ns)
+        retry_failed: also get unchanged file which is failed on the last index
+    Returns:
+        list: item of stats which path is not indexed or have different size or mtime
+    """
+    indexed = {}
+    for chunk in _chunks([x[0] for x in stats], BULK_CHUNK_SIZE):
+        query = session.query(ImageFilePath.path, ImageFilePath.size, ImageFilePath.mtime_ns) \
+            .filter(ImageFilePath.path.in_(chunk))
+        if retry_failed:
+            query = query.filter(ImageFilePath.error.is_(None))
+        indexed.update((path, (size, mtime_ns)) for path, size, mtime_ns in query)
+    return [x for x in stats if indexed.get(x[0]) != (x[1], x[2])]
+
+
+def update_image_file_paths(session, items):
+    """Insert image file and insert or update its path in bulk.
+
+    Info of existing image file is not changed.
+    Path of failed file is kept with the error and without image file.
+
+    Args:
+        session: database session
+        items: list of ((path, size, mtime_ns), info), see `api.get_image_info` for the info,
+            info is the exception for failed file
+    """
+    if not items:
+        return
+    now = datetime.now()
+    img_file_rows = {}
+    for _, info in items:
+        if isinstance(info, Exception):
+            continue
+        row = {x: info.get(x) for x in IMAGE_FILE_INFO_KEYS}
+        row.update(checksum=info['checksum'], created_at=now)
+        img_file_rows.setdefault(info['checksum'], row)
+    insert_ignore(session, ImageFile.__table__, list(img_file_rows.values()))
+    img_file_ids = get_or_insert_ids(session, ImageFile.checksum, list(img_file_rows))
+    path_ids = {}
+    for chunk in _chunks([x[0][0] for x in items], BULK_CHUNK_SIZE):
+        path_ids.update(session.query(ImageFilePath.path, ImageFilePath.id)
+                        .filter(ImageFilePath.path.in_(chunk)))
+    update_rows = []
+    insert_rows = []
+    for (path, size, mtime_ns), info in items:
+        row = {'size': size, 'mtime_ns': mtime_ns, 'image_file_id': None, 'error': None}
+        if isinstance(info, Exception):
+            row['error'] = str(info) or type(info).__name__
+        else:
+            row['image_file_id'] = img_file_ids[info['checksum']]
+        if path in path_ids:
+            update_rows.append(dict([('b_id', path_ids[path])] + [
+                ('b_' + key, value) for key, value in row.items()]))
+        else:
+            row.update(path=path, created_at=now)
+            insert_rows.append(row)
+    insert_ignore(session, ImageFilePath.__table__, insert_rows)
+    table = ImageFilePath.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        size=bindparam('b_size'), mtime_ns=bindparam('b_mtime_ns'),
+        image_file_id=bindparam('b_image_file_id'), error=bindparam('b_error'))
+    for chunk in _chunks(update_rows, BULK_CHUNK_SIZE):
+        session.execute(stmt, chunk)
+    updated_ids = set(path_ids.values())
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, ImageFilePath) and obj.id in updated_ids:
+            session.expire(obj)
+
+
+def remove_missing_image_file_paths(session, folder, paths):
+    """Remove path record under folder which is not on paths.
+
+    Returns:
+        int: number of removed path record
+    """
+    prefix = os.path.join(folder, '')
+    query = session.query(ImageFilePath.id, ImageFilePath.path).filter(
+        ImageFilePath.path >= prefix, ImageFilePath.path < prefix + '\uffff')
+    missing_ids = [id_ for id_, path in query if path not in paths]
+    for chunk in _chunks(missing_ids, BULK_CHUNK_SIZE):
+        session.query(ImageFilePath).filter(ImageFilePath.id.in_(chunk)) \
+            .delete(synchronize_session='fetch')
+    return len(missing_ids)
+
+
+class DHashIndex:
+    """BK-tree of dhash column for near duplicate search.
+
+    The tree is kept per engine and column.
+    Record with id greater than the last indexed id is added to the tree before search.
+    Tree is removed when hash of existing record is changed or record is deleted on this
+    process, see `discard_changed_dhash_index`, and rebuilt on the next search.
+    Tree older than max_age is also rebuilt, for existing record changed by other process.
+    """
+
+    def __init__(self, columns, max_age=3600):
+        self.columns = columns
+        self.max_age = max_age
+        self._data = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _query(self, session, column):
+        id_column = column.class_.id
+        return session.query(id_column, column).filter(column.isnot(None)).order_by(id_column)
+
+    def _build(self, session, column):
+        tree = imghash.BKTree()
+        last_id = 0
+        for id_, value in self._query(session, column).yield_per(BULK_CHUNK_SIZE):
+            tree.add(imghash.to_unsigned(value), id_)
+            last_id = id_
+        return tree, last_id, time.monotonic()
+
+    def get_tree(self, session, column):
+        """Get up to date tree of column."""
+        assert column in self.columns, 'Column is not indexed: {}'.format(column)
+        engine = session.get_bind()
+        key = (column.class_, column.key)
+        with self._lock:
+            data = self._data.setdefault(engine, {})
+            if key not in data or time.monotonic() - data[key][2] > self.max_age:
+                data[key] = self._build(session, column)
+                return data[key][0]
+            tree, last_id, built_at = data[key]
+            id_column = column.class_.id
+            for id_, value in self._query(session, column).filter(id_column > last_id):
+                tree.add(imghash.to_unsigned(value), id_)
+                last_id = id_
+            data[key] = (tree, last_id, built_at)
+            return tree
+
+    def find(self, session, column, value, max_distance=imghash.DEFAULT_MAX_DISTANCE):
+        """Find id of record with hash under max_distance from unsigned hash value.
+
+        Returns:
+            list: (distance, id) sorted by distance
+        """
+        tree = self.get_tree(session, column)
+        return sorted(
+            (distance, id_) for distance, _, ids in tree.find(value, max_distance) for id_ in ids)
+
+    def discard(self, engine, model):
+        """Remove tree of model columns, so it is rebuilt on the next search."""
+        with self._lock:
+            data = self._data.get(engine, {})
+            for key in [x for x in data if x[0] is model]:
+                del data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+dhash_index = DHashIndex(columns=(ImageFile.dhash, Url.dhash))
+DHASH_INDEX_MODELS = tuple(set(x.class_ for x in dhash_index.columns))
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def clear_dhash_index(session):
+    """Rolled back record may be on the tree, so clear it."""
+    dhash_index.clear()
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def discard_changed_dhash_index(session, flush_context):
+    """Remove tree which have deleted record or record with changed hash.
+
+    New record is added to the tree on the next search, so it don't remove the tree.
+    """
+    changed_models = set()
+    for obj in session.deleted:
+        if isinstance(obj, DHASH_INDEX_MODELS):
+            changed_models.add(type(obj))
+    for obj in session.dirty:
+        if not isinstance(obj, DHASH_INDEX_MODELS):
+            continue
+        history = orm_attributes.get_history(
+            obj, 'dhash', passive=orm_attributes.PASSIVE_NO_INITIALIZE)
+        if history.added or history.deleted:
+            changed_models.add(type(obj))
+    for model in changed_models:
+        dhash_index.discard(session.get_bind(), model)
+
+
+@event.listens_for(orm.Session, 'after_bulk_update')
+@event.listens_for(orm.Session, 'after_bulk_delete')
+def discard_bulk_changed_dhash_index(context):
+    model = context.mapper.class_
+    if issubclass(model, DHASH_INDEX_MODELS):
+        dhash_index.discard(context.session.get_bind(), model)
+
+
+def find_near_duplicates(session, column, value, max_distance=imghash.DEFAULT_MAX_DISTANCE):
+    """Find model with dhash under max_distance from value.
+
+    Args:
+        session: database session
+        column: `ImageFile.dhash` or `Url.dhash`
+        value: signed or unsigned dhash
+        max_distance: maximum hamming distance
+    Returns:
+        list: (distance, model) sorted by distance
+    """
+    model = column.class_
+    res = dhash_index.find(session, column, imghash.to_unsigned(value), max_distance)
+    instances = {}
+    for chunk in _chunks([x[1] for x in res], BULK_CHUNK_SIZE):
+        instances.update((x.id, x) for x in session.query(model).filter(model.id.in_(chunk)))
+    return [(distance, instances[id_]) for distance, id_ in res if id_ in instances]
+
+
+def _get_image_file_dhash(file_paths):
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            continue
+        try:
+            return imghash.to_signed(imghash.dhash_file(file_path))
+        except OSError as err:
+            log.warning('Failed to hash image file: %s, %s', file_path, err)
+
+
+def backfill_image_file_dhash(session, thumb_folder=None, chunk_size=BULK_CHUNK_SIZE):
+    """Set dhash of image file which don't have it.
+
+    Hash is computed from the thumbnail or the indexed path of the image file,
+    image file without readable file is skipped.
+
+    Yields:
+        int: number of updated image file on each processed chunk
+    """
+    thumb_folder = thumb_folder if thumb_folder else DEFAULT_THUMB_FOLDER
+    thumbnail = orm.aliased(ImageFile)
+    table = ImageFile.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        dhash=bindparam('b_dhash'))
+    last_id = 0
+    while True:
+        rows = session.query(ImageFile.id, ImageFile.checksum, thumbnail.checksum) \
+            .outerjoin(thumbnail, ImageFile.thumbnail_id == thumbnail.id) \
+            .filter(ImageFile.dhash.is_(None), ImageFile.id > last_id) \
+            .order_by(ImageFile.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        paths = dict(
+            session.query(ImageFilePath.image_file_id, ImageFilePath.path)
+            .filter(ImageFilePath.image_file_id.in_([x[0] for x in rows])))
+        update_rows = []
+        for id_, checksum, thumb_checksum in rows:
+            file_paths = [
+                os.path.join(thumb_folder, x + '.jpg') for x in (thumb_checksum, checksum) if x]
+            if id_ in paths:
+                file_paths.append(paths[id_])
+            value = _get_image_file_dhash(file_paths)
+            if value is not None:
+                update_rows.append({'b_id': id_, 'b_dhash': value})
+        if update_rows:
+            session.execute(stmt, update_rows)
+            dhash_index.discard(session.get_bind(), ImageFile)
+        updated_ids = set(x['b_id'] for x in update_rows)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, ImageFile) and obj.id in updated_ids:
+                session.expire(obj)
+        yield len(update_rows)
+
+
+def iter_match_results_dict(dict_input):
+    """Iterate (url, thumbnails, tags) item from match results dict.
+
+    See `ModePlugin.get_match_results_dict` for the format of dict_input.
+    """
+    for url, data in dict_input['url'].items():
+        yield url, data['thumbnail'], data['tag']
+
+
+def get_url_info(tags, namespaces=None):
+    """Get url column value from url tags.
+
+    Args:
+        tags: list of (namespace, value) tag
+        namespaces: mapping of url column to its namespaces, default to URL_INFO_NAMESPACES
+    Returns:
+        dict: url column as key, only for valid value
+    """
+    namespaces = URL_INFO_NAMESPACES if namespaces is None else namespaces
+    res = {}
+    for key, nm_values in namespaces.items():
+        for nm, value in tags:
+            if nm not in nm_values or not value:
+                continue
+            if key == 'mimetype':
+                value = str(value).lower()
+                if '/' not in value:
+                    value = mimetypes.types_map.get('.' + value)
+            else:
+                try:
+                    value = int(value)
+                except ValueError:
+                    value = None
+            if value is not None:
+                res[key] = value
+                break
+    return res
+
+
+def update_url_info(session, url_info):
+    """Update url width, height and mimetype in bulk.
+
+    Column is only changed when the new value is not None.
+
+    Args:
+        session: database session
+        url_info: dict of url id and its info, see `get_url_info`
+    """
+    if not url_info:
+        return
+    table = Url.__table__
+    keys = list(URL_INFO_NAMESPACES)
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        **{x: func.coalesce(bindparam('b_' + x), table.c[x]) for x in keys})
+    rows = [
+        dict([('b_id', url_id)] + [('b_' + x, info.get(x)) for x in keys])
+        for url_id, info in url_info.items()]
+    _execute_chunks(session, stmt, rows, table, metrics.INGEST_UPDATED_ROWS)
+    # loaded url models don't know the new value yet
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Url) and obj.id in url_info:
+            session.expire(obj, keys)
+
+
+def increase_count(session, column, counts):
+    """Increase counter column of rows in bulk.
+
+    Args:
+        session: database session
+        column: counter column, e.g. `Netloc.url_count`
+        counts: dict of row id and the increment, it can be negative
+    """
+    counts = {key: value for key, value in counts.items() if value}
+    if not counts:
+        return
+    table = column.table
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        {column.key: table.c[column.key] + bindparam('b_count')})
+    session.execute(stmt, [{'b_id': key, 'b_count': value} for key, value in counts.items()])
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, column.class_) and obj.id in counts:
+            session.expire(obj, [column.key])
+
+
+def recount(session, column, foreign_key):
+    """Set counter column to the number of rows which refer to the row.
+
+    Args:
+        session: database session
+        column: counter column, e.g. `Netloc.url_count`
+        foreign_key: foreign key column of referring rows, e.g. `Url.netloc_id`
+    """
+    table = column.table
+    session.execute(table.update().values({
+        column.key: select([func.count(foreign_key)])
+        .where(foreign_key == table.c.id).as_scalar()}))
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, column.class_):
+            session.expire(obj, [column.key])
+
+
+def _is_changed(obj, keys):
+    for key in keys:
+        history = orm_attributes.get_history(
+            obj, key, passive=orm_attributes.PASSIVE_NO_INITIALIZE)
+        if history.added or history.deleted:
+            return True
+    return False
+
+
+@event.listens_for(orm.Session, 'before_flush')
+def set_new_url_netloc(session, flush_context, instances):
+    """Link new url model and url model with changed value to its netloc before the flush.
+
+    Only new url is counted here, url counter of changed url is updated by
+    `update_tag_counters`.
+    """
+    urls = [
+        x for x in session.new
+        if isinstance(x, Url) and x.netloc_id is None and x.netloc is None and x.value]
+    changed_urls = [
+        x for x in session.dirty if isinstance(x, Url) and x.id is not None and x.value]
+    changed_urls = [
+        x for x in changed_urls
+        if _is_changed(x, ('value',)) and not _is_changed(x, ('netloc_id', 'netloc'))]
+    netlocs = {x: urlparse(str(x.value)).netloc for x in urls + changed_urls}
+    netlocs = {key: value for key, value in netlocs.items() if value}
+    if not netlocs:
+        return
+    netloc_ids = get_or_insert_ids(session, Netloc.value, list(set(netlocs.values())))
+    for url, value in netlocs.items():
+        url.netloc_id = netloc_ids[value]
+    for url in changed_urls:
+        session.expire(url, ['netloc'])
+    increase_count(session, Netloc.url_count, Counter(
+        netloc_ids[value] for url, value in netlocs.items() if url in session.new))
+
+
+@event.listens_for(orm.Session, 'before_flush')
+def keep_tag_counter_changes(session, flush_context, instances):
+    """Keep value which is changed on the flush and needed by `update_tag_counters`.
+
+    Url tag rows of deleted url are deleted on the flush,
+    and old namespace id of changed tag and old netloc id of changed url may not be loaded.
+    """
+    url_ids = [x.id for x in session.deleted if isinstance(x, Url) and x.id is not None]
+    tag_counts = Counter()
+    netloc_counts = Counter()
+    url_table = Url.__table__
+    for chunk in _chunks(url_ids, BULK_CHUNK_SIZE):
+        tag_counts.update(x[0] for x in session.execute(
+            select([url_tags.c.tag_id]).where(url_tags.c.url_id.in_(chunk))))
+        netloc_counts.update(x[0] for x in session.execute(
+            select([url_table.c.netloc_id])
+            .where(url_table.c.id.in_(chunk)).where(url_table.c.netloc_id.isnot(None))))
+    flush_context.attributes['deleted_url_tag_counts'] = tag_counts
+    flush_context.attributes['deleted_url_netloc_counts'] = netloc_counts
+    tag_keys = ('namespace_id', 'namespace')
+    tag_ids = [
+        x.id for x in session.dirty
+        if isinstance(x, Tag) and x.id is not None and _is_changed(x, tag_keys)]
+    namespace_ids = {}
+    for chunk in _chunks(tag_ids, BULK_CHUNK_SIZE):
+        namespace_ids.update(session.execute(
+            select([Tag.__table__.c.id, Tag.__table__.c.namespace_id])
+            .where(Tag.__table__.c.id.in_(chunk))).fetchall())
+    flush_context.attributes['old_tag_namespace_ids'] = namespace_ids
+    url_ids = [
+        x.id for x in session.dirty
+        if isinstance(x, Url) and x.id is not None and _is_changed(x, ('netloc_id', 'netloc'))]
+    netloc_ids = {}
+    for chunk in _chunks(url_ids, BULK_CHUNK_SIZE):
+        netloc_ids.update(session.execute(
+            select([url_table.c.id, url_table.c.netloc_id])
+            .where(url_table.c.id.in_(chunk))).fetchall())
+    flush_context.attributes['old_url_netloc_ids'] = netloc_ids
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def update_tag_counters(session, flush_context):
+    """Update tag counter of namespace and url counter of tag and netloc for flushed model.
+
+    Tag and url which are changed or deleted with query or bulk statement are not counted,
+    run `recount_tags` after that.
+    """
+    nm_counts = Counter()
+    tag_counts = Counter()
+    for obj in session.new:
+        if isinstance(obj, Tag) and obj.namespace_id is not None:
+            nm_counts[obj.namespace_id] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Tag) and obj.namespace_id is not None:
+            nm_counts[obj.namespace_id] -= 1
+    old_namespace_ids = flush_context.attributes.get('old_tag_namespace_ids', {})
+    for obj in session.dirty:
+        if not isinstance(obj, Tag) or obj.id not in old_namespace_ids:
+            continue
+        old_id, new_id = old_namespace_ids[obj.id], obj.namespace_id
+        if old_id == new_id:
+            continue
+        if old_id is not None:
+            nm_counts[old_id] -= 1
+        if new_id is not None:
+            nm_counts[new_id] += 1
+    tag_counts.subtract(flush_context.attributes.get('deleted_url_tag_counts', ()))
+    for obj in set(session.new).union(session.dirty):
+        if not isinstance(obj, Url):
+            continue
+        history = orm_attributes.get_history(
+            obj, 'tags', passive=orm_attributes.PASSIVE_NO_INITIALIZE)
+        tag_counts.update(x.id for x in history.added or ())
+        tag_counts.subtract(x.id for x in history.deleted or ())
+    netloc_counts = Counter()
+    netloc_counts.subtract(flush_context.attributes.get('deleted_url_netloc_counts', ()))
+    old_netloc_ids = flush_context.attributes.get('old_url_netloc_ids', {})
+    for obj in session.dirty:
+        if not isinstance(obj, Url) or obj.id not in old_netloc_ids:
+            continue
+        old_id, new_id = old_netloc_ids[obj.id], obj.netloc_id
+        if old_id == new_id:
+            continue
+        if old_id is not None:
+            netloc_counts[old_id] -= 1
+        if new_id is not None:
+            netloc_counts[new_id] += 1
+    increase_count(session, Namespace.tag_count, nm_counts)
+    increase_count(session, Tag.url_count, tag_counts)
+    increase_count(session, Netloc.url_count, netloc_counts)
+
+
+def link_url_netlocs(session, url_ids):
+    """Link url without netloc to its netloc.
+
+    This is for url inserted without ORM, e.g. by `get_or_insert_ids`.
+
+    Args:
+        session: database session
+        url_ids: list of url id
+    """
+    netlocs = {}
+    value_col = type_coerce(Url.value, db.String)
+    for chunk in _chunks(url_ids, BULK_CHUNK_SIZE):
+        query = session.query(Url.id, value_col) \
+            .filter(Url.id.in_(chunk)).filter(Url.netloc_id.is_(None))
+        netlocs.update((id_, urlparse(value).netloc) for id_, value in query)
+    netlocs = {key: value for key, value in netlocs.items() if value}
+    if not netlocs:
+        return
+    netloc_ids = get_or_insert_ids(session, Netloc.value, list(set(netlocs.values())))
+    table = Url.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        netloc_id=bindparam('b_netloc_id'))
+    rows = [{'b_id': key, 'b_netloc_id': netloc_ids[value]} for key, value in netlocs.items()]
+    _execute_chunks(session, stmt, rows, table, metrics.INGEST_UPDATED_ROWS)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Url) and obj.id in netlocs:
+            session.expire(obj, ['netloc_id', 'netloc'])
+    increase_count(session, Netloc.url_count, Counter(netloc_ids[x] for x in netlocs.values()))
+
+
+def _bulk_create_match_results_chunk(session, items):
+    url_values = set()
+    nm_values = set()
+    for url, thumbnails, tags in items:
+        url_values.add(url)
+        url_values.update(thumbnails)
+        nm_values.update(x[0] for x in tags if x[0])
+    url_ids = get_or_insert_ids(session, Url.value, [str(furl(x)) for x in url_values])
+    url_ids = {x: url_ids[str(furl(x))] for x in url_values}
+    link_url_netlocs(session, list(set(url_ids.values())))
+    nm_ids = get_or_insert_ids(session, Namespace.value, list(nm_values))
+    tag_keys = set()
+    for _, _, tags in items:
+        tag_keys.update((nm_ids[nm] if nm else None, value) for nm, value in tags)
+    tag_ids = get_or_insert_tag_ids(session, list(tag_keys))
+    mr_keys = []
+    url_tag_rows = set()
+    url_info = {}
+    for url, thumbnails, tags in items:
+        url_id = url_ids[url]
+        info = get_url_info(tags)
+        if info:
+            url_info.setdefault(url_id, {}).update(info)
+        info = get_url_info(tags, THUMBNAIL_INFO_NAMESPACES)
+        if info and len(thumbnails) == 1:
+            url_info.setdefault(url_ids[thumbnails[0]], {}).update(info)
+        if thumbnails:
+            mr_keys.extend((url_id, url_ids[x]) for x in thumbnails)
+        else:
+            mr_keys.append((url_id, None))
+        url_tag_rows.update(
+            (url_id, tag_ids[(nm_ids[nm] if nm else None, value)]) for nm, value in tags)
+    mr_ids = get_or_insert_match_result_ids(session, list(set(mr_keys)))
+    for chunk in _chunks(list(set(x[0] for x in url_tag_rows)), BULK_CHUNK_SIZE):
+        url_tag_rows.difference_update(
+            session.query(url_tags.c.url_id, url_tags.c.tag_id)
+            .filter(url_tags.c.url_id.in_(chunk)))
+    insert_ignore(session, url_tags, [{'url_id': x[0], 'tag_id': x[1]} for x in url_tag_rows])
+    increase_count(session, Tag.url_count, Counter(x[1] for x in url_tag_rows))
+    # loaded url models don't know the new tags yet
+    tagged_url_ids = set(x[0] for x in url_tag_rows)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Url) and obj.id in tagged_url_ids:
+            session.expire(obj, ['tags'])
+    update_url_info(session, url_info)
+    return [mr_ids[x] for x in mr_keys]
+
+
+def bulk_create_match_results(session, items, chunk_size=BULK_CHUNK_SIZE):
+    """Create match results with their urls and tags in bulk.
+
+    Instead of one query for every url, namespace, tag and match result,
+    every chunk of items take a few `IN (...)` queries
+    and bulk insert for the missing rows.
+
+    Args:
+        session: database session
+        items: iterable of (url, thumbnails, tags) item, see `iter_match_results_dict`
+        chunk_size: number of items processed on each chunk
+    Returns:
+        list: match result models
+    """
+    session.flush()
+    mr_ids = []
+    for chunk in _chunks(items, chunk_size):
+        mr_ids.extend(_bulk_create_match_results_chunk(session, chunk))
+    # remove duplicate but keep the order
+    mr_ids = list(OrderedDict.fromkeys(mr_ids))
+    mr_models = {}
+    for chunk in _chunks(mr_ids, BULK_CHUNK_SIZE):
+        mr_models.update((x.id, x) for x in session.query(MatchResult).filter(
+            MatchResult.id.in_(chunk)))
+    return [mr_models[x] for x in mr_ids]
+
+
+def insert_response_rows(session, rows):
+    """Insert response records from plain row data, write function for `writer.write`.
+
+    Args:
+        session: database session
+        rows: list of dict, see `Response.get_row`, url and final url are url string
+    Returns:
+        list: id of response records on the same order
+    """
+    values = {str(furl(x[key])) for x in rows for key in ('url', 'final_url') if x[key]}
+    url_ids = get_or_insert_ids(session, Url.value, list(values))
+    link_url_netlocs(session, list(url_ids.values()))
+    res = []
+    for row in rows:
+        row = dict(row)
+        url, final_url = row.pop('url'), row.pop('final_url')
+        res.append(Response(
+            url_id=url_ids[str(furl(url))],
+            final_url_id=url_ids[str(furl(final_url))] if final_url else None, **row))
+    session.add_all(res)
+    session.flush()
+    return [x.id for x in res]
+
+
+def insert_search_query_rows(session, rows):
+    """Get or create search query records with their match results from plain row data.
+
+    Write function for `writer.write`.
+
+    Args:
+        session: database session
+        rows: list of dict with search_term, page, mode_id and items,
+            items is list of (url, thumbnails, tags) item, see `iter_match_results_dict`
+    Returns:
+        list: id of search query records on the same order
+    """
+    res = []
+    for row in rows:
+        model = get_or_create(
+            session, SearchQuery,
+            search_term=row['search_term'], page=row['page'], mode_id=row['mode_id'])[0]
+        session.flush()
+        mr_ids = []
+        for chunk in _chunks(row['items'], BULK_CHUNK_SIZE):
+            mr_ids.extend(_bulk_create_match_results_chunk(session, chunk))
+        mr_ids = set(mr_ids)
+        for chunk in _chunks(list(mr_ids), BULK_CHUNK_SIZE):
+            mr_ids.difference_update(
+                x[0] for x in session.query(search_query_match_results.c.match_result_id)
+                .filter(search_query_match_results.c.search_query_id == model.id)
+                .filter(search_query_match_results.c.match_result_id.in_(chunk)))
+        insert_ignore(session, search_query_match_results, [
+            {'search_query_id': model.id, 'match_result_id': x} for x in mr_ids])
+        res.append(model.id)
+    return res
+
+
+def backfill_url_info(session, chunk_size=BULK_CHUNK_SIZE):
+    """Fill url width, height and mimetype from tags of existing url.
+
+    Url is read in chunk ordered by id, so it don't need to load the whole table.
+
+    Yields:
+        int: number of url on each processed chunk
+    """
+    nm_values = set(sum(URL_INFO_NAMESPACES.values(), ()))
+    nm_values.update(sum(THUMBNAIL_INFO_NAMESPACES.values(), ()))
+    last_id = 0
+    while True:
+        url_ids = [x[0] for x in session.query(Url.id).filter(Url.id > last_id)
+                   .order_by(Url.id).limit(chunk_size)]
+        if not url_ids:
+            break
+        last_id = url_ids[-1]
+        tags = {}
+        query = session.query(url_tags.c.url_id, Namespace.value, Namespace.alias, Tag.value) \
+            .join(Tag, Tag.id == url_tags.c.tag_id) \
+            .join(Namespace, Namespace.id == Tag.namespace_id) \
+            .filter(url_tags.c.url_id.in_(url_ids)) \
+            .filter(or_(Namespace.value.in_(nm_values), Namespace.alias.in_(nm_values)))
+        for url_id, nm_value, nm_alias, value in query:
+            nm = nm_value if nm_value in nm_values else nm_alias
+            tags.setdefault(url_id, []).append((nm, value))
+        url_info = {}
+        for url_id, url_tag_list in tags.items():
+            info = get_url_info(url_tag_list)
+            if info:
+                url_info[url_id] = info
+        query = session.query(MatchResult.url_id, MatchResult.thumbnail_url_id) \
+            .filter(MatchResult.url_id.in_(list(tags))) \
+            .filter(MatchResult.thumbnail_url_id.isnot(None))
+        for url_id, thumbnail_url_id in query:
+            info = get_url_info(tags[url_id], THUMBNAIL_INFO_NAMESPACES)
+            if info:
+                url_info.setdefault(thumbnail_url_id, {}).update(info)
+        update_url_info(session, url_info)
+        yield len(url_ids)
+
+
+def rebuild_netlocs(session, chunk_size=BULK_CHUNK_SIZE):
+    """Link every url to its netloc and count the url of every netloc again.
+
+    Url is read in chunk ordered by id, so it don't need to load the whole table.
+
+    Yields:
+        int: number of url on each processed chunk
+    """
+    value_col = type_coerce(Url.value, db.String)
+    table = Url.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        netloc_id=bindparam('b_netloc_id'))
+    last_id = 0
+    while True:
+        rows = session.query(Url.id, value_col, Url.netloc_id).filter(Url.id > last_id) \
+            .order_by(Url.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        netlocs = {x[0]: urlparse(x[1]).netloc for x in rows}
+        netloc_ids = get_or_insert_ids(
+            session, Netloc.value, list(set(x for x in netlocs.values() if x)))
+        update_rows = []
+        for id_, _, netloc_id in rows:
+            new_netloc_id = netloc_ids.get(netlocs[id_])
+            if new_netloc_id != netloc_id:
+                update_rows.append({'b_id': id_, 'b_netloc_id': new_netloc_id})
+        if update_rows:
+            session.execute(stmt, update_rows)
+        yield len(rows)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Url):
+            session.expire(obj, ['netloc_id', 'netloc'])
+    recount(session, Netloc.url_count, Url.netloc_id)
+
+
+def recount_tags(session):
+    """Count tags of every namespace and urls of every tag again."""
+    recount(session, Namespace.tag_count, Tag.namespace_id)
+    recount(session, Tag.url_count, url_tags.c.tag_id)
+
+
+def migrate_response_bodies(session, chunk_size=BULK_CHUNK_SIZE):
+    """Move response body of old record from text column to response store.
+
+    Json body of old record is also removed, because it is parsed from the body.
+
+    Yields:
+        int: number of response on each processed chunk
+    """
+    last_id = 0
+    while True:
+        models = session.query(Response).filter(
+            Response.id > last_id, Response.text_digest.is_(None),
+            Response.text_inline.isnot(None)).order_by(Response.id).limit(chunk_size).all()
+        if not models:
+            break
+        last_id = models[-1].id
+        for model in models:
+            encoding = model.encoding or 'utf-8'
+            try:
+                content = model.text_inline.encode(encoding)
+            except UnicodeEncodeError:
+                encoding = 'utf-8'
+                content = model.text_inline.encode(encoding)
+            model.set_content(content, encoding)
+            model.json_inline = None
+        yield len(models)
+
+
+def remove_unused_response_blobs(session, min_age=3600):
+    """Remove body from response store which is not used by any response.
+
+    Args:
+        min_age: only remove body which is not stored for this seconds,
+            so body of response which is not committed yet is kept
+    Returns:
+        int: number of removed body
+    """
+    def used_digests(digests):
+        return [x[0] for x in session.query(Response.text_digest).filter(
+            Response.text_digest.in_(digests)).distinct()]
+
+    return get_response_store().remove_unused(used_digests, min_age=min_age)
+
+
+def _get_index_names(connection, table_name):
+    dialect_name = connection.dialect.name
+    # expression index is not reflected by sqlalchemy inspector
+    if dialect_name == 'sqlite':
+        query = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name"
+    elif dialect_name == 'postgresql':
+        query = 'SELECT indexname FROM pg_indexes WHERE tablename = :name'
+    else:
+        return {x['name'] for x in inspect(connection).get_indexes(table_name)}
+    return {x[0] for x in connection.execute(text(query), name=table_name)}
+
+
+def get_missing_schema(connection):
+    """Get columns and indexes of existing tables which are not on the database.
+
+    `db.create_all` only create missing tables,
+    so columns and indexes added to existing tables have to be added with `upgrade_schema`.
+
+    Returns:
+        tuple: list of missing columns and list of missing indexes
+    """
+    inspector = inspect(connection)
+    table_names = set(inspector.get_table_names())
+    columns, indexes = [], []
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        column_names = {x['name'] for x in inspector.get_columns(table.name)}
+        columns.extend(x for x in table.columns if x.name not in column_names)
+        index_names = _get_index_names(connection, table.name)
+        indexes.extend(
+            x for x in sorted(table.indexes, key=lambda x: x.name)
+            if x.name not in index_names)
+    return columns, indexes
+
+
+def _add_column(connection, column):
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.format_table(column.table), preparer.format_column(column),
+        column.type.compile(dialect=dialect))
+    # existing rows get the default value, column without it can't be not null
+    if column.default is not None and column.default.is_scalar:
+        ddl += ' DEFAULT {}'.format(literal(column.default.arg, column.type).compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+        if not column.nullable:
+            ddl += ' NOT NULL'
+    for foreign_key in column.foreign_keys:
+        ddl += ' REFERENCES {} ({})'.format(
+            preparer.format_table(foreign_key.column.table),
+            preparer.format_column(foreign_key.column))
+    connection.execute(ddl)
+
+
+def merge_duplicates(session, index):
+    """Merge rows which have the same value on unique index into the row with lowest id.
+
+    Rows which refer to the merged rows are changed to refer to the kept row.
+
+    Returns:
+        int: number of merged rows
+    """
+    table = index.table
+    expressions = list(index.expressions)
+    references = [
+        (ref_table, foreign_key.parent)
+        for ref_table in db.metadata.sorted_tables
+        for foreign_key in ref_table.foreign_keys if foreign_key.column is table.c.id]
+    groups = session.execute(
+        select(expressions + [func.min(table.c.id)])
+        .group_by(*expressions).having(func.count() > 1)).fetchall()
+    count = 0
+    for group in groups:
+        keep_id = group[-1]
+        ids = [x[0] for x in session.execute(select([table.c.id]).where(and_(
+            table.c.id != keep_id, *[x == y for x, y in zip(expressions, group)])))]
+        for ref_table, column in references:
+            if not column.primary_key:
+                session.execute(
+                    ref_table.update().where(column.in_(ids)).values({column.name: keep_id}))
+                continue
+            # association row may already exist for the kept row
+            rows = [dict(x) for x in session.execute(ref_table.select().where(column.in_(ids)))]
+            for row in rows:
+                row[column.name] = keep_id
+            insert_ignore(session, ref_table, rows)
+            session.execute(ref_table.delete().where(column.in_(ids)))
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+        count += len(ids)
+    if count:
+        identity_cache.clear()
+    return count
+
+
+def upgrade_schema(session):
+    """Add missing columns and indexes of existing tables.
+
+    Duplicate rows are merged before unique index is created.
+    Existing rows get default value of the new columns,
+    so counters and columns filled from other tables have to be computed again.
+
+    Returns:
+        tuple: list of added columns, list of added indexes and number of merged rows
+    """
+    connection = session.connection()
+    columns, indexes = get_missing_schema(connection)
+    for column in columns:
+        _add_column(connection, column)
+    merged = 0
+    for index in indexes:
+        if index.unique:
+            merged += merge_duplicates(session, index)
+        index.create(connection)
+    return columns, indexes, merged
+
 # }}}
 # {{{ plugin
 
 
-def get_plugin_manager():
-    manager = PluginManager(plugin_info_ext='ini')
-    manager.setCategoriesFilter({
-        'mode': ModePlugin,
-    })
-    manager.setPluginPlaces([plugin.__path__[0]])
-    manager.collectPlugins()
-    return manager
+_plugin_manager = None
+_plugin_manager_signature = None
+_plugin_manager_lock = threading.Lock()
+
+
+def get_plugin_files_signature():
+    """Get name and modification time of every plugin file."""
+    folder = plugin.__path__[0]
+    res = []
+    for name in sorted(os.listdir(folder)):
+        if os.path.splitext(name)[1] in ('.ini', '.py'):
+            res.append((name, os.path.getmtime(os.path.join(folder, name))))
+    return tuple(res)
+
+
+def get_plugin_manager(reload=False):
+    """Get process-wide plugin manager.
+
+    Plugins are collected once and only collected again when
+    plugin file is added, removed or modified, or when reload is True.
+    """
+    global _plugin_manager, _plugin_manager_signature
+    start = time.perf_counter()
+    collected = False
+    signature = get_plugin_files_signature()
+    with _plugin_manager_lock:
+        if reload or _plugin_manager is None or signature != _plugin_manager_signature:
+            manager = PluginManager(plugin_info_ext='ini')
+            manager.setCategoriesFilter({
+                'mode': ModePlugin,
+            })
+            manager.setPluginPlaces([plugin.__path__[0]])
+            manager.collectPlugins()
+            for plugin_info in manager.getAllPlugins():
+                plugin_info.plugin_object.name = plugin_info.name
+            log.debug('plugins collected: {}'.format(len(manager.getAllPlugins())))
+            _plugin_manager = manager
+            _plugin_manager_signature = signature
+            collected = True
+        res = _plugin_manager
+    metrics.PLUGIN_MANAGER_DURATION.observe(time.perf_counter() - start, collected=collected)
+    return res
+
+
+def update_plugin_models(session, manager=None):
+    """Create or update plugin record for every plugin on the manager."""
+    manager = get_plugin_manager() if manager is None else manager
+    keys = [
+        'name', 'version', 'description', 'author', 'website', 'copyright',
+        'categories', 'category']
+    res = []
+    for plugin_info in manager.getAllPlugins():
+        with session.no_autoflush:
+            model = get_or_create(session, Plugin, path=plugin_info.path)[0]
+        #  update record
+        for key in keys:
+            if getattr(plugin_info, key):
+                if key == 'version':
+                    setattr(model, key, str(getattr(plugin_info, key)))
+                else:
+                    setattr(model, key, getattr(plugin_info, key))
+        session.add(model)
+        res.append(model)
+    return res
+
 
+class ModePlugin(IPlugin):
+    """Base class for mode plugin."""
+
+    requests_lib = 'requests_html'
+    # cache ttl in seconds for fetched page, None to use RESPONSE_CACHE_TTL app config
+    cache_ttl = None
+    # plugin name, set when the plugin is collected
+    name = None
+
+    def timer(self, stage):
+        """Measure time of plugin stage, e.g. fetch, parse or ingest."""
+        return metrics.PLUGIN_DURATION.time(
+            plugin=self.name or type(self).__name__, stage=stage)
+
+    def create_match_results(self, session, items):
+        """Create match results from (url, thumbnails, tags) items and measure it.
+
+        Items from lazy parser is parsed while it is inserted,
+        parse time is measured apart from ingest time.
+        """
+        items = metrics.IterTimer(items)
+        start = time.perf_counter()
+        res = bulk_create_match_results(session, items)
+        labels = {'plugin': self.name or type(self).__name__}
+        metrics.PLUGIN_DURATION.observe(items.elapsed, stage='parse', **labels)
+        metrics.PLUGIN_DURATION.observe(
+            time.perf_counter() - start - items.elapsed, stage='ingest', **labels)
+        return res
+
+    def get_query_url(self, search_term, page=1):
+        """Get url fetched for search term and page."""
+        if page != 1:
+            raise NotImplementedError
+        return search_term
+
+    def get_match_items_many(self, queries, session, use_cache=True, **fetch_kwargs):
+        """Get match result items for many queries, the urls are fetched concurrently.
+
+        Items are plain data, so they can be written with `writer.write`.
+
+        Args:
+            queries: list of (search_term, page)
+            session: database session
+            use_cache: use cached response, see `Response.create`
+            **fetch_kwargs: keyword arguments for `fetch.fetch_many`
+        Returns:
+            list: list of (url, thumbnails, tags) item for each query on the same order,
+            None if the query url can't be fetched.
+        """
+        res = [None] * len(queries)
+        urls = []
+        for idx, (search_term, page) in enumerate(queries):
+            try:
+                urls.append((idx, self.get_query_url(search_term, page=page)))
+            except (AssertionError, NotImplementedError, ValueError):
+                log.exception('Failed to get query url, search term: {}'.format(search_term))
+        with self.timer('fetch'):
+            resp_list = Response.create_many(
+                [x[1] for x in urls], 'get', session, requests_lib=self.requests_lib,
+                use_cache=use_cache, cache_ttl=self.cache_ttl, **fetch_kwargs)
+        for (idx, _), (resp_model, resp) in zip(urls, resp_list):
+            if not resp_model:
+                continue
+            with self.timer('parse'):
+                res[idx] = list(self.iter_match_results(
+                    text=resp_model.text, response=resp, session=session, url=queries[idx][0]))
+        return res
+
+    def get_match_results_many(self, queries, session, use_cache=True, **fetch_kwargs):
+        """Get match results for many queries, see `get_match_items_many`.
+
+        Returns:
+            list: list of match results for each query on the same order,
+            None if the query url can't be fetched.
+        """
+        res = []
+        for items in self.get_match_items_many(
+                queries, session, use_cache=use_cache, **fetch_kwargs):
+            if items is None:
+                res.append(None)
+                continue
+            with self.timer('ingest'):
+                res.append(bulk_create_match_results(session, items))
+        return res
 
     @classmethod
     def get_match_results_dict(self, text=None, response=None, session=None, url=None):
@@ -431,29 +2546,16 @@ def get_plugin_manager():
         """
         return {}
 
+    @classmethod
+    def iter_match_results(cls, text=None, response=None, session=None, url=None):
+        """Iterate (url, thumbnails, tags) item of match results.
+
+        Plugin can override this to yield item while parsing,
+        so the whole match results don't have to be kept on memory.
+        """
+        return iter_match_results_dict(cls.get_match_results_dict(
+            text=text, response=response, session=session, url=url))
+
     @classmethod
     def match_results_models_from_dict(cls, dict_input, session):
-        if dict_input['tag']:
-            pass
-        for url, data in dict_input['url'].items():
-            tag_models = []
-            for nm, tag_value in data['tag']:
-                #  tag_model = models.get_or_create_tag()
-                if nm:
-                    nm_model = get_or_create(session, Namespace, value=nm)[0]
-                    tag_models.append(get_or_create(
-                        session, Tag, value=tag_value, namespace=nm_model)[0])
-                else:
-                    tag_models.append(get_or_create(
-                        session, Tag, value=tag_value, namespace=None)[0])
-                pass
-            mr_model = None
-            if data['thumbnail']:
-                for tu in data['thumbnail']:
-                    mr_model = get_or_create_match_result(
-                        session, url=url, thumbnail_url=tu)[0]
-                    yield mr_model
-            else:
-                mr_model = get_or_create_match_result(session, url=url)[0]
-                yield mr_model
-            mr_model.url.tags.extend(tag_models)
+        return bulk_create_match_results(session, iter_match_results_dict(dict_input))
@@ -1,30 +1,40 @@
 from urllib.parse import urlparse, urljoin
 
-from bs4 import BeautifulSoup
 import structlog
 
-from gbooru_images_download import models, api
+from gbooru_images_download import api, fetch, models
 
 
 log = structlog.getLogger(__name__)
 
 
-class ModePlugin():
+class ModePlugin(models.ModePlugin):
 
-    def get_match_results(self, search_term, page, session=None):
+    def get_query_url(self, search_term, page=1):
         assert page == 1, 'Only support first page'
         scheme = urlparse(search_term).scheme
         assert_msg = 'Unknown scheme: {}'.format(scheme)
         assert scheme in ('http', 'https'), assert_msg
-        resp_model = models.Response.create(search_term, 'get', session)
-        mr_dict = self.get_match_results_dict(
-            text=resp_model.text, session=session, url=search_term)
-        match_results = self.match_results_models_from_dict(mr_dict, session)
+        return search_term
+
+    def get_match_results(
+            self, search_term, page, session=None, use_cache=True,
+            max_retries=fetch.MAX_RETRIES):
+        query_url = self.get_query_url(search_term, page=page)
+        with self.timer('fetch'):
+            resp_model = models.Response.create(
+                query_url, 'get', session, use_cache=use_cache, cache_ttl=self.cache_ttl,
+                max_retries=max_retries)
+        with self.timer('parse'):
+            mr_dict = self.get_match_results_dict(
+                text=resp_model.text, session=session, url=search_term)
+        with self.timer('ingest'):
+            match_results = self.match_results_models_from_dict(mr_dict, session)
         return match_results
 
     @classmethod
     def get_match_results_dict(cls, text=None, response=None, session=None, url=None):
-        soup = BeautifulSoup(text, 'html.parser')
+        soup = api.get_soup(text)
         res = {'url': {}, 'tag': []}
         a_tags = soup.select('a')
         skipped_hrefs = []
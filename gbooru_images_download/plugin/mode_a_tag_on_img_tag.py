@@ -1,6 +1,5 @@
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
 import structlog
 
 from gbooru_images_download import models, api
@@ -12,7 +11,7 @@ log = structlog.getLogger(__name__)
 class ParserPlugin():
 
     def get_match_results(self, text, session=None, url=None):
-        soup = BeautifulSoup(text, 'html.parser')
+        soup = api.get_soup(text)
         a_tags = soup.select('a')
         session.commit()
         skipped_hrefs = []
@@ -1,20 +1,29 @@
 from urllib.parse import urlparse
 
-from gbooru_images_download import models, api
+from gbooru_images_download import api, fetch, models
 
 
-class ModePlugin():
+class ModePlugin(models.ModePlugin):
 
-    def get_match_results(
-            self, search_term=None, page=1, text=None, response=None, session=None, url=None):
+    def get_query_url(self, search_term, page=1):
         if page != 1:
             raise NotImplementedError
         assert urlparse(search_term).scheme in ('http', 'https'), 'Unknown scheme'
-        resp_model, resp = models.Response.create(
-            search_term, 'get', session, requests_lib='requests_html', return_response=True)
-        mr_dict = self.get_match_results_dict(
-            text=text, response=response, session=session, url=url)
-        match_results = self.match_results_models_from_dict(mr_dict, session)
+        return search_term
+
+    def get_match_results(
+            self, search_term=None, page=1, text=None, response=None, session=None, url=None,
+            use_cache=True, max_retries=fetch.MAX_RETRIES):
+        query_url = self.get_query_url(search_term, page=page)
+        with self.timer('fetch'):
+            resp_model, resp = models.Response.create(
+                query_url, 'get', session, requests_lib=self.requests_lib, return_response=True,
+                use_cache=use_cache, cache_ttl=self.cache_ttl, max_retries=max_retries)
+        with self.timer('parse'):
+            mr_dict = self.get_match_results_dict(
+                text=resp_model.text, response=resp, session=session, url=search_term)
+        with self.timer('ingest'):
+            match_results = self.match_results_models_from_dict(mr_dict, session)
         return match_results
 
     @classmethod
@@ -1,14 +1,16 @@
 """google image search."""
 from urllib.parse import urlparse, urlencode, parse_qs
+import html
 import json
-import requests
+import re
 
 import structlog
-from bs4 import BeautifulSoup
 
-from gbooru_images_download import models, api
+from gbooru_images_download import api, fetch, models
 
 log = structlog.getLogger(__name__)
+RG_META_PATTERN = re.compile(
+    r'<div\s[^>]*class=["\']?[^"\'>]*\brg_meta\b[^>]*>(.*?)</div>', re.DOTALL)
 
 
 def get_json_response(query, page=1):
@@ -29,7 +31,7 @@ def get_json_response(query, page=1):
     parsed_url = urlparse('https://www.google.com/search')
     query_url = parsed_url._replace(query=urlencode(url_query)).geturl()
     log.debug('query url', url=query_url)
-    resp = requests.get(query_url)
+    resp = fetch.fetch(query_url, requests_lib='requests')
     return resp.json()
 
 
@@ -59,7 +61,8 @@ def get_data(html_tag):
     res['img_url'] = {
         'value': url_from_img_url,
         'width': img_url_width,
-        'height': img_url_height
+        'height': img_url_height,
+        'mimetype': json_data.get('ity'),
     }
     # thumbnail url
     res['thumbnail_url'] = {
@@ -75,7 +78,7 @@ def get_match_results(json_response=None, session=None):
     session = models.db.session if session is None else session
     if json_response is not None:
         html = json_response[1][1]
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = api.get_soup(html)
         for html_tag in soup.select('.rg_bx'):
             data = get_data(html_tag=html_tag)
             model = api.get_or_create_match_result(session=session, data=data)[0]
@@ -85,11 +88,20 @@ def get_match_results(json_response=None, session=None):
         yield
 
 
-class ModePlugin():
+def iter_rg_meta(text):
+    """Iterate json data of every rg_meta tag on the text.
+
+    The text is scanned for the tag instead of parsed into html tree,
+    so each json data is yielded as soon as it is found.
+    """
+    for match in RG_META_PATTERN.finditer(text):
+        yield json.loads(html.unescape(match.group(1)))
+
+
+class ModePlugin(models.ModePlugin):
     """Base class for parser plugin."""
 
-    def get_match_results(
-            self, search_term=None, page=1, text=None, response=None, session=None, url=None):
+    def get_query_url(self, search_term, page=1):
         parsed_url = urlparse('https://www.google.com/search')
         url_query = {
             'asearch': 'ichunk',
@@ -100,29 +112,35 @@ class ModePlugin():
             'tbm': 'isch',
             'yv': '3',
         }
-        query_url = parsed_url._replace(query=urlencode(url_query)).geturl()
+        return parsed_url._replace(query=urlencode(url_query)).geturl()
+
+    def get_match_results(
+            self, search_term=None, page=1, text=None, response=None, session=None, url=None,
+            use_cache=True, max_retries=fetch.MAX_RETRIES):
+        query_url = self.get_query_url(search_term, page=page)
         log.debug('query url', url=query_url)
-        resp_model = models.Response.create(query_url, method='get', session=session)
-        mr_dict = self.get_match_results_dict(
-            text=resp_model.text, session=session, url=search_term)
-        match_results = self.match_results_models_from_dict(mr_dict, session)
+        with self.timer('fetch'):
+            resp_model = models.Response.create(
+                query_url, method='get', session=session, use_cache=use_cache,
+                cache_ttl=self.cache_ttl, max_retries=max_retries)
+        items = self.iter_match_results(text=resp_model.text, session=session, url=search_term)
+        match_results = self.create_match_results(session, items)
         return match_results
 
     @classmethod
-    def get_match_results_dict(self, text=None, response=None, session=None, url=None):
-        text = '<style>{}'.format(text.split('<style>', 1)[1])
-        soup = BeautifulSoup(text, 'html.parser')
-        res = {'url': {}, 'tag': []}
-        rg_bx = soup.select('.rg_bx')
-        for html_tag in rg_bx:
-            rg_meta = json.loads(html_tag.select_one('div.rg_meta').text)
+    def iter_match_results(cls, text=None, response=None, session=None, url=None):
+        for rg_meta in iter_rg_meta(text):
             url_tags = [
                 ('gi {}'.format(key), str(value)) for key, value in rg_meta.items() if str(value)]
-            url = rg_meta['ou']
-            thumbnail = rg_meta['tu']
+            yield rg_meta['ou'], [rg_meta['tu']], url_tags
+
+    @classmethod
+    def get_match_results_dict(self, text=None, response=None, session=None, url=None):
+        res = {'url': {}, 'tag': []}
+        for url, thumbnails, url_tags in self.iter_match_results(text=text):
             if url in res['url']:
                 res['url'][url]['tag'].extend(url_tags)
-                res['url'][url]['thumbnail'].append(thumbnail)
+                res['url'][url]['thumbnail'].extend(thumbnails)
             else:
-                res['url'][url] = {'thumbnail': [thumbnail], 'tag': url_tags}
+                res['url'][url] = {'thumbnail': thumbnails, 'tag': url_tags}
         return res
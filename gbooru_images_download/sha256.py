@@ -1,15 +1,44 @@
 #!/usr/bin/env python
 """taken and modified from https://gist.github.com/rji/b38c7238128edf53a181"""
 import hashlib
+import mmap
 import sys
 
 
+def sha256_fileobj(file_obj, block_size=65536):
+    """sha256 checksum of file object."""
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: file_obj.read(block_size), b''):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
 def sha256_checksum(filename, block_size=65536):
     """sha256 checksum."""
-    sha256 = hashlib.sha256()
     with open(filename, 'rb') as file_path:
-        for block in iter(lambda: file_path.read(block_size), b''):
-            sha256.update(block)
+        return sha256_fileobj(file_path, block_size=block_size)
+
+
+def sha256_mmap(filename, block_size=1 << 20):
+    """sha256 checksum of memory mapped file.
+
+    The file is hashed in large block directly from the page cache,
+    without copying every block into new bytes object.
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as file_obj:
+        try:
+            mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can't be mapped
+            return sha256.hexdigest()
+        with mapped:
+            view = memoryview(mapped)
+            try:
+                for idx in range(0, len(view), block_size):
+                    sha256.update(view[idx:idx + block_size])
+            finally:
+                view.release()
     return sha256.hexdigest()
 
 
@@ -0,0 +1,145 @@
+"""Single-flight module.
+
+Lock keyed by the identity of a job, so concurrent caller with the same key run one at a time,
+and later caller can use the first caller result instead of repeating the job.
+
+Thread on the same process wait on in-process lock,
+other process wait on lock file when fcntl is available.
+Keys are striped by their digest prefix, so keys on the same stripe share one lock
+and the number of lock files is bounded.
+"""
+from contextlib import ExitStack, contextmanager
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from appdirs import user_data_dir
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+DEFAULT_LOCK_FOLDER = os.path.join(
+    user_data_dir('gbooru_images_download', 'rachmadaniharyono'), 'lock')
+POLL_INTERVAL = 0.1
+# digest prefix length of a stripe, 16 ** 3 lock files at most
+STRIPE_LENGTH = 3
+# default timeout of caller which wait for other caller, e.g. running search
+LOCK_TIMEOUT = 600
+
+
+def get_stripe(key):
+    """Get stripe of key."""
+    return hashlib.sha1(key.encode('utf8')).hexdigest()[:STRIPE_LENGTH]
+
+
+class KeyLock:
+    """In-process and cross-process lock keyed by string.
+
+    Lock is held per stripe of the key, see `get_stripe`.
+    The same thread can hold other key on the same stripe while it hold a key.
+    Lock entry of a stripe is removed when no thread use it.
+    Lock file is kept, removing it while other process wait on it would break the lock.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_lock_path(self, stripe):
+        folder = self.folder if self.folder else DEFAULT_LOCK_FOLDER
+        return os.path.join(folder, stripe + '.lock')
+
+    @contextmanager
+    def _file_lock(self, stripe, deadline):
+        if fcntl is None:
+            yield False
+            return
+        path = self.get_lock_path(stripe)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError('Lock timeout, path: {}'.format(path))
+                    time.sleep(POLL_INTERVAL)
+            try:
+                yield waited
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        """Hold lock of key.
+
+        Yields:
+            bool: True if other caller hold the lock before
+        """
+        stripe = get_stripe(key)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            # lock, number of user and depth of the holder thread
+            entry = self._entries.setdefault(stripe, [threading.RLock(), 0, 0])
+            entry[1] += 1
+        try:
+            waited = not entry[0].acquire(blocking=False)
+            if waited:
+                log.debug('Wait for running job: %s', key)
+                if not entry[0].acquire(timeout=-1 if timeout is None else timeout):
+                    raise TimeoutError('Lock timeout, key: {}'.format(key))
+            try:
+                entry[2] += 1
+                if entry[2] > 1:
+                    # file is already locked by this thread
+                    yield waited
+                else:
+                    with self._file_lock(stripe, deadline) as file_waited:
+                        yield waited or file_waited
+            finally:
+                entry[2] -= 1
+                entry[0].release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._entries[stripe]
+
+
+key_lock = KeyLock()
+
+
+def lock(key, timeout=None):
+    """Hold the shared lock of key, see `KeyLock.lock`."""
+    return key_lock.lock(key, timeout=timeout)
+
+
+@contextmanager
+def lock_many(keys, timeout=None):
+    """Hold lock of every key.
+
+    Keys are locked on sorted stripe order, so two callers with overlapping stripes
+    don't deadlock.
+
+    Yields:
+        bool: True if other caller hold any of the lock before
+    """
+    with ExitStack() as stack:
+        waited = [
+            stack.enter_context(lock(x, timeout=timeout))
+            for x in sorted(set(keys), key=lambda x: (get_stripe(x), x))]
+        yield any(waited)
+
+
+def get_search_query_key(search_term, page, mode):
+    """Get key of search query, mode is the plugin record."""
+    return 'search_query:{}:{}:{}'.format(mode.name if mode is not None else '', page, search_term)
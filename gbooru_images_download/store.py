@@ -0,0 +1,163 @@
+"""Content-addressed store module."""
+import gzip
+import io
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .sha256 import sha256_fileobj
+
+
+log = logging.getLogger(__name__)
+COMPRESSIONS = ('zstd', 'gzip')
+CHUNK_SIZE = 65536
+
+
+class BlobStore:
+    """Store blob on folder with its sha256 checksum as the file name.
+
+    Identical blobs are stored only once.
+    Blob is compressed with zstd when zstandard is installed, gzip otherwise.
+    """
+
+    def __init__(self, folder, compression=None):
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        assert compression in COMPRESSIONS, 'Unknown compression: {}'.format(compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstandard is required for zstd compression')
+        self.folder = folder
+        self.compression = compression
+
+    def get_path(self, digest, compression=None):
+        compression = self.compression if compression is None else compression
+        ext = '.zst' if compression == 'zstd' else '.gz'
+        return os.path.join(self.folder, digest[:2], digest + ext)
+
+    def find_path(self, digest):
+        """Find path and compression of stored blob, (None, None) if not found."""
+        for compression in COMPRESSIONS:
+            path = self.get_path(digest, compression)
+            if os.path.isfile(path):
+                return path, compression
+        return None, None
+
+    def __contains__(self, digest):
+        return self.find_path(digest)[0] is not None
+
+    def put(self, data):
+        """Put blob to the store.
+
+        Returns:
+            tuple: sha256 digest and size of the blob
+        """
+        digest = sha256_fileobj(io.BytesIO(data))
+        path = self.find_path(digest)[0]
+        if path is not None:
+            # blob is used again, so it is not removed as old unused blob
+            os.utime(path)
+            return digest, len(data)
+        path = self.get_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.compression == 'zstd':
+            compressed_data = zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed_data = gzip.compress(data)
+        # write to temporary file first, so partial blob is never on the path
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed_data)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return digest, len(data)
+
+    def open(self, digest):
+        """Open stored blob as decompressed binary file object."""
+        path, compression = self.find_path(digest)
+        if path is None:
+            raise KeyError(digest)
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstandard is required to read blob: {}'.format(path))
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return gzip.open(path, 'rb')
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+    def iter_chunks(self, digest, chunk_size=CHUNK_SIZE):
+        """Iterate decompressed chunk of stored blob."""
+        with self.open(digest) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def iter_digests(self, older_than=None):
+        """Iterate digest of stored blob.
+
+        Args:
+            older_than: only blob with modification time before this timestamp
+        """
+        if not os.path.isdir(self.folder):
+            return
+        for entry in os.scandir(self.folder):
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for blob_entry in os.scandir(entry.path):
+                digest, ext = os.path.splitext(blob_entry.name)
+                if ext not in ('.zst', '.gz') or not digest.startswith(entry.name):
+                    continue
+                if older_than is not None and blob_entry.stat().st_mtime >= older_than:
+                    continue
+                yield digest
+
+    def remove(self, digest):
+        """Remove stored blob.
+
+        Returns:
+            bool: True if the blob is found and removed
+        """
+        removed = False
+        for compression in COMPRESSIONS:
+            try:
+                os.remove(self.get_path(digest, compression))
+                removed = True
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def remove_unused(self, used_digests, min_age=0, chunk_size=1000):
+        """Remove stored blob which is not used.
+
+        Args:
+            used_digests: function which return the used digests from list of digests
+            min_age: only remove blob which is not written or put again for this seconds,
+                so blob which is put but not yet referenced is kept
+            chunk_size: number of digest passed to used_digests on every call
+        Returns:
+            int: number of removed blob
+        """
+        count = 0
+        digests = []
+        older_than = time.time() - min_age
+        for digest in self.iter_digests(older_than=older_than):
+            digests.append(digest)
+            if len(digests) >= chunk_size:
+                count += self._remove_unused_chunk(digests, used_digests)
+                digests = []
+        if digests:
+            count += self._remove_unused_chunk(digests, used_digests)
+        return count
+
+    def _remove_unused_chunk(self, digests, used_digests):
+        used = set(used_digests(digests))
+        return sum(self.remove(x) for x in digests if x not in used)
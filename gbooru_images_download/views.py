@@ -4,25 +4,54 @@ from urllib.parse import unquote, urlparse
 import json
 import logging
 
-from bs4 import BeautifulSoup
-from flask import flash, make_response, redirect, request, url_for
+from flask import (
+    Response, flash, jsonify, redirect, request, stream_with_context, url_for)
 from flask_admin import AdminIndexView, expose
 from flask_admin.babel import gettext
-from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib import sqla
 from flask_admin.form import rules
 from flask_admin.helpers import get_redirect_target
 from flask_admin.model.helpers import get_mdict_item_or_list
 from jinja2 import Markup, contextfunction
+from sqlalchemy import orm
 from sqlalchemy.sql.expression import desc
 from wtforms import fields, validators
 import humanize
 
-from . import api, models, filters, forms
+from . import ajax, api, imghash, jobs, metrics, models, filters, forms, writer
 
 
 log = logging.getLogger(__name__)
 
 
+class ModelView(sqla.ModelView):
+    """Model view which measure time of column formatter.
+
+    Relationship used by column_list is loaded with list_load_options,
+    so the list page don't run query for every row.
+    Other relationship raise on access in the list page.
+    """
+
+    list_load_options = ()
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        # only list query get the options, delete action and count query use get_query too
+        count, query = super().get_list(
+            page, sort_column, sort_desc, search, filters, execute=False, page_size=page_size)
+        query = query.options(*self.list_load_options).options(orm.raiseload('*'))
+        if execute:
+            query = query.all()
+        return count, query
+
+    @contextfunction
+    def get_list_value(self, context, model, name):
+        if name not in self.column_formatters:
+            return super().get_list_value(context, model, name)
+        with metrics.FORMATTER_DURATION.time(view=self.endpoint, column=name):
+            return super().get_list_value(context, model, name)
+
+
 def date_formatter(view, context, model, name):
     date_data = getattr(model, name)
     humanized_date_data = humanize.naturaltime(date_data)
@@ -41,10 +70,65 @@ def url_formatter(view, context, model, name):
     return Markup(templ.format(data.value, unquote(str(data.value))))
 
 
+def dhash_formatter(view, context, model, name):
+    data = getattr(model, name)
+    if data is None:
+        return ''
+    return Markup('<a href="{}">{:016x}</a>'.format(
+        view.get_url('.near_duplicates_view', id=model.id), imghash.to_unsigned(data)))
+
+
+class NearDuplicatesMixin:
+    """Model view mixin with near duplicates view of the record dhash."""
+
+    @expose('/near-duplicates')
+    def near_duplicates_view(self):
+        return_url = get_redirect_target() or self.get_url('.index_view')
+        id = get_mdict_item_or_list(request.args, 'id')
+        model = self.get_one(id) if id is not None else None
+        if model is None:
+            flash(gettext('Record does not exist.'), 'error')
+            return redirect(return_url)
+        if model.dhash is None:
+            flash(gettext('Record does not have dhash.'), 'error')
+            return redirect(return_url)
+        max_distance = request.args.get(
+            'max_distance', imghash.DEFAULT_MAX_DISTANCE, type=int)
+        results = []
+        for name, column in (('Image file', models.ImageFile.dhash), ('Url', models.Url.dhash)):
+            items = models.find_near_duplicates(self.session, column, model.dhash, max_distance)
+            results.append((name, [x for x in items if x[1] is not model]))
+        return self.render(
+            'gbooru_images_download/near_duplicates.html',
+            model=model, max_distance=max_distance, results=results, return_url=return_url)
+
+
+def get_or_create_url_id(session, url):
+    """Get id of url record, write function for `writer.write`."""
+    entry = models.get_or_create(session, models.Url, value=url)[0]
+    session.flush()
+    return entry.id
+
+
+def get_search_result_url(search_term, page, page_size):
+    """Get url of match result view filtered by search query."""
+    return url_for(
+        'matchresult.index_view', page_size=page_size,
+        flt0_search_query_search_term_equals=search_term,
+        flt1_search_query_page_equals=page
+    )
+
+
 class HomeView(AdminIndexView):
 
     @expose('/')
     def index(self):
+        """Search from index form.
+
+        Uncached search is queued as background job when JOB_QUEUE app config is set
+        and a worker is running, so the page is returned immediately
+        and the job page is shown until it is finished, see `jobs.is_enabled`.
+        """
         form = forms.IndexForm(request.args)
         if form.search_term.data:
             session = models.db.session
@@ -52,44 +136,67 @@ class HomeView(AdminIndexView):
             plugin_inst = manager.getPluginByName(form.mode.data, category='mode')
             plugin_model = models.get_or_create(session, models.Plugin, path=plugin_inst.path)[0]
             form.mode.data = plugin_model
-            session = models.db.session
-            model, created = models.get_or_create(
-                session, models.SearchQuery,
-                search_term=form.search_term.data,
-                page=form.page.data,
-                mode=plugin_model
-            )
-            if not created and not form.disable_cache.data:
-                page_size = len(model.match_results)
-                return redirect(url_for(
-                    'matchresult.index_view', page_size=page_size,
-                    flt0_search_query_search_term_equals=model.search_term,
-                    flt1_search_query_page_equals=model.page
-                ))
-            model = models.SearchQuery.create(form, session)
+            session.flush()
+            model = models.SearchQuery.get_finished(
+                session, form.search_term.data, form.page.data, plugin_model)
+            if model is not None and not form.disable_cache.data:
+                return redirect(get_search_result_url(
+                    model.search_term, model.page, len(model.match_results)))
+            if jobs.is_enabled(session):
+                job = jobs.enqueue_search_query(
+                    session, form.search_term.data, form.page.data, plugin_model,
+                    use_cache=not form.disable_cache.data)[0]
+                session.commit()
+                return redirect(url_for('.job_view', job_id=job.id))
+            model = models.SearchQuery.create(form, session, max_retries=0)
             if model:
-                page_size = len(model.match_results)
-                return redirect(url_for(
-                    'matchresult.index_view', page_size=page_size,
-                    flt0_search_query_search_term_equals=model.search_term,
-                    flt1_search_query_page_equals=model.page
-                ))
+                return redirect(get_search_result_url(
+                    model.search_term, model.page, len(model.match_results)))
             flash(gettext('Search error.'), 'error')
         return self.render('gbooru_images_download/index.html', form=form)
 
+    def get_job_status(self, job):
+        res = {'id': job.id, 'kind': job.kind, 'status': job.status, 'error': job.error}
+        if job.status == models.Job.STATUS_DONE and job.kind == 'search_query':
+            res['redirect_url'] = get_search_result_url(
+                job.result['search_term'], job.result['page'],
+                job.result['match_result_count'])
+        return res
+
+    @expose('/job/<int:job_id>')
+    def job_view(self, job_id):
+        """Progress page of job, it polls the job status until it is finished."""
+        job = models.db.session.query(models.Job).get(job_id)
+        if job is None:
+            flash(gettext('Record does not exist.'), 'error')
+            return redirect(url_for('.index'))
+        status = self.get_job_status(job)
+        if status.get('redirect_url'):
+            return redirect(status['redirect_url'])
+        return self.render(
+            'gbooru_images_download/job.html', job=job,
+            poll_interval=int(jobs.POLL_INTERVAL * 1000))
+
+    @expose('/job/<int:job_id>.json')
+    def job_status_view(self, job_id):
+        job = models.db.session.query(models.Job).get(job_id)
+        if job is None:
+            return jsonify({'error': 'Record does not exist.'}), 404
+        return jsonify(self.get_job_status(job))
+
     @expose('/u/')
     def url_redirect(self):
         """View for single image url."""
         url = request.args.get('u', None)
         session = models.db.session
-        entry, created = models.get_or_create(session, models.Url, value=url)
-        if created:
-            session.add(entry)
-            session.commit()
-        if not entry.id:
+        entry = session.query(models.Url).filter_by(value=url).first()
+        url_id = entry.id if entry is not None else \
+            writer.write(session, get_or_create_url_id, url)
+        session.commit()
+        if not url_id:
             flash(gettext('Url id error.'), 'error')
             return redirect(url_for('admin.index'))
-        return redirect(url_for('url.details_view', id=entry.id))
+        return redirect(url_for('url.details_view', id=url_id))
 
 
 class NamespaceView(ModelView):
@@ -102,6 +209,24 @@ class NamespaceView(ModelView):
         'hidden',
     ]
     column_formatters = {'created_at': date_formatter, }
+    column_sortable_list = ('created_at', 'value', 'alias', 'tag_count')
+
+
+class ImageFileView(NearDuplicatesMixin, ModelView):
+    """Custom view for ImageFile model."""
+
+    can_create = False
+    can_view_details = True
+    can_set_page_size = True
+    column_default_sort = ('created_at', True)
+    column_display_pk = True
+    column_filters = ['created_at', 'checksum', 'width', 'height', 'img_format', 'dhash']
+    column_formatters = {'created_at': date_formatter, 'dhash': dhash_formatter}
+    column_list = (
+        'created_at', 'id', 'checksum', 'width', 'height', 'img_format', 'size', 'dhash')
+    column_searchable_list = ('checksum', )
+    form_columns = ('width', 'height', 'img_format', 'thumbnail')
+    page_size = 100
 
 
 class MatchResultView(ModelView):
@@ -160,6 +285,11 @@ class MatchResultView(ModelView):
         'tags',
         'thumbnail_url',
         'url',
+        'url.width',
+        'url.height',
+        'url.mimetype',
+        filters.MatchResultSearchQueryFilter(models.MatchResult, 'Search query'),
+        filters.TagFilter(models.MatchResult, 'Tag'),
     ]
     column_formatters = {
         'created_at': date_formatter,
@@ -183,9 +313,15 @@ class MatchResultView(ModelView):
         'url.width',
         'url.height',
     )
-    column_sortable_list = ('created_at', 'url', 'thumbnail_url')
+    column_sortable_list = ('created_at', 'url', 'thumbnail_url', 'url.width', 'url.height')
+    form_ajax_refs = {'search_queries': ajax.search_query_loader, 'tags': ajax.tag_loader}
+    list_template = 'gbooru_images_download/model_list.html'
     named_filter_urls = True
     page_size = 100
+    list_load_options = (
+        orm.selectinload(models.MatchResult.url),
+        orm.selectinload(models.MatchResult.thumbnail_url),
+    )
 
     def create_model(self, form):
         try:
@@ -198,7 +334,7 @@ class MatchResultView(ModelView):
             pm = api.get_plugin_manager()
             plugin = pm.getPluginByName(model.mode.name, model.mode.category)
             mrs = list(set(plugin.plugin_object.get_match_results(
-                model.search_term, model.page, self.session)))
+                model.search_term, model.page, self.session, max_retries=0)))
             model.match_results = mrs
             self.session.add(model)
             self._on_model_change(form, model, True)
@@ -218,22 +354,17 @@ class NetlocView(ModelView):
     can_create = False
     can_edit = False
     can_set_page_size = True
+    column_default_sort = ('url_count', True)
     column_editable_list = ('hidden', )
     column_formatters = {'created_at': date_formatter}
+    column_list = ('created_at', 'value', 'url_count', 'hidden')
+    column_searchable_list = ('value', )
+    column_sortable_list = ('created_at', 'value', 'url_count')
     edit_modal = True
     form_columns = ('hidden', )
     form_excluded_columns = ['created_at', ]
     page_size = 100
 
-    def get_list(self, page, sort_field, sort_desc, search, filters, page_size=None):
-        query = self.session.query(models.Url.value).distinct()
-        for item in query:
-            n_model = models.get_or_create(self.session, self.model, value=item[0].netloc)[0]
-            self.session.add(n_model)
-        self.session.commit()
-        res = super().get_list(page, sort_field, sort_desc, search, filters, page_size=None)
-        return res
-
 
 class PluginView(ModelView):
 
@@ -279,21 +410,8 @@ class PluginView(ModelView):
     @expose('/update')
     def index_update_view(self):
         return_url = get_redirect_target() or self.get_url('.index_view')
-        manager = api.get_plugin_manager()
-        keys = [
-            'name', 'version', 'description', 'author', 'website', 'copyright',
-            'categories', 'category']
-        for plugin in manager.getAllPlugins():
-            with self.session.no_autoflush:
-                model = models.get_or_create(self.session, self.model, path=plugin.path)[0]
-            #  update record
-            for key in keys:
-                if getattr(plugin, key):
-                    if key == 'version':
-                        setattr(model, key, str(getattr(plugin, key)))
-                    else:
-                        setattr(model, key, getattr(plugin, key))
-            self.session.add(model)
+        manager = api.get_plugin_manager(reload=True)
+        models.update_plugin_models(self.session, manager)
         self.session.commit()
         return redirect(return_url)
 
@@ -302,7 +420,8 @@ class ResponseView(ModelView):
 
     def _text_formatter(self, context, model, name):
         data = getattr(model, name)
-        soup = BeautifulSoup(data, 'html.parser')
+        # lxml wrap fragment with html and body tag, so the prettified text would change
+        soup = api.get_soup(data, features='html.parser')
         code_section = '<pre><code class="language-html">{}</code></pre>'.format(
             Markup.escape(soup.prettify(formatter='minimal'))
         )
@@ -317,11 +436,15 @@ class ResponseView(ModelView):
     can_view_details = True
     column_default_sort = ('created_at', True)
     column_display_pk = True
+    column_details_list = (
+        'created_at', 'method', 'url', 'kwargs_json', 'status_code', 'reason', 'final_url',
+        'text_digest', 'text_size', 'text', 'links', 'headers',
+    )
     column_filters = [
         'created_at',
         'final_url',
         'status_code',
-        'text',
+        'text_digest',
         'url',
     ]
     column_formatters = {
@@ -345,6 +468,10 @@ class ResponseView(ModelView):
     }
     column_list = ('created_at', 'status_code', 'method', 'url', 'content_type')
     details_template = 'gbooru_images_download/response_details.html'
+    list_load_options = (
+        orm.selectinload(models.Response.url),
+        orm.selectinload(models.Response.final_url),
+    )
     form_columns = ('method', 'kwargs_json')
     form_create_rules = ('url_input', 'method', 'kwargs_json')
     form_overrides = {
@@ -353,12 +480,13 @@ class ResponseView(ModelView):
         'method': {'class': 'radio'},
         'kwargs_json': {'rows': 5},
     }
+    form_ajax_refs = {'response': ajax.response_loader}
     list_template = 'gbooru_images_download/response_list.html'
 
     def create_model(self, form):
         model = self.model.create(
             url=form.url_input.data, method=form.method.data, session=self.session,
-            kwargs_json=form.kwargs_json.data,
+            kwargs_json=form.kwargs_json.data, use_cache=False, max_retries=0,
             on_model_change_func=lambda x: self._on_model_change(form, x, True),
             handle_view_exception=self.handle_view_exception,
             after_model_change_func=lambda x: self.after_model_change(form, x, True)
@@ -375,8 +503,9 @@ class ResponseView(ModelView):
         if model is None:
             flash(gettext('Record does not exist.'), 'error')
             return redirect(return_url)
-        resp = make_response(model.text)
-        resp.mimetype = '; '.join(model.content_type)
+        resp = Response(stream_with_context(model.iter_content()))
+        if model.content_type:
+            resp.headers['Content-Type'] = '; '.join(model.content_type)
         return resp
 
     def get_create_form(self):
@@ -440,10 +569,6 @@ class ResponseView(ModelView):
         if not id:
             id = get_mdict_item_or_list(request.args, 'response')
         form = forms.ResponseParserForm()
-        form.response.choices = [
-            (x.id, "id:{0.id} url:{0.url.value}".format(x))
-            for x in self.session.query(self.model).all()
-        ]
         form.parser.choices = [
             (x.id, x.name)
             for x in self.session.query(models.Plugin).filter_by(category=plugin_category)
@@ -460,14 +585,15 @@ class ResponseView(ModelView):
         if model is None:
             flash(gettext('Response record does not exist.'), 'error')
             return resp_tmpl(form=form)
-        form.response.default = model.id
+        form.response.default = model
         parser_model_id = get_mdict_item_or_list(request.args, 'parser')
         parser_model = self.session.query(models.Plugin).filter_by(
             id=parser_model_id, category=plugin_category).first()
         parser_result = None
         if parser_model:
             form.parser.default = parser_model.id
-            form.process()
+        form.process()
+        if parser_model:
             manager = api.get_plugin_manager()
             plugin = manager.getPluginByName(parser_model.name, category=plugin_category)
             get_match_results_dict = plugin.plugin_object.get_match_results_dict
@@ -493,7 +619,7 @@ class SearchQueryView(ModelView):
         return data
 
     def _match_result_formatter(self, context, model, name):
-        data = len(model.match_results)
+        data = model.match_result_count
         return Markup('<a href="{}">{}</a>'.format(
             url_for(
                 'matchresult.index_view', page_size=data,
@@ -513,10 +639,16 @@ class SearchQueryView(ModelView):
     column_sortable_list = ('created_at', 'search_term', 'page')
     column_filters = ('page', 'search_term')
     form_excluded_columns = ['created_at', 'match_results']
+    # match result is only counted
+    list_load_options = (
+        orm.with_expression(
+            models.SearchQuery.match_result_count, models.search_query_match_result_count),
+        orm.selectinload(models.SearchQuery.mode),
+    )
 
     def create_model(self, form):
         res = self.model.create(
-            form=form, session=self.session,
+            form=form, session=self.session, max_retries=0,
             on_model_change_func=self._on_model_change,
             handle_view_exception=self.handle_view_exception,
             after_model_change_func=self.after_model_change
@@ -532,19 +664,19 @@ class TagView(ModelView):
     column_filters = ('value', 'namespace.value')
     column_formatters = {
         'created_at': date_formatter,
-        'urls': lambda v, c, m, p: len(m.urls),
         'value': lambda v, c, m, p: Markup(
             '<span style="word-break:break-all;">{}</span>'.format(m.value)
         )
     }
-    column_labels = {'namespace.value': 'Namespace'}
-    column_list = ('created_at', 'namespace.value', 'value', 'urls')
+    column_labels = {'namespace.value': 'Namespace', 'url_count': 'Urls'}
+    column_list = ('created_at', 'namespace.value', 'value', 'url_count')
     column_searchable_list = ('value', 'namespace.value')
-    column_sortable_list = ('value', 'namespace.value', 'created_at')
+    column_sortable_list = ('value', 'namespace.value', 'created_at', 'url_count')
+    list_load_options = (orm.selectinload(models.Tag.namespace), )
     page_size = 100
 
 
-class UrlView(ModelView):
+class UrlView(NearDuplicatesMixin, ModelView):
     """Custom view for ImageURL model."""
 
     def _content_type_formatter(self, context, model, name):
@@ -568,10 +700,12 @@ class UrlView(ModelView):
             getattr(m, p), 'id="source-url"'
         )),
         'content_type': _content_type_formatter,
+        'dhash': dhash_formatter,
     }
-    column_list = ('created_at', 'id', 'value', 'content_type')
+    column_list = ('created_at', 'id', 'value', 'content_type', 'dhash')
     column_searchable_list = ('value', )
     details_template = 'gbooru_images_download/url_details.html'
+    form_ajax_refs = {'tags': ajax.tag_loader}
     form_edit_rules = [
         rules.FieldSet(('value', 'tags'), 'Url'),
         #  rules.FieldSet(('value', 'hidden', 'tags'), 'Url'),
@@ -580,4 +714,10 @@ class UrlView(ModelView):
     ]
     form_excluded_columns = ['created_at', ]
     form_overrides = dict(value=fields.StringField,)
+    # content type is read from response headers
+    list_load_options = (
+        orm.selectinload('responses').load_only('headers'),
+        orm.selectinload('on_final_responses').load_only('headers'),
+    )
+    list_template = 'gbooru_images_download/model_list.html'
     page_size = 100
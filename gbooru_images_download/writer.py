@@ -0,0 +1,180 @@
+"""Writer module.
+
+Write-behind channel, ingest write from many producer is run by single writer thread
+and committed together on one transaction.
+
+Sqlite allow only one writer at a time and every commit is synced to disk,
+so one commit for many write is faster than one commit for each of them
+and the producers don't wait on each other for the database lock.
+
+Producer hand plain row data to write function, e.g. `models.insert_response_rows`,
+and get plain value back, e.g. id of created record.
+"""
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from . import metrics, models
+
+
+log = logging.getLogger(__name__)
+# maximum number of write on single transaction
+BATCH_SIZE = 200
+# seconds to wait for more write before the transaction is committed
+FLUSH_INTERVAL = 0.01
+WRITE_TIMEOUT = 60
+
+
+class WriteBehind:
+    """Run write function on writer thread and commit them in batch.
+
+    Write function is called with the writer session and must not use record from other session,
+    pass plain row data instead and return plain value, e.g. id of created record.
+
+    When the batch fail, every write on it is run again on its own transaction,
+    so single bad write don't fail the others.
+
+    Args:
+        app: flask app, the writer thread use its database session
+        batch_size: maximum number of write on single transaction
+        flush_interval: seconds to wait for more write before the transaction is committed
+    """
+
+    def __init__(self, app, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Commit queued write and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue write function.
+
+        Returns:
+            Future: result of the function, it is set after the transaction is committed
+        """
+        future = Future()
+        self.start()
+        self._queue.put((func, args, kwargs, future))
+        return future
+
+    def write(self, func, *args, timeout=WRITE_TIMEOUT, **kwargs):
+        """Queue write function and wait until it is committed, see `submit`."""
+        return self.submit(func, *args, **kwargs).result(timeout)
+
+    def _get_batch(self):
+        """Get batch of write, None on the batch mark the writer to stop."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, session, batch):
+        try:
+            results = [func(session, *args, **kwargs) for func, args, kwargs, _ in batch]
+            session.commit()
+        except Exception as err:  # pylint: disable=broad-except
+            session.rollback()
+            if len(batch) > 1:
+                log.warning('Write batch failed, write one by one: %s', err)
+                for item in batch:
+                    self._write(session, [item])
+                return
+            log.exception('Write failed.')
+            batch[0][3].set_exception(err)
+            return
+        self.commits += 1
+        self.writes += len(batch)
+        for item, result in zip(batch, results):
+            item[3].set_result(result)
+
+    def _run(self):
+        with self.app.app_context():
+            session = models.db.session
+            try:
+                stop = False
+                while not stop:
+                    batch = self._get_batch()
+                    stop = batch[-1] is None
+                    batch = [
+                        x for x in batch
+                        if x is not None and x[3].set_running_or_notify_cancel()]
+                    if batch:
+                        self._write(session, batch)
+            finally:
+                models.db.session.remove()
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'writes': self.writes,
+            'queued': self._queue.qsize(),
+            'batch_size': self.batch_size,
+        }
+
+
+def init_app(app, **kwargs):
+    """Add write-behind writer to app extensions, see `get_writer`."""
+    app.extensions['write_behind'] = writer = WriteBehind(app, **kwargs)
+    metrics.registry.register(metrics.GaugeFunc(
+        'gbooru_write_behind', 'Write-behind writer stats.', ('stat', ),
+        func=lambda: {(k, ): v for k, v in writer.stats().items()}))
+    return writer
+
+
+def get_writer():
+    """Get write-behind writer of current app or None if it is not enabled."""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('write_behind')
+
+
+def holds_write_lock(session):
+    """Check if the session has uncommitted write on sqlite.
+
+    Writer thread would wait for the database lock of that session,
+    while the session wait for the writer.
+    """
+    return bool(getattr(session.connection().connection, 'in_transaction', False))
+
+
+def write(session, func, *args, **kwargs):
+    """Run write function with write-behind writer of current app.
+
+    When the writer is not enabled or the session already hold the database lock,
+    the function is run with the session and the caller commit it.
+
+    Args:
+        session: database session of the caller
+        func: write function, it is called with database session, args and kwargs
+    """
+    writer = get_writer()
+    if writer is None or holds_write_lock(session):
+        return func(session, *args, **kwargs)
+    return writer.write(func, *args, **kwargs)
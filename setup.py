@@ -48,11 +48,13 @@ setup(
         'requests>=2.22.0',
         'SQLAlchemy-Utils>=0.33.11',
         'SQLAlchemy>=1.3.4',
+        'Yapsy>=1.11.223',
     ],
     tests_require=test_deps,
     extras_require={
         'test': test_deps,
         'dev': dev_deps,
+        'zstd': ['zstandard>=0.11.1'],
     },
     setup_requires=['pytest-runner'],
     classifiers=[
@@ -1,10 +1,13 @@
 """Module contain shared fixture function."""
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import logging
+import threading
 
 from flask import Flask
 import pytest
 
-from gbooru_images_download import models
+from gbooru_images_download import models, singleflight
 
 
 log = logging.getLogger('__name__')
@@ -13,6 +16,22 @@ vcr_log.setLevel(logging.INFO)
 logging.basicConfig()
 
 
+@pytest.fixture(autouse=True)
+def tmp_response_folder(tmpdir, monkeypatch):
+    """Keep response body on tmp folder."""
+    folder = tmpdir.join('response')
+    monkeypatch.setattr(models, 'DEFAULT_RESPONSE_FOLDER', folder.strpath)
+    return folder
+
+
+@pytest.fixture(autouse=True)
+def tmp_lock_folder(tmpdir, monkeypatch):
+    """Keep single-flight lock files on tmp folder."""
+    folder = tmpdir.join('lock')
+    monkeypatch.setattr(singleflight, 'DEFAULT_LOCK_FOLDER', folder.strpath)
+    return folder
+
+
 @pytest.fixture()
 def tmp_db(tmpdir):
     """Get tmp db."""
@@ -25,3 +44,19 @@ def tmp_db(tmpdir):
     app.app_context().push()
     models.db.create_all()
     return models.db
+
+
+@pytest.fixture()
+def http_server(tmpdir):
+    """Serve files on tmpdir with local http server."""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    handler = partial(QuietHandler, directory=tmpdir.strpath)
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield {'url': 'http://127.0.0.1:{}/'.format(server.server_port), 'folder': tmpdir}
+    server.shutdown()
+    server.server_close()
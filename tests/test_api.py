@@ -1,11 +1,13 @@
 """Test for api module."""
+from collections import Counter
+import json
 from bs4 import BeautifulSoup
 from PIL import Image
 import pytest
 import requests
 import vcr
 
-from gbooru_images_download import api, models
+from gbooru_images_download import api, models, sha256
 
 
 @pytest.fixture()
@@ -44,3 +46,112 @@ def test_parse_img_search_html(tmp_db):
     assert data['size_search_url']
     assert data['TextMatch']
     assert data['MainSimilarResult']
+
+
+def test_get_or_create_match_result(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    json_data = {
+        'ou': 'http://example.com/1.png', 'ow': 640, 'oh': 480, 'ity': 'png',
+        'tu': 'http://example.com/t/1.jpg', 'tw': 160, 'th': 120}
+    html_tag = BeautifulSoup(
+        '<div class="rg_bx"><a href="/imgres?imgurl=http://example.com/1.png'
+        '&amp;imgrefurl=http://example.com/page.html&amp;w=640&amp;h=480"></a>'
+        '<div class="rg_meta">{}</div></div>'.format(json.dumps(json_data)),
+        'html.parser')
+    data = api.get_data(html_tag)
+    model, created = api.get_or_create_match_result(data, session)
+    session.commit()
+    assert created
+    assert (str(model.url.value), model.url.width, model.url.height, model.url.mimetype) == \
+        ('http://example.com/1.png', 640, 480, 'image/png')
+    assert (model.thumbnail_url.width, model.thumbnail_url.height) == (160, 120)
+    assert ('ity', 'png') in [(x.namespace.value, x.value) for x in model.url.tags]
+    assert api.get_or_create_match_result(api.get_data(html_tag), session) == (model, False)
+    assert len(model.url.tags) == len(data['tag'])
+
+
+def test_get_or_create_image_files_with_thumbnail(tmp_db, tmp_pic, tmpdir):
+    session = tmp_db.session
+    thumb_folder = tmpdir.mkdir('thumb')
+    big_pic = tmpdir.join('big.jpg')
+    Image.new('RGB', (2000, 1000), 'blue').save(big_pic.strpath)
+    tmp_pic['image_input'].copy(tmpdir.join('copy.jpg'))
+    broken_pic = tmpdir.join('broken.jpg')
+    broken_pic.write('not image')
+    file_paths = [x.strpath for x in (
+        tmp_pic['image_input'], big_pic, tmpdir.join('copy.jpg'), broken_pic)]
+    res = api.get_or_create_image_files_with_thumbnail(
+        file_paths, session=session, thumb_folder=thumb_folder.strpath, max_workers=2)
+    session.commit()
+    assert isinstance(res[3], Exception)
+    (pic_m, created), (big_m, big_created), (copy_m, copy_created) = res[:3]
+    assert (created, big_created, copy_created) == (True, True, False)
+    assert pic_m == copy_m
+    assert pic_m.checksum == tmp_pic['checksum']
+    assert (pic_m.width, pic_m.height, pic_m.img_format) == (500, 500, 'JPEG')
+    assert (big_m.thumbnail.width, big_m.thumbnail.height) == (256, 128)
+    assert big_m.thumbnail.thumbnail == big_m.thumbnail
+    # image file get dhash of its thumbnail, solid color image have zero dhash
+    assert big_m.dhash == big_m.thumbnail.dhash == 0
+    assert 'dhash' not in api.get_image_info(big_pic.strpath)
+    thumb_path = thumb_folder.join(big_m.thumbnail.checksum + '.jpg')
+    assert Image.open(thumb_path.strpath).size == (256, 128)
+    assert len(thumb_folder.listdir()) == 2
+    # thumbnail is not created again
+    thumb_path.setmtime(0)
+    assert api.get_or_create_image_file_with_thumbnail(
+        big_pic.strpath, session=session, thumb_folder=thumb_folder.strpath) == (big_m, False)
+    assert thumb_path.mtime() == 0
+
+
+def test_index_image_folder(tmp_db, tmpdir):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    folder = tmpdir.mkdir('index')
+    for name, color in (('1.jpg', 'red'), ('sub/2.png', 'blue'), ('sub/3.jpg', 'red')):
+        folder.join(name).dirpath().ensure(dir=True)
+        Image.new('RGB', (100, 50), color).save(folder.join(name).strpath)
+    folder.join('note.txt').write('text')
+    folder.join('broken.jpg').write('not image')
+
+    def index(retry_failed=False):
+        res = Counter()
+        for counter in api.index_image_folder(
+                folder.strpath, session=session, chunk_size=2, retry_failed=retry_failed):
+            session.commit()
+            res.update(counter)
+        return res
+
+    assert index() == Counter(files=4, indexed=3, failed=1)
+    assert session.query(models.ImageFile).count() == 2
+    # indexed image is not decoded for dhash
+    assert session.query(models.ImageFile).filter(models.ImageFile.dhash.isnot(None)).count() == 0
+    path_m = session.query(models.ImageFilePath).filter_by(path=folder.join('1.jpg').strpath).one()
+    assert (path_m.image_file.width, path_m.image_file.height, path_m.error) == (100, 50, None)
+    assert path_m.image_file.paths[1].path == folder.join('sub', '3.jpg').strpath
+    broken_m = session.query(models.ImageFilePath) \
+        .filter_by(path=folder.join('broken.jpg').strpath).one()
+    assert (broken_m.image_file, broken_m.size) == (None, folder.join('broken.jpg').size())
+    assert broken_m.error
+    # only changed file is hashed again, unchanged failed file is skipped too
+    assert index() == Counter(files=4)
+    assert index(retry_failed=True) == Counter(files=4, failed=1)
+    Image.new('RGB', (100, 50), 'green').save(folder.join('sub', '3.jpg').strpath)
+    folder.join('sub', '2.png').remove()
+    assert index() == Counter(files=3, indexed=1, removed=1)
+    assert session.query(models.ImageFilePath).count() == 3
+    assert session.query(models.ImageFile).count() == 3
+    # fixed file is indexed
+    Image.new('RGB', (100, 50), 'red').save(folder.join('broken.jpg').strpath, 'JPEG')
+    assert index() == Counter(files=3, indexed=1)
+    session.refresh(broken_m)
+    assert (broken_m.image_file.width, broken_m.error) == (100, None)
+
+
+@pytest.mark.parametrize('content', [b'', b'a' * 3000000])
+def test_sha256_mmap(tmpdir, content):
+    file_path = tmpdir.join('file')
+    file_path.write_binary(content)
+    assert sha256.sha256_mmap(file_path.strpath, block_size=1000000) == \
+        sha256.sha256_checksum(file_path.strpath)
@@ -0,0 +1,52 @@
+"""Test benchmark suite on small scale, so it keep working with the code."""
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_bench(*args):
+    return subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench'] + list(args), cwd=ROOT_DIR,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_benchmark(tmpdir):
+    output = tmpdir.join('result.json').strpath
+    proc = run_bench(
+        'run', '--scale', '50', '--repeat', '1', '--images', '2', '--max-workers', '1',
+        '--work-folder', tmpdir.join('work').strpath, '--output', output)
+    assert proc.returncode == 0, proc.stderr
+    with open(output) as f:
+        data = json.load(f)
+    res = {(x['name'], x['scale']): x for x in data['results']}
+    assert res[('get_match_results_dict:google_image', None)]['rows'] == 100
+    assert res[('match_results_models_from_dict', 50)]['rows'] == 50
+    assert res[('create_thumbnails', None)]['rows'] == 2
+    assert res[('view:matchresult', 50)]['median'] > 0
+    assert res[('view:tag', 50)]['median'] > 0
+    # view database is kept for the next run, leftover of interrupted run is replaced
+    view_dbs = tmpdir.join('work').listdir('view-50-*.db')
+    assert len(view_dbs) == 1
+    view_dbs[0].remove()
+    tmpdir.join('work', view_dbs[0].basename + '.tmp').write('broken')
+    proc = run_bench(
+        'run', '--scale', '50', '--repeat', '2', '--only', 'view:*',
+        '--work-folder', tmpdir.join('work').strpath)
+    assert proc.returncode == 0, proc.stderr
+    assert view_dbs[0].check()
+    assert not tmpdir.join('work', view_dbs[0].basename + '.tmp').check()
+    proc = run_bench('compare', output, output)
+    assert proc.returncode == 0, proc.stderr
+    assert 'REGRESSION' not in proc.stdout
+    for item in data['results']:
+        item['median'] *= 2
+    slower = tmpdir.join('slower.json').strpath
+    with open(slower, 'w') as f:
+        json.dump(data, f)
+    proc = run_bench('compare', output, slower)
+    assert proc.returncode != 0
+    assert 'REGRESSION' in proc.stdout
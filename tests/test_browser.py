@@ -0,0 +1,109 @@
+"""Test for browser module."""
+import threading
+import time
+
+import pytest
+
+from gbooru_images_download import browser
+
+
+class FakeBrowser:
+
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+
+def get_pool(**kwargs):
+    browsers = []
+
+    def create():
+        browsers.append(FakeBrowser())
+        return browsers[-1]
+
+    def close(item):
+        item.closed = True
+
+    pool = browser.BrowserPool(create, close, check=lambda x: x.healthy, **kwargs)
+    return pool, browsers
+
+
+def test_browser_pool():
+    pool, browsers = get_pool(max_size=2, max_pages=3)
+    # browser is reused
+    for _ in range(2):
+        with pool.lease() as item:
+            assert item is browsers[0]
+    # recycled after max pages
+    with pool.lease():
+        pass
+    assert browsers[0].closed
+    with pool.lease() as item:
+        assert item is browsers[1]
+    # unhealthy browser is replaced
+    browsers[1].healthy = False
+    with pool.lease() as item:
+        assert item is browsers[2]
+    assert browsers[1].closed
+    # browser is closed when the lease raise error
+    with pytest.raises(ValueError):
+        with pool.lease():
+            raise ValueError
+    assert browsers[2].closed
+    assert pool.stats() == {'size': 0, 'idle': 0, 'max_size': 2, 'created': 3, 'recycled': 3}
+    with pool.lease():
+        pass
+    pool.close()
+    assert browsers[3].closed
+    with pytest.raises(RuntimeError):
+        with pool.lease():
+            pass
+
+
+def test_browser_pool_max_size():
+    pool, browsers = get_pool(max_size=2)
+    active = []
+    max_active = []
+    lock = threading.Lock()
+
+    def work():
+        with pool.lease() as item:
+            with lock:
+                active.append(item)
+                max_active.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(item)
+
+    threads = [threading.Thread(target=work) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_active) <= 2
+    assert len(browsers) == 2
+    with pool.lease(), pool.lease():
+        with pytest.raises(TimeoutError):
+            with pool.lease(timeout=0.01):
+                pass
+
+
+def test_render(monkeypatch):
+    render_browsers = []
+
+    def create():
+        render_browsers.append(browser.RenderBrowser(None, FakeBrowser()))
+        return render_browsers[-1]
+
+    monkeypatch.setattr(browser, 'render_pool', browser.BrowserPool(create, lambda x: None))
+
+    class FakeHTML:
+        session = 'original'
+
+        def render(self, **kwargs):
+            # launched browser of the pool is used, instead of the session browser
+            return self.session.browser, kwargs
+
+    html = FakeHTML()
+    assert browser.render(html, sleep=1) == (render_browsers[0].browser, {'sleep': 1})
+    assert html.session == 'original'
@@ -0,0 +1,127 @@
+"""Test for download module."""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import io
+import os
+import threading
+
+from PIL import Image
+import pytest
+
+from gbooru_images_download import download, models
+
+
+def get_image_data(size, color='red', img_format='JPEG'):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, img_format)
+    return buf.getvalue()
+
+
+@pytest.fixture()
+def range_server():
+    """Http server with range request support, which record request headers."""
+    files = {}
+    requests_headers = []
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            requests_headers.append(dict(self.headers))
+            data = files.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            start = 0
+            range_header = self.headers.get('Range')
+            if range_header and self.headers.get('If-Range', '"etag"') == '"etag"':
+                start = int(range_header.split('=')[1].split('-')[0])
+                self.send_response(206)
+                self.send_header(
+                    'Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('ETag', '"etag"')
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+
+    server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield {
+        'url': 'http://127.0.0.1:{}'.format(server.server_port),
+        'files': files, 'headers': requests_headers}
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_urls(tmp_db, tmpdir, range_server):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    base_url = range_server['url']
+    files = range_server['files']
+    files['/1.jpg'] = get_image_data((300, 200))
+    files['/1t.jpg'] = get_image_data((30, 20))
+    files['/2.png'] = get_image_data((100, 100), 'blue', 'PNG')
+    files['/3.txt'] = b'text'
+    models.bulk_create_match_results(session, [
+        (base_url + '/1.jpg', [base_url + '/1t.jpg'], []),
+        (base_url + '/2.png', [], []),
+        (base_url + '/3.txt', [], []),
+        (base_url + '/404.jpg', [], []),
+    ])
+    session.commit()
+    urls = download.get_match_result_urls(session)
+    assert [str(x.value) for x in urls][0] == base_url + '/1t.jpg'
+    assert len(urls) == 5
+    folder = tmpdir.join('download').strpath
+
+    def run():
+        res = sum(download.download_urls(session, urls, folder=folder, chunk_size=2), Counter())
+        session.commit()
+        return res
+
+    assert run() == Counter(downloaded=3, failed=2)
+    download_m = session.query(models.Download).join(models.Url) \
+        .filter(models.Url.value == base_url + '/1.jpg').one()
+    assert download_m.status == models.Download.STATUS_DONE
+    assert (download_m.image_file.width, download_m.image_file.height) == (300, 200)
+    assert download_m.path.endswith(download_m.image_file.checksum + '.jpg')
+    with open(download_m.path, 'rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == download_m.image_file.checksum
+    # original url get dhash of its thumbnail
+    thumbnail_m = session.query(models.Url).filter_by(value=base_url + '/1t.jpg').one()
+    assert download_m.url.dhash == thumbnail_m.dhash == 0
+    assert os.listdir(os.path.join(folder, 'part')) == []
+    failed_m = session.query(models.Download).filter_by(status=models.Download.STATUS_FAILED)
+    assert sorted(x.attempts for x in failed_m) == [1, 1]
+    # downloaded url is skipped, failed url is tried again
+    assert run() == Counter(skipped=3, failed=2)
+
+
+def test_stream_to_part_file(tmpdir, range_server):
+    data = get_image_data((500, 500), 'green')
+    range_server['files']['/1.jpg'] = data
+    url = range_server['url'] + '/1.jpg'
+    part_path = download.get_part_path(tmpdir.strpath, url)
+    os.makedirs(os.path.dirname(part_path))
+    # interrupted download
+    with open(part_path, 'wb') as f:
+        f.write(data[:100])
+    with open(part_path + '.json', 'w') as f:
+        f.write('{"ETag": "\\"etag\\""}')
+    assert download.stream_to_part_file(url, part_path) == hashlib.sha256(data).hexdigest()
+    assert range_server['headers'][-1]['Range'] == 'bytes=100-'
+    with open(part_path, 'rb') as f:
+        assert f.read() == data
+    # changed file is downloaded again
+    with open(part_path, 'wb') as f:
+        f.write(b'old data')
+    with open(part_path + '.json', 'w') as f:
+        f.write('{"ETag": "\\"old\\""}')
+    assert download.stream_to_part_file(url, part_path) == hashlib.sha256(data).hexdigest()
+    with open(part_path, 'rb') as f:
+        assert f.read() == data
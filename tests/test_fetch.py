@@ -0,0 +1,168 @@
+"""Test for fetch module."""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timezone
+import threading
+
+import pytest
+import requests
+
+from gbooru_images_download import exceptions, fetch
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = fetch.TokenBucket(rate=0.5, burst=2, clock=clock)
+    # burst then one request every 2 seconds
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 2, 4]
+    clock.now = 10
+    assert bucket.reserve() == 0
+    # throttled host is blocked, then the rate is lower
+    assert bucket.throttled() == fetch.BASE_BACKOFF
+    assert bucket.rate == 0.5 * fetch.BACKOFF_FACTOR
+    assert bucket.reserve() == fetch.BASE_BACKOFF
+    assert bucket.reserve() == fetch.BASE_BACKOFF + 1 / bucket.rate
+    # backoff is doubled for throttled request in a row, retry-after is used when it is given
+    assert bucket.throttled() == fetch.BASE_BACKOFF * 2
+    assert bucket.throttled(retry_after=fetch.MAX_BACKOFF * 2) == fetch.MAX_BACKOFF * 2
+    assert bucket.get_blocked_seconds() == fetch.MAX_BACKOFF * 2
+    assert bucket.throttled(retry_after=1) == 1
+    assert bucket.get_blocked_seconds() == fetch.MAX_BACKOFF * 2
+    for _ in range(1000):
+        bucket.succeeded()
+    assert (bucket.rate, bucket.throttle_count) == (0.5, 0)
+
+
+def test_token_bucket_not_limited():
+    clock = FakeClock()
+    bucket = fetch.TokenBucket(clock=clock)
+    assert [bucket.reserve() for _ in range(10)] == [0] * 10
+    bucket.throttled(retry_after=1)
+    assert bucket.rate == fetch.THROTTLED_RATE * fetch.BACKOFF_FACTOR
+    for _ in range(1000):
+        bucket.succeeded()
+    assert bucket.rate is None
+
+
+def test_scheduler_get_rate():
+    scheduler = fetch.HostScheduler(rates={'google.com': (0.5, 1)})
+    assert scheduler.get_rate('www.google.com') == (0.5, 1)
+    assert scheduler.get_rate('ipv4.google.com:443') == (0.5, 1)
+    assert scheduler.get_rate('example.com') == (None, 1)
+    assert scheduler.get_rate('notgoogle.com') == (None, 1)
+
+
+def test_get_retry_after():
+    now = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+    def get(value):
+        resp = requests.Response()
+        if value is not None:
+            resp.headers['Retry-After'] = value
+        return fetch.get_retry_after(resp, now=now)
+
+    assert get(None) is None
+    assert get('120') == 120
+    assert get('-1') == 0
+    assert get('Mon, 01 Jan 2018 00:02:00 GMT') == 120
+    assert get('Sun, 31 Dec 2017 00:00:00 GMT') == 0
+    assert get('soon') is None
+
+
+def test_is_throttled():
+    def get(url, status_code):
+        resp = requests.Response()
+        resp.url, resp.status_code = url, status_code
+        return fetch.is_throttled(resp)
+
+    assert get('http://example.com/', 429)
+    assert not get('http://example.com/', 503)
+    assert get('https://www.google.com/search', 503)
+    assert not get('https://notgoogle.com/', 503)
+    assert get('https://ipv4.google.com/sorry/index', 200)
+
+
+@pytest.fixture()
+def throttling_server():
+    """Http server which throttle the first requests."""
+    state = {'throttled': 2, 'requests': 0}
+
+    class ThrottlingHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            state['requests'] += 1
+            if state['throttled']:
+                state['throttled'] -= 1
+                self.send_response(429)
+                self.send_header('Retry-After', '7')
+                body = b''
+            elif self.path == '/unusual':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                body = b'<html>' + fetch.UNUSUAL_TRAFFIC_TEXT + b'</html>'
+            else:
+                self.send_response(200)
+                body = b'ok'
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port), state
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_throttled(monkeypatch, throttling_server):
+    url, state = throttling_server
+    clock = FakeClock()
+    scheduler = fetch.HostScheduler(rates={}, clock=clock, sleep=clock.sleep)
+    monkeypatch.setattr(fetch, 'scheduler', scheduler)
+    monkeypatch.setattr(fetch, 'BASE_BACKOFF', 1)
+    resp = fetch.fetch(url + '/', requests_lib='requests')
+    # request is queued until the backoff end instead of failing
+    assert (resp.status_code, resp.text, state['requests']) == (200, 'ok', 3)
+    assert clock.now >= 7 + 7
+    # retry is exhausted
+    state['throttled'] = 10
+    with pytest.raises(exceptions.HostThrottled) as excinfo:
+        fetch.fetch(url + '/', requests_lib='requests', max_retries=1)
+    assert excinfo.value.response.status_code == 429
+    assert state['requests'] == 5
+    state['throttled'] = 0
+    with pytest.raises(exceptions.HostThrottled) as excinfo:
+        fetch.fetch(url + '/unusual', requests_lib='requests', max_retries=0)
+    assert fetch.is_throttled(excinfo.value.response)
+
+
+def test_fetch_max_wait(monkeypatch, throttling_server):
+    url, state = throttling_server
+    clock = FakeClock()
+    scheduler = fetch.HostScheduler(rates={}, clock=clock, sleep=clock.sleep)
+    monkeypatch.setattr(fetch, 'scheduler', scheduler)
+    # retry-after is longer than the wait limit
+    with pytest.raises(exceptions.HostThrottled) as excinfo:
+        fetch.fetch(url + '/', requests_lib='requests', max_wait=5)
+    assert (excinfo.value.response.status_code, state['requests'], clock.now) == (429, 1, 0)
+    # host is still blocked
+    with pytest.raises(exceptions.HostThrottled) as excinfo:
+        fetch.fetch(url + '/', requests_lib='requests', max_wait=5)
+    assert excinfo.value.response is None
+    assert state['requests'] == 1
+    resp = fetch.fetch(url + '/', requests_lib='requests', max_wait=14)
+    assert (resp.status_code, state['requests'], clock.now) == (200, 3, 14)
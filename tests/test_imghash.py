@@ -0,0 +1,53 @@
+"""Test for imghash module."""
+import random
+
+from PIL import Image
+import pytest
+
+from gbooru_images_download import imghash
+
+
+def get_image(seed, size=(64, 64)):
+    rnd = random.Random(seed)
+    img = Image.new('L', (8, 8))
+    img.putdata([rnd.randrange(256) for _ in range(64)])
+    return img.resize(size, Image.BILINEAR).convert('RGB')
+
+
+def test_dhash(tmpdir):
+    img = get_image(1, (320, 240))
+    value = imghash.dhash(img)
+    assert 0 <= value < 1 << imghash.HASH_BITS
+    # resized and re-encoded copy
+    copy_path = tmpdir.join('copy.jpg').strpath
+    img.resize((160, 120)).save(copy_path, quality=50)
+    assert imghash.hamming_distance(value, imghash.dhash_file(copy_path)) <= 4
+    assert imghash.hamming_distance(value, imghash.dhash(get_image(2, (320, 240)))) > 10
+
+
+@pytest.mark.parametrize('value', [0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1])
+def test_signed(value):
+    signed = imghash.to_signed(value)
+    assert -(1 << 63) <= signed < 1 << 63
+    assert imghash.to_unsigned(signed) == value
+
+
+def test_bk_tree():
+    rnd = random.Random(0)
+    values = [rnd.getrandbits(64) for _ in range(500)]
+    values.append(values[0])
+    tree = imghash.BKTree()
+    for idx, value in enumerate(values):
+        tree.add(value, idx)
+    assert len(tree) == len(values)
+    query = values[0] ^ 0b1011
+    for max_distance in (0, 3, 20, 30):
+        expected = sorted(
+            (imghash.hamming_distance(query, x), idx) for idx, x in enumerate(values)
+            if imghash.hamming_distance(query, x) <= max_distance)
+        res = sorted(
+            (distance, idx) for distance, _, idxs in tree.find(query, max_distance)
+            for idx in idxs)
+        assert res == expected
+    assert tree.find(values[0], 0)[0] == (0, values[0], [0, len(values) - 1])
+    assert imghash.BKTree().find(0) == []
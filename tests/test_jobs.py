@@ -0,0 +1,211 @@
+"""Test jobs module."""
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+from gbooru_images_download import jobs, models, views
+from gbooru_images_download.__main__ import create_app
+
+
+def test_enqueue_job(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    job, created = models.enqueue_job(session, 'test', key='k1', value=1)
+    assert created
+    session.commit()
+    assert job.args == {'value': 1}
+    assert job.status == models.Job.STATUS_QUEUED
+    assert models.enqueue_job(session, 'test', key='k1', value=2) == (job, False)
+    assert models.enqueue_job(session, 'test', key='k2')[1]
+    # job without key is never merged
+    assert models.enqueue_job(session, 'test')[1]
+    assert models.enqueue_job(session, 'test')[1]
+    job.status = models.Job.STATUS_DONE
+    session.commit()
+    assert models.enqueue_job(session, 'test', key='k1')[0] is not job
+
+
+def test_claim_job(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    for idx in range(20):
+        models.enqueue_job(session, 'test', value=idx)
+    session.commit()
+    app = tmp_db.get_app()
+    claimed = []
+
+    def claim(worker):
+        with app.app_context():
+            while True:
+                job = models.claim_job(tmp_db.session, worker)
+                if job is None:
+                    break
+                claimed.append((job.id, worker))
+            tmp_db.session.remove()
+
+    threads = [threading.Thread(target=claim, args=('w{}'.format(x), )) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(x[0] for x in claimed) == list(range(1, 21))
+    session.expire_all()
+    jobs_m = session.query(models.Job).all()
+    assert {x.status for x in jobs_m} == {models.Job.STATUS_RUNNING}
+    assert {x.attempts for x in jobs_m} == {1}
+    assert dict(claimed) == {x.id: x.worker for x in jobs_m}
+
+
+def test_requeue_stale_jobs(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    old = datetime.now() - timedelta(hours=2)
+    running = models.Job.STATUS_RUNNING
+    session.add_all([
+        models.Job(kind='test', status=running, started_at=old, updated_at=old, attempts=1),
+        models.Job(kind='test', status=running, started_at=old, updated_at=old, attempts=3),
+        # long job with recent heartbeat
+        models.Job(kind='test', status=running, started_at=old, attempts=1),
+    ])
+    session.commit()
+    assert models.requeue_stale_jobs(session, 3600, 3) == 1
+    session.commit()
+    assert [x.status for x in session.query(models.Job).order_by(models.Job.id)] == [
+        models.Job.STATUS_QUEUED, models.Job.STATUS_FAILED, models.Job.STATUS_RUNNING]
+
+
+def test_heartbeat(tmp_db, monkeypatch):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    updated = []
+
+    def wait(session, job_id):
+        job = session.query(models.Job).get(job_id)
+        for _ in range(100):
+            time.sleep(0.01)
+            session.expire(job)
+            if job.updated_at > job.started_at:
+                updated.append(job.updated_at)
+                break
+        return len(updated)
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, 'wait', wait)
+    job = models.enqueue_job(session, 'wait')[0]
+    session.commit()
+    job.args = {'job_id': job.id}
+    session.commit()
+    job = models.claim_job(session, 'test')
+    assert jobs.run_job(session, job, heartbeat_interval=0.01).result == 1
+    assert job.finished_at == job.updated_at
+
+
+def test_is_job_queue_stalled(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    old = datetime.now() - timedelta(hours=2)
+    assert not models.is_job_queue_stalled(session, 60)
+    job = models.Job(kind='test', status=models.Job.STATUS_QUEUED, updated_at=old)
+    session.add(job)
+    session.commit()
+    assert models.is_job_queue_stalled(session, 60)
+    # worker is busy with long job
+    session.add(models.Job(
+        kind='test', status=models.Job.STATUS_RUNNING, worker='test', started_at=old))
+    session.commit()
+    assert not models.is_job_queue_stalled(session, 60)
+
+
+def test_run_worker(tmp_db, monkeypatch):
+    tmp_db.session.remove()
+    session = tmp_db.session
+
+    def add(session, a, b):
+        if b is None:
+            raise ValueError('b is None')
+        return a + b
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, 'add', add)
+    job1 = models.enqueue_job(session, 'add', a=1, b=2)[0]
+    job2 = models.enqueue_job(session, 'add', a=1, b=None)[0]
+    job3 = models.enqueue_job(session, 'unknown')[0]
+    session.commit()
+    assert jobs.run_worker(session, stop_when_empty=True, worker='test') == 3
+    assert (job1.status, job1.result, job1.worker) == (models.Job.STATUS_DONE, 3, 'test')
+    assert job1.finished_at is not None
+    assert (job2.status, job2.error) == (models.Job.STATUS_FAILED, 'b is None')
+    assert job3.status == models.Job.STATUS_FAILED
+    assert jobs.run_worker(session, stop_when_empty=True) == 0
+
+
+def test_index_enqueue_search(tmpdir, monkeypatch):
+    db_uri = 'sqlite:///' + tmpdir.join('temp.db').strpath
+    # job queue is opt-in
+    monkeypatch.delenv('GBOORU_IMAGES_DOWNLOAD_JOB_QUEUE', raising=False)
+    assert not create_app(db_uri).config['JOB_QUEUE']
+    monkeypatch.setenv('GBOORU_IMAGES_DOWNLOAD_JOB_QUEUE', '1')
+    assert not create_app('sqlite://').config['JOB_QUEUE']
+    app = create_app(db_uri)
+    assert app.config['JOB_QUEUE']
+    app.config['WTF_CSRF_ENABLED'] = False
+    models.db.session.remove()
+    session = models.db.session
+    app.extensions['admin'][0].add_view(views.MatchResultView(models.MatchResult, session))
+    client = app.test_client()
+    resp = client.get('/?search_term=red+picture&page=1')
+    assert resp.status_code == 302
+    assert resp.location.endswith('/job/1')
+    # same search is not queued twice
+    assert client.get('/?search_term=red+picture&page=1').location.endswith('/job/1')
+    assert session.query(models.Job).count() == 1
+    resp = client.get('/job/1')
+    assert resp.status_code == 200
+    assert '/job/1.json' in resp.data.decode()
+    data = json.loads(client.get('/job/1.json').data.decode())
+    assert data['status'] == models.Job.STATUS_QUEUED
+    assert 'redirect_url' not in data
+
+    def run_search_query(session, search_term, page, mode_id, use_cache=True):
+        mode = session.query(models.Plugin).get(mode_id)
+        model = models.get_or_create(
+            session, models.SearchQuery, search_term=search_term, page=page, mode=mode)[0]
+        model.match_results.append(
+            models.get_or_create_match_result(session, url='http://example.com/1.jpg')[0])
+        session.commit()
+        return {'search_query_id': model.id, 'search_term': search_term, 'page': page,
+                'match_result_count': len(model.match_results)}
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, 'search_query', run_search_query)
+    assert jobs.run_worker(session, stop_when_empty=True) == 1
+    data = json.loads(client.get('/job/1.json').data.decode())
+    assert data['status'] == models.Job.STATUS_DONE
+    assert '/matchresult/' in data['redirect_url']
+    assert 'red+picture' in data['redirect_url']
+    assert client.get('/job/1').location.endswith(data['redirect_url'])
+    # finished search is not queued again
+    resp = client.get('/?search_term=red+picture&page=1')
+    assert '/matchresult/' in resp.location
+    assert session.query(models.Job).count() == 1
+    assert client.get('/job/2.json').status_code == 404
+
+
+def test_index_without_worker(tmpdir, monkeypatch):
+    monkeypatch.setenv('GBOORU_IMAGES_DOWNLOAD_JOB_QUEUE', '1')
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    models.db.session.remove()
+    session = models.db.session
+    old = datetime.now() - timedelta(hours=2)
+    session.add(models.Job(kind='test', status=models.Job.STATUS_QUEUED, updated_at=old))
+    session.commit()
+    calls = []
+
+    def create(form, session, max_retries):
+        calls.append((form.search_term.data, max_retries))
+        return False
+
+    monkeypatch.setattr(models.SearchQuery, 'create', create)
+    client = app.test_client()
+    # queued job is not claimed, so search is run on the request
+    assert client.get('/?search_term=red+picture&page=1').status_code == 200
+    assert calls == [('red picture', 0)]
+    assert session.query(models.Job).count() == 1
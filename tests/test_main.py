@@ -1,10 +1,12 @@
 import os
 import tempfile
 
+from click.testing import CliRunner
+from PIL import Image
 import pytest
 
 
-from gbooru_images_download.__main__ import create_app
+from gbooru_images_download.__main__ import cli, create_app
 from gbooru_images_download import models
 
 
@@ -29,7 +31,188 @@ def client():
     os.unlink(db_path)
 
 
+@pytest.fixture
+def cli_db(tmpdir, monkeypatch):
+    """Session of file database which is also used by cli command."""
+    db_uri = 'sqlite:///' + tmpdir.join('cli.db').strpath
+    monkeypatch.setenv('GBOORU_IMAGES_DOWNLOAD_DB_URI', db_uri)
+    create_app(db_uri)
+    models.db.session.remove()
+    yield models.db.session
+    models.db.session.remove()
+
+
+def invoke(session, args):
+    """Invoke cli command and check that it succeed."""
+    session.remove()
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    session.remove()
+    return result
+
+
+def create_match_results(session):
+    models.bulk_create_match_results(session, [
+        ('http://example.com/1.jpg', ['http://t.example.com/1.jpg'], [
+            ('gi ow', '640'), ('gi oh', '480'), ('gi ity', 'png'), ('gi tw', '160'),
+            ('gi th', '120'), ('', 'red')]),
+        ('http://example.com/2.jpg', [], [('gi ow', '320'), ('', 'red')]),
+    ])
+    session.commit()
+
+
 def test_empty_db(client):
     """Start with a blank database."""
     rv = client.get('/')
     assert rv.status_code == 200
+
+
+def test_reload_plugins():
+    result = CliRunner().invoke(cli, ['reload-plugins'])
+    assert result.exit_code == 0, result.output
+    assert 'Google image' in result.output
+
+
+def test_batch_search(http_server):
+    for idx in range(2):
+        http_server['folder'].join('{}.html'.format(idx)).write(
+            '<a href="/{0}.jpg">{0}</a>'.format(idx))
+    input_text = '\n'.join([
+        http_server['url'] + '0.html',
+        http_server['url'] + '1.html\t1\ta tag',
+        'ftp://example.com/1.html',
+        # same failed query on the same chunk
+        'ftp://example.com/1.html',
+    ])
+    result = CliRunner().invoke(cli, ['batch-search', '--mode', 'a tag'], input=input_text)
+    assert result.exit_code == 0, result.output
+    assert 'queries: 4, ok: 2, failed: 2, match results: 2' in result.output
+    # failed query don't leave empty search query record
+    assert {x.search_term for x in models.db.session.query(models.SearchQuery)} == {
+        http_server['url'] + '0.html', http_server['url'] + '1.html'}
+
+
+def test_backfill_url_info(cli_db):
+    create_match_results(cli_db)
+    cli_db.execute(models.Url.__table__.update().values(width=None, height=None, mimetype=None))
+    cli_db.commit()
+    result = invoke(cli_db, ['backfill-url-info', '--chunk-size', '2'])
+    assert 'urls: 3' in result.output
+    assert {
+        str(x.value): (x.width, x.height, x.mimetype)
+        for x in cli_db.query(models.Url)
+    } == {
+        'http://example.com/1.jpg': (640, 480, 'image/png'),
+        'http://t.example.com/1.jpg': (160, 120, None),
+        'http://example.com/2.jpg': (320, None, None),
+    }
+
+
+def test_rebuild_netlocs(cli_db):
+    create_match_results(cli_db)
+    cli_db.execute(models.Url.__table__.update().values(netloc_id=None))
+    cli_db.execute(models.Netloc.__table__.update().values(url_count=0))
+    cli_db.commit()
+    result = invoke(cli_db, ['rebuild-netlocs', '--chunk-size', '2'])
+    assert 'urls: 3, netlocs: 2' in result.output
+    assert {x.value: x.url_count for x in cli_db.query(models.Netloc)} == \
+        {'example.com': 2, 't.example.com': 1}
+    assert {str(x.value): x.netloc.value for x in cli_db.query(models.Url)} == {
+        'http://example.com/1.jpg': 'example.com',
+        'http://t.example.com/1.jpg': 't.example.com',
+        'http://example.com/2.jpg': 'example.com',
+    }
+
+
+def test_recount_tags(cli_db):
+    create_match_results(cli_db)
+    cli_db.execute(models.Namespace.__table__.update().values(tag_count=0))
+    cli_db.execute(models.Tag.__table__.update().values(url_count=0))
+    cli_db.commit()
+    result = invoke(cli_db, ['recount-tags'])
+    assert 'namespaces: 5, tags: 7' in result.output
+    assert cli_db.query(models.Namespace).filter_by(value='gi ow').one().tag_count == 2
+    assert cli_db.query(models.Tag).filter_by(value='red').one().url_count == 2
+    assert cli_db.query(models.Tag).filter_by(value='640').one().url_count == 1
+
+
+def test_upgrade_db():
+    result = CliRunner().invoke(cli, ['upgrade-db'])
+    assert result.exit_code == 0, result.output
+    assert 'columns: 0, indexes: 0, merged rows: 0' in result.output
+
+
+def test_migrate_response_bodies():
+    result = CliRunner().invoke(cli, ['migrate-response-bodies', '--vacuum'])
+    assert result.exit_code == 0, result.output
+    assert 'responses: 0' in result.output
+
+
+def test_clean_response_store():
+    result = CliRunner().invoke(cli, ['clean-response-store'])
+    assert result.exit_code == 0, result.output
+    assert 'removed: 0' in result.output
+
+
+def test_create_thumbnails(tmpdir, cli_db):
+    folder = tmpdir.mkdir('images')
+    Image.new('RGB', (500, 400), 'red').save(folder.join('1.jpg').strpath)
+    folder.join('1.txt').write('text')
+    thumb_folder = tmpdir.join('thumb')
+    result = invoke(cli_db, [
+        'create-thumbnails', folder.strpath, '--thumb-folder', thumb_folder.strpath,
+        '--max-workers', '1'])
+    assert 'images: 1, ok: 1, failed: 0' in result.output
+    # thumbnail is its own thumbnail
+    image_file = cli_db.query(models.ImageFile).filter(
+        models.ImageFile.thumbnail_id != models.ImageFile.id).one()
+    assert (image_file.width, image_file.height, image_file.img_format) == (500, 400, 'JPEG')
+    assert (image_file.thumbnail.width, image_file.thumbnail.height) == (256, 205)
+    assert cli_db.query(models.ImageFile).count() == 2
+    assert len(thumb_folder.listdir()) == 1
+
+
+def test_index_folder(tmpdir, cli_db):
+    folder = tmpdir.mkdir('images')
+    Image.new('RGB', (500, 400), 'red').save(folder.join('1.jpg').strpath)
+    folder.join('2.jpg').write('not image')
+    result = invoke(cli_db, ['index-folder', folder.strpath, '--max-workers', '1'])
+    assert 'files: 2, indexed: 1, failed: 1, removed: 0' in result.output
+    assert cli_db.query(models.ImageFilePath).filter(
+        models.ImageFilePath.error.isnot(None)).count() == 1
+    result = invoke(cli_db, ['index-folder', folder.strpath, '--max-workers', '1'])
+    assert 'files: 2, indexed: 0, failed: 0, removed: 0' in result.output
+    result = invoke(
+        cli_db, ['index-folder', folder.strpath, '--max-workers', '1', '--retry-failed'])
+    assert 'files: 2, indexed: 0, failed: 1, removed: 0' in result.output
+    path_m = cli_db.query(models.ImageFilePath).filter(
+        models.ImageFilePath.image_file_id.isnot(None)).one()
+    assert path_m.path == folder.join('1.jpg').strpath
+    assert (path_m.image_file.width, path_m.image_file.height) == (500, 400)
+    assert path_m.size == folder.join('1.jpg').size()
+    # path of removed file is removed
+    folder.join('1.jpg').remove()
+    result = invoke(cli_db, ['index-folder', folder.strpath, '--max-workers', '1'])
+    assert 'removed: 1' in result.output
+    assert cli_db.query(models.ImageFilePath).filter(
+        models.ImageFilePath.image_file_id.isnot(None)).count() == 0
+    assert cli_db.query(models.ImageFilePath).count() == 1
+
+
+def test_backfill_dhash(tmpdir):
+    result = CliRunner().invoke(cli, ['backfill-dhash', '--thumb-folder', tmpdir.strpath])
+    assert result.exit_code == 0, result.output
+    assert 'image files: ' in result.output
+
+
+def test_download(tmpdir):
+    result = CliRunner().invoke(cli, [
+        'download', '--search-term', 'no match result', '--folder', tmpdir.strpath])
+    assert result.exit_code == 0, result.output
+    assert 'urls: 0, downloaded: 0, skipped: 0, failed: 0' in result.output
+
+
+def test_worker():
+    result = CliRunner().invoke(cli, ['worker', '--burst'])
+    assert result.exit_code == 0, result.output
+    assert 'jobs: 0' in result.output
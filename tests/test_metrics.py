@@ -0,0 +1,100 @@
+"""Test metrics module."""
+import logging
+
+from gbooru_images_download import metrics, models, views
+from gbooru_images_download.__main__ import create_app
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter('test_rows_total', 'Rows.', ('table', )))
+    histogram = registry.register(metrics.Histogram(
+        'test_duration_seconds', 'Duration.', ('name', ), buckets=(0.1, 1)))
+    registry.register(metrics.GaugeFunc(
+        'test_size', 'Size.', ('pool', ), func=lambda: {('a"b', ): 2}))
+    counter.inc(3, table='url')
+    counter.inc(table='url')
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, name='x')
+    assert histogram.get(name='x') == (4, 5.65)
+    assert registry.render().splitlines() == [
+        '# HELP test_duration_seconds Duration.',
+        '# TYPE test_duration_seconds histogram',
+        'test_duration_seconds_bucket{name="x",le="0.1"} 2',
+        'test_duration_seconds_bucket{name="x",le="1.0"} 3',
+        'test_duration_seconds_bucket{name="x",le="+Inf"} 4',
+        'test_duration_seconds_sum{name="x"} 5.65',
+        'test_duration_seconds_count{name="x"} 4',
+        '# HELP test_rows_total Rows.',
+        '# TYPE test_rows_total counter',
+        'test_rows_total{table="url"} 4',
+        '# HELP test_size Size.',
+        '# TYPE test_size gauge',
+        'test_size{pool="a\\"b"} 2',
+    ]
+
+
+def test_metrics_endpoint(tmpdir, caplog):
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    app.config['SLOW_REQUEST_SECONDS'] = 0
+    models.db.session.remove()
+    session = models.db.session
+    app.extensions['admin'][0].add_view(views.MatchResultView(models.MatchResult, session))
+    app.extensions['admin'][0].add_view(views.UrlView(models.Url, session))
+    rows = metrics.INGEST_ROWS.get(table='url')
+    inserted_rows = metrics.INGEST_INSERTED_ROWS.get(table='url')
+    updated_rows = metrics.INGEST_UPDATED_ROWS.get(table='url')
+    models.bulk_create_match_results(session, [
+        ('http://example.com/{}.jpg'.format(x), ['http://example.com/t/{}.jpg'.format(x)], [])
+        for x in range(3)])
+    session.commit()
+    assert metrics.INGEST_ROWS.get(table='url') >= rows + 6
+    # url netloc update is not counted as inserted rows
+    assert metrics.INGEST_INSERTED_ROWS.get(table='url') == inserted_rows + 6
+    assert metrics.INGEST_UPDATED_ROWS.get(table='url') == updated_rows + 6
+    sql_count = metrics.SQL_DURATION.get(statement='SELECT')[0]
+    request_count = metrics.REQUEST_DURATION.get(
+        method='GET', endpoint='matchresult.index_view', status=200)[0]
+    formatter_count = metrics.FORMATTER_DURATION.get(view='matchresult', column='thumbnail')[0]
+    client = app.test_client()
+    with caplog.at_level(logging.WARNING, logger=metrics.__name__):
+        assert client.get('/matchresult/').status_code == 200
+    assert 'Slow request: GET /matchresult/' in caplog.text
+    assert metrics.REQUEST_DURATION.get(
+        method='GET', endpoint='matchresult.index_view', status=200)[0] == request_count + 1
+    assert metrics.SQL_DURATION.get(statement='SELECT')[0] > sql_count
+    assert metrics.FORMATTER_DURATION.get(
+        view='matchresult', column='thumbnail')[0] == formatter_count + 3
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.content_type == metrics.CONTENT_TYPE
+    text = resp.data.decode()
+    assert 'gbooru_http_request_duration_seconds_count{' \
+        'method="GET",endpoint="matchresult.index_view",status="200"}' in text
+    assert 'gbooru_http_request_sql_queries_count{endpoint="matchresult.index_view"}' in text
+    assert 'gbooru_ingest_rows_total{table="url"}' in text
+    assert 'gbooru_identity_cache{stat="hits"}' in text
+    assert 'gbooru_browser_pool{pool="render",stat="size"}' in text
+    assert 'gbooru_write_behind{stat="commits"}' in text
+
+
+def test_plugin_create_match_results(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    plugin = models.get_plugin_manager().getPluginByName('Google image', 'mode').plugin_object
+    assert plugin.name == 'Google image'
+    parse_count = metrics.PLUGIN_DURATION.get(plugin='Google image', stage='parse')[0]
+    ingest_count = metrics.PLUGIN_DURATION.get(plugin='Google image', stage='ingest')[0]
+
+    def iter_items():
+        for idx in range(3):
+            yield 'http://example.com/{}.jpg'.format(idx), [], [('gi id', str(idx))]
+
+    res = plugin.create_match_results(session, iter_items())
+    session.commit()
+    assert len(res) == 3
+    assert metrics.PLUGIN_DURATION.get(plugin='Google image', stage='parse')[0] == \
+        parse_count + 1
+    assert metrics.PLUGIN_DURATION.get(plugin='Google image', stage='ingest')[0] == \
+        ingest_count + 1
+    tmp_db.session.remove()
@@ -1,12 +1,15 @@
 """Test for models module."""
+from datetime import datetime
 from urllib.parse import urlparse, parse_qs
 import os
 
 from PIL import Image
+from sqlalchemy import create_engine, event, exc as sa_exc
 import pytest
 import vcr
 
-from gbooru_images_download import models
+from gbooru_images_download import fetch, imghash, models
+from gbooru_images_download.__main__ import create_app
 
 
 @pytest.fixture()
@@ -45,3 +48,575 @@ def tmp_pic(tmpdir):
             's8B_1ggosgLyAvgIKaArsyqIJ9conTehK4QjnjesNtMnGjDr2WYL3JwKke7gjGUtkou0VlOLR40JczbbhOx4-'
             'RDy03I_1kUV6WgCRiPqIUovom1AgBAwLEI6u_1ggaCgoICAESBM9Xj5QM&sa=X&'
             'ved=0ahUKEwi3o6zp3IrXAhUJahoKHfAKCekQ2A4IIygB'}
+
+
+def test_bulk_create_match_results(tmp_db):
+    session = tmp_db.session
+    dict_input = {
+        'url': {
+            'http://example.com/1.html': {
+                'thumbnail': ['http://example.com/1.jpg', 'http://example.com/1.png'],
+                'tag': [(None, 'tag1'), ('namespace1', 'tag2')],
+            },
+            'http://example.com/2.html': {
+                'thumbnail': [],
+                'tag': [('namespace1', 'tag2'), ('namespace2', 'tag2')],
+            },
+        },
+        'tag': [],
+    }
+    res = models.ModePlugin.match_results_models_from_dict(dict_input, session)
+    session.commit()
+    assert len(res) == 3
+    assert session.query(models.MatchResult).count() == 3
+    assert session.query(models.Url).count() == 4
+    assert session.query(models.Namespace).count() == 2
+    assert session.query(models.Tag).count() == 3
+    url_m = session.query(models.Url).filter_by(value='http://example.com/2.html').one()
+    assert sorted(x.as_string for x in url_m.tags) == ['namespace1:tag2', 'namespace2:tag2']
+    # run again, nothing new should be created
+    res2 = models.bulk_create_match_results(
+        session, models.iter_match_results_dict(dict_input), chunk_size=1)
+    session.commit()
+    assert [x.id for x in res] == [x.id for x in res2]
+    assert session.query(models.Tag).count() == 3
+    assert session.query(models.Url).count() == 4
+
+
+def test_get_or_insert_unique(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    nm_id = models.get_or_insert_ids(session, models.Namespace.value, ['unique namespace'])
+    nm_id = nm_id['unique namespace']
+    url_id = models.get_or_insert_ids(session, models.Url.value, ['http://example.com/u/1'])
+    url_id = url_id['http://example.com/u/1']
+    tag_ids = models.get_or_insert_tag_ids(session, [(nm_id, 'tag1'), (None, 'tag1')])
+    mr_ids = models.get_or_insert_match_result_ids(session, [(url_id, None)])
+    # other worker insert the same rows after the select
+    now = models.datetime.now()
+    assert models.insert_ignore(session, models.Tag.__table__, [
+        {'namespace_id': nm_id, 'value': 'tag1', 'created_at': now},
+        {'namespace_id': None, 'value': 'tag1', 'created_at': now},
+        {'namespace_id': None, 'value': 'tag2', 'created_at': now}]) == 1
+    assert models.insert_ignore(session, models.MatchResult.__table__, [
+        {'url_id': url_id, 'thumbnail_url_id': None, 'created_at': now}]) == 0
+    assert models.get_or_insert_tag_ids(session, list(tag_ids)) == tag_ids
+    assert models.get_or_insert_match_result_ids(session, [(url_id, None)]) == mr_ids
+    session.commit()
+    assert session.query(models.Tag).count() == 3
+    assert session.query(models.MatchResult).count() == 1
+    assert session.query(models.Namespace).get(nm_id).tag_count == 1
+    with pytest.raises(sa_exc.IntegrityError):
+        session.execute(models.Tag.__table__.insert(), [{'namespace_id': None, 'value': 'tag2'}])
+    session.rollback()
+
+
+def test_url_info(tmp_db):
+    session = tmp_db.session
+    items = [
+        ('http://example.com/info/1.jpg', ['http://example.com/info/t1.jpg'], [
+            ('gi ow', '1920'), ('gi oh', '1080'), ('gi ity', 'jpg'),
+            ('gi tw', '160'), ('gi th', '90')]),
+        ('http://example.com/info/2.png', [], [('gi ow', '2560'), ('gi ity', 'png')]),
+        ('http://example.com/info/3.gif', [], [('width', 'x')]),
+    ]
+    models.bulk_create_match_results(session, items)
+    session.commit()
+
+    def get_info():
+        return {
+            str(x.value): (x.width, x.height, x.mimetype) for x in session.query(models.Url)
+            .filter(models.Url.value.startswith('http://example.com/info/'))}
+
+    exp_info = {
+        'http://example.com/info/1.jpg': (1920, 1080, 'image/jpeg'),
+        'http://example.com/info/t1.jpg': (160, 90, None),
+        'http://example.com/info/2.png': (2560, None, 'image/png'),
+        'http://example.com/info/3.gif': (None, None, None),
+    }
+    assert get_info() == exp_info
+    wide_urls = session.query(models.Url.value).join(
+        models.MatchResult, models.MatchResult.url_id == models.Url.id
+    ).filter(models.Url.width > 1920).all()
+    assert [str(x[0]) for x in wide_urls] == ['http://example.com/info/2.png']
+    # clear the columns and fill it again from url tags
+    session.query(models.Url).update(
+        {'width': None, 'height': None, 'mimetype': None}, synchronize_session='fetch')
+    session.commit()
+    assert sum(models.backfill_url_info(session, chunk_size=2)) == \
+        session.query(models.Url).count()
+    session.commit()
+    assert get_info() == exp_info
+
+
+def test_netloc(tmp_db):
+    session = tmp_db.session
+
+    def get_counts():
+        return {
+            x.value: x.url_count for x in session.query(models.Netloc)
+            .filter(models.Netloc.value.endswith('netloc.example.com'))}
+
+    url_m = models.get_or_create(session, models.Url, value='http://a.netloc.example.com/1')[0]
+    session.commit()
+    assert url_m.netloc.value == 'a.netloc.example.com'
+    items = [
+        ('http://a.netloc.example.com/1', ['http://b.netloc.example.com/1'], []),
+        ('http://a.netloc.example.com/2', [], []),
+    ]
+    models.bulk_create_match_results(session, items)
+    session.commit()
+    exp_counts = {'a.netloc.example.com': 2, 'b.netloc.example.com': 1}
+    assert get_counts() == exp_counts
+    assert url_m.netloc.urls.count() == 2
+    # break the counter and rebuild it
+    session.query(models.Netloc).update({'url_count': 0})
+    session.query(models.Url).update({'netloc_id': None})
+    session.commit()
+    assert sum(models.rebuild_netlocs(session, chunk_size=2)) == \
+        session.query(models.Url).count()
+    session.commit()
+    assert get_counts() == exp_counts
+    # changed and deleted url
+    url_m.value = 'http://c.netloc.example.com/1'
+    session.commit()
+    assert url_m.netloc.value == 'c.netloc.example.com'
+    exp_counts = {'a.netloc.example.com': 1, 'b.netloc.example.com': 1, 'c.netloc.example.com': 1}
+    assert get_counts() == exp_counts
+    url_m.netloc = session.query(models.Netloc).filter_by(value='b.netloc.example.com').one()
+    session.commit()
+    exp_counts = {'a.netloc.example.com': 1, 'b.netloc.example.com': 2, 'c.netloc.example.com': 0}
+    assert get_counts() == exp_counts
+    session.delete(url_m)
+    session.commit()
+    exp_counts['b.netloc.example.com'] = 1
+    assert get_counts() == exp_counts
+
+
+def test_tag_counters(tmp_db):
+    session = tmp_db.session
+    # orm path
+    nm_m = models.get_or_create(session, models.Namespace, value='counter namespace')[0]
+    tag_m = models.Tag(value='counter tag 1', namespace=nm_m)
+    session.add(tag_m)
+    url_m = models.get_or_create(session, models.Url, value='http://example.com/counter/1')[0]
+    url_m.tags.append(tag_m)
+    session.commit()
+    assert (nm_m.tag_count, tag_m.url_count) == (1, 1)
+    # bulk path, existing url tag is not counted again
+    items = [
+        ('http://example.com/counter/1', [], [
+            ('counter namespace', 'counter tag 1'), ('counter namespace', 'counter tag 2')]),
+        ('http://example.com/counter/2', [], [('counter namespace', 'counter tag 1')]),
+    ]
+    models.bulk_create_match_results(session, items)
+    models.bulk_create_match_results(session, items)
+    session.commit()
+
+    def get_counts():
+        return nm_m.tag_count, {x.value: x.url_count for x in nm_m.tags}
+
+    exp_counts = (2, {'counter tag 1': 2, 'counter tag 2': 1})
+    assert get_counts() == exp_counts
+    url_m.tags.remove(tag_m)
+    session.commit()
+    assert tag_m.url_count == 1
+    url_m.tags.append(tag_m)
+    session.commit()
+    # break the counter and count again
+    session.query(models.Namespace).update({'tag_count': 0})
+    session.query(models.Tag).update({'url_count': 0})
+    session.commit()
+    models.recount_tags(session)
+    session.commit()
+    assert get_counts() == exp_counts
+    most_used = session.query(models.Tag.value).filter(models.Tag.namespace == nm_m) \
+        .order_by(models.Tag.url_count.desc()).first()
+    assert most_used[0] == 'counter tag 1'
+    # namespace change
+    other_nm = models.get_or_create(session, models.Namespace, value='other namespace')[0]
+    tag_m.namespace = other_nm
+    session.commit()
+    assert (nm_m.tag_count, other_nm.tag_count) == (1, 1)
+    tag_m.namespace_id = None
+    session.commit()
+    assert (nm_m.tag_count, other_nm.tag_count) == (1, 0)
+    tag_m.namespace_id = nm_m.id
+    session.commit()
+    assert get_counts() == exp_counts
+    # url deletion
+    session.delete(url_m)
+    session.commit()
+    assert get_counts() == (2, {'counter tag 1': 1, 'counter tag 2': 0})
+
+
+def test_find_near_duplicates(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    base = 0x0f0f0f0f0f0f0f0f
+    for idx, value in enumerate((base, base ^ 0b1, base ^ 0b111, ~base & ((1 << 64) - 1))):
+        session.add(models.ImageFile(
+            checksum='dhash{}'.format(idx), dhash=imghash.to_signed(value)))
+    session.add(models.ImageFile(checksum='no dhash'))
+    session.commit()
+
+    def find(value, max_distance=2):
+        return [(distance, x.checksum) for distance, x in models.find_near_duplicates(
+            session, models.ImageFile.dhash, value, max_distance)]
+
+    assert find(base) == [(0, 'dhash0'), (1, 'dhash1')]
+    assert find(imghash.to_signed(base ^ 0b11)) == [(1, 'dhash1'), (1, 'dhash2'), (2, 'dhash0')]
+    # new record and hash of existing record
+    session.add(models.ImageFile(checksum='dhash4', dhash=base ^ 0b10))
+    session.query(models.ImageFile).filter_by(checksum='no dhash').update({'dhash': base})
+    session.commit()
+    assert find(base, 0) == [(0, 'dhash0'), (0, 'no dhash')]
+    assert [x[1] for x in find(base, 1)] == ['dhash0', 'no dhash', 'dhash1', 'dhash4']
+    session.query(models.ImageFile).filter_by(checksum='dhash0').delete()
+    session.commit()
+    assert find(base, 0) == [(0, 'no dhash')]
+    # hash of existing record changed with orm
+    img_file = session.query(models.ImageFile).filter_by(checksum='dhash3').one()
+    img_file.dhash = imghash.to_signed(base)
+    session.commit()
+    assert find(base, 0) == [(0, 'dhash3'), (0, 'no dhash')]
+    # unchanged tree only query the new record
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(tmp_db.engine, 'before_cursor_execute', count_statement)
+    try:
+        models.dhash_index.get_tree(session, models.ImageFile.dhash)
+    finally:
+        event.remove(tmp_db.engine, 'before_cursor_execute', count_statement)
+    assert len(statements) == 1
+    assert 'count' not in statements[0].lower()
+
+
+def test_get_or_create_identity_cache(tmp_db):
+    session = tmp_db.session
+    nm_m = models.get_or_create(session, models.Namespace, value='cache namespace')[0]
+    session.commit()
+    models.identity_cache.clear()
+    stats = models.identity_cache.stats()
+    assert models.get_or_create(session, models.Namespace, value='cache namespace') == \
+        (nm_m, False)
+    assert models.identity_cache.stats()['misses'] == stats['misses'] + 1
+    assert models.get_or_create(session, models.Namespace, value='cache namespace') == \
+        (nm_m, False)
+    assert models.identity_cache.stats()['hits'] == stats['hits'] + 1
+    tag_m = models.get_or_create(session, models.Tag, value='cache tag', namespace=nm_m)[0]
+    session.commit()
+    assert models.get_or_create(
+        session, models.Tag, value='cache tag', namespace=nm_m)[0] == tag_m
+    assert models.identity_cache.stats()['size'] == 2
+    session.commit()
+    # only key added on the rolled back transaction is removed
+    models.get_or_create(session, models.Namespace, value='rolled back namespace')
+    session.flush()
+    assert models.get_or_create(session, models.Namespace, value='rolled back namespace')[1] \
+        is False
+    assert models.identity_cache.stats()['size'] == 3
+    session.rollback()
+    assert models.identity_cache.stats()['size'] == 2
+    assert models.get_or_create(
+        session, models.Namespace, value='rolled back namespace')[1] is True
+    session.rollback()
+
+
+def test_identity_cache_select_count(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    values = ['http://example.com/cache/{}'.format(x) for x in range(5)]
+    for value in values:
+        models.get_or_create(session, models.Url, value=value)
+    session.commit()
+    models.identity_cache.clear()
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(tmp_db.engine, 'before_cursor_execute', count_statement)
+    try:
+        for _ in range(3):
+            for value in values:
+                models.get_or_create(session, models.Url, value=value)
+        # only the first lookup of every key query the database
+        assert len(statements) == len(values)
+        session.commit()
+        del statements[:]
+        for value in values:
+            models.get_or_create(session, models.Url, value=value)
+        # expired instance is loaded by primary key
+        assert len(statements) == len(values)
+        assert all('WHERE url.id = ?' in x for x in statements)
+    finally:
+        event.remove(tmp_db.engine, 'before_cursor_execute', count_statement)
+
+
+def test_get_or_insert_ids_identity_cache(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    models.identity_cache.clear()
+    values = ['http://example.com/bulk/{}'.format(x) for x in range(5)]
+    ids = models.get_or_insert_ids(session, models.Url.value, values)
+    session.commit()
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(tmp_db.engine, 'before_cursor_execute', count_statement)
+    try:
+        # id of committed record is taken from the cache without query on the next chunk
+        assert models.get_or_insert_ids(session, models.Url.value, values) == ids
+        assert statements == []
+        new_value = 'http://example.com/bulk/new'
+        res = models.get_or_insert_ids(session, models.Url.value, values + [new_value])
+        assert len(res) == 6 and len(statements) == 2
+    finally:
+        event.remove(tmp_db.engine, 'before_cursor_execute', count_statement)
+    # id of rolled back record is removed
+    session.rollback()
+    del statements[:]
+    assert models.identity_cache.get_ids(
+        session, models.Url, 'value', values + [new_value]) == ids
+
+
+def test_identity_cache_deleted(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    tag_m = models.get_or_create(session, models.Tag, value='deleted tag')[0]
+    session.commit()
+    tag_id = tag_m.id
+    assert models.get_or_create(session, models.Tag, value='deleted tag') == (tag_m, False)
+    # primary key of the last row is reused by sqlite
+    session.query(models.Tag).filter_by(id=tag_id).delete()
+    session.add(models.Tag(id=tag_id, value='other tag'))
+    session.commit()
+    instance, created = models.get_or_create(session, models.Tag, value='deleted tag')
+    assert created and instance.value == 'deleted tag'
+    session.rollback()
+    # record deleted from other process
+    models.get_or_create(session, models.Tag, value='other tag')
+    session.execute(models.Tag.__table__.update().values(value='renamed tag'))
+    session.commit()
+    assert models.get_or_create(session, models.Tag, value='other tag')[1]
+    session.rollback()
+    url_m = models.get_or_create(session, models.Url, value='http://example.com/deleted')[0]
+    session.commit()
+    session.delete(url_m)
+    session.commit()
+    assert models.identity_cache.get_ids(
+        session, models.Url, 'value', ['http://example.com/deleted']) == {}
+
+
+def test_upgrade_schema(tmpdir, caplog):
+    db_uri = 'sqlite:///' + tmpdir.join('old.db').strpath
+    engine = create_engine(db_uri)
+    # tables of old version, without counter columns and unique index
+    for stmt in [
+        'CREATE TABLE namespace (id INTEGER PRIMARY KEY, created_at TIMESTAMP NOT NULL, '
+        'value VARCHAR NOT NULL UNIQUE, alias VARCHAR, hidden BOOLEAN)',
+        'CREATE TABLE tag (id INTEGER PRIMARY KEY, created_at TIMESTAMP NOT NULL, '
+        'value VARCHAR, namespace_id INTEGER REFERENCES namespace (id), alias VARCHAR, '
+        'hidden BOOLEAN)',
+        'CREATE TABLE url (id INTEGER PRIMARY KEY, created_at TIMESTAMP NOT NULL, '
+        'value VARCHAR NOT NULL UNIQUE)',
+        'CREATE TABLE url_tags (url_id INTEGER NOT NULL REFERENCES url (id), '
+        'tag_id INTEGER NOT NULL REFERENCES tag (id), PRIMARY KEY (url_id, tag_id))',
+        "INSERT INTO namespace VALUES (1, '2018-01-01 00:00:00', 'n', NULL, 0)",
+        "INSERT INTO tag VALUES (1, '2018-01-01 00:00:00', 'a', 1, NULL, 0)",
+        "INSERT INTO tag VALUES (2, '2018-01-01 00:00:00', 'a', 1, NULL, 0)",
+        "INSERT INTO tag VALUES (3, '2018-01-01 00:00:00', 'b', NULL, NULL, 0)",
+        "INSERT INTO tag VALUES (4, '2018-01-01 00:00:00', 'b', NULL, NULL, 0)",
+        "INSERT INTO url VALUES (1, '2018-01-01 00:00:00', 'http://example.com/1.jpg')",
+        'INSERT INTO url_tags VALUES (1, 1), (1, 2), (1, 4)',
+    ]:
+        engine.execute(stmt)
+    engine.dispose()
+    create_app(db_uri)
+    assert 'Database schema is outdated' in caplog.text
+    assert 'tag.url_count' in caplog.text
+    models.db.session.remove()
+    session = models.db.session
+    columns, indexes, merged = models.upgrade_schema(session)
+    models.recount_tags(session)
+    session.commit()
+    assert {str(x) for x in columns} >= {
+        'namespace.tag_count', 'tag.url_count', 'url.netloc_id', 'url.width'}
+    assert {x.name for x in indexes} >= {'uq_tag_namespace_id_value', 'ix_tag_url_count'}
+    assert merged == 2
+    assert models.get_missing_schema(session.connection()) == ([], [])
+    assert [(x.id, x.url_count) for x in session.query(models.Tag).order_by(models.Tag.id)] \
+        == [(1, 1), (3, 1)]
+    assert session.query(models.Namespace).one().tag_count == 1
+    assert sorted(session.query(models.url_tags)) == [(1, 1), (1, 3)]
+    assert models.insert_ignore(session, models.Tag.__table__, [
+        {'value': 'a', 'namespace_id': 1, 'created_at': datetime.now(), 'url_count': 0},
+        {'value': 'b', 'namespace_id': None, 'created_at': datetime.now(), 'url_count': 0},
+    ]) == 0
+    # upgraded database is not changed again
+    assert models.upgrade_schema(session) == ([], [], 0)
+    session.rollback()
+    models.db.session.remove()
+
+
+def test_migrate_response_bodies(tmp_db, tmp_response_folder):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    url_m = models.get_or_create(session, models.Url, value='http://example.com/1.json')[0]
+    # old record with the body on the database
+    responses = [
+        models.Response(
+            url=url_m, method='get', status_code=200, text_inline='{"a": 1}',
+            json_inline={'a': 1}),
+        models.Response(
+            url=url_m, method='get', status_code=200, text_inline='\u00e9\ufffd',
+            encoding='ISO-8859-1'),
+        models.Response(url=url_m, method='get', status_code=200, text_inline='{"a": 1}'),
+    ]
+    session.add_all(responses)
+    session.commit()
+    assert list(models.migrate_response_bodies(session, chunk_size=2)) == [2, 1]
+    session.commit()
+    session.expire_all()
+    assert [x.text_inline for x in responses] == [None] * 3
+    assert [(x.text, x.json) for x in responses] == [
+        ('{"a": 1}', {'a': 1}), ('\u00e9\ufffd', None), ('{"a": 1}', {'a': 1})]
+    assert responses[0].json_inline is None
+    assert responses[1].encoding == 'utf-8'
+    assert responses[0].text_digest == responses[2].text_digest
+    assert list(models.migrate_response_bodies(session)) == []
+    # body is removed after every response which use it is deleted
+    store = models.get_response_store()
+    digests = [x.text_digest for x in responses[:2]]
+    session.delete(responses[0])
+    session.delete(responses[1])
+    session.commit()
+    assert models.remove_unused_response_blobs(session) == 0
+    assert models.remove_unused_response_blobs(session, min_age=0) == 1
+    assert digests[0] in store
+    assert digests[1] not in store
+    session.delete(responses[2])
+    session.commit()
+    assert models.remove_unused_response_blobs(session, min_age=0) == 1
+    assert tmp_response_folder.listdir()[0].listdir() == []
+
+
+def test_get_plugin_manager():
+    manager = models.get_plugin_manager()
+    assert manager is models.get_plugin_manager()
+    assert manager.getPluginByName('Google image', 'mode')
+    reloaded_manager = models.get_plugin_manager(reload=True)
+    assert reloaded_manager is not manager
+    assert reloaded_manager is models.get_plugin_manager()
+
+
+def test_response_create_many(tmp_db, http_server):
+    session = tmp_db.session
+    for idx in range(3):
+        http_server['folder'].join('{}.html'.format(idx)).write(
+            '<a href="/{0}.jpg">{0}</a>'.format(idx))
+    urls = [http_server['url'] + '{}.html'.format(x) for x in range(3)]
+    urls.append('ftp://example.com/1.html')
+    res = models.Response.create_many(urls, 'get', session, per_host_limit=2)
+    assert [x[0].text for x in res[:3]] == \
+        ['<a href="/{0}.jpg">{0}</a>'.format(x) for x in range(3)]
+    assert all(x[0].status_code == 200 for x in res[:3])
+    assert all(x[0].text_inline is None and x[0].text_size == 22 for x in res[:3])
+    assert b''.join(res[0][0].iter_content()) == b'<a href="/0.jpg">0</a>'
+    assert res[3] == (False, None)
+    plugin = models.get_plugin_manager().getPluginByName('a tag', 'mode').plugin_object
+    mrs = plugin.get_match_results_many([(x, 1) for x in urls[:2]], session)
+    assert [[str(y.url.value) for y in x] for x in mrs] == \
+        [[http_server['url'] + '{}.jpg'.format(x)] for x in range(2)]
+
+
+def test_response_create_cache(tmp_db, http_server, monkeypatch):
+    monkeypatch.setattr(fetch, 'scheduler', fetch.HostScheduler())
+    session = tmp_db.session
+    http_server['folder'].join('cache.html').write('<a href="/1.jpg">1</a>')
+    url = http_server['url'] + 'cache.html'
+    model = models.Response.create(url, 'get', session)
+    assert model.status_code == 200
+    assert model.get_conditional_headers()['If-Modified-Since']
+    # fresh record is used without request
+    cached_model, resp = models.Response.create(
+        url, 'get', session, cache_ttl=60, return_response=True)
+    assert cached_model == model
+    assert resp.html.absolute_links == {http_server['url'] + '1.jpg'}
+    # stale record is revalidated
+    revalidated_model = models.Response.create(url, 'get', session, cache_ttl=0)
+    assert revalidated_model != model
+    assert revalidated_model.status_code == 304
+    assert revalidated_model.text_digest == model.text_digest
+    assert revalidated_model.text == '<a href="/1.jpg">1</a>'
+    res = models.Response.create_many([url], 'get', session, cache_ttl=60)
+    assert res[0][0] == revalidated_model
+    assert models.Response.create(url, 'get', session, use_cache=False).status_code == 200
+    # unusual traffic page is not saved
+    unusual_url = http_server['url'] + 'unusual.html'
+    http_server['folder'].join('unusual.html').write_binary(
+        b'<html>' + fetch.UNUSUAL_TRAFFIC_TEXT + b'</html>')
+    assert models.Response.create(unusual_url, 'get', session, max_retries=0) is False
+    assert not session.query(models.Response).join(
+        models.Url, models.Response.url_id == models.Url.id
+    ).filter(models.Url.value == unusual_url).count()
+    # and the one saved before it is checked is not used
+    latest = models.Response.get_latest(url, 'get', session)
+    throttled_model = models.Response(
+        url=latest.url, method='get', status_code=200,
+        headers={'content-type': ('Content-Type', 'text/html')})
+    throttled_model.set_content(b'<html>' + fetch.UNUSUAL_TRAFFIC_TEXT + b'</html>')
+    session.add(throttled_model)
+    session.commit()
+    assert models.Response.get_latest(url, 'get', session) == latest
+
+
+@pytest.mark.parametrize('count', [1, 10])
+def test_match_result_view_query_count(tmp_db, count):
+    from gbooru_images_download import views
+    tmp_db.session.remove()
+    session = tmp_db.session
+    items = [(
+        'http://example.com/view/{}.jpg'.format(idx),
+        ['http://example.com/view/thumb/{}.jpg'.format(idx)],
+        [('width', str(idx)), ('height', '2'), ('', 'tag{}'.format(idx))],
+    ) for idx in range(count)]
+    models.bulk_create_match_results(session, items)
+    session.commit()
+    session.expunge_all()
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args)
+
+    event.listen(tmp_db.engine, 'before_cursor_execute', count_statement)
+    try:
+        view = views.MatchResultView(models.MatchResult, session)
+        _, res = view.get_list(0, None, None, None, [])
+        assert len(res) == count
+        assert {(x.url.width, x.url.height) for x in res} == {(x, 2) for x in range(count)}
+        assert all(x.thumbnail_url.value for x in res)
+        # count, match result, url and thumbnail url
+        assert len(statements) == 4
+    finally:
+        event.remove(tmp_db.engine, 'before_cursor_execute', count_statement)
+
+
+def test_set_sqlite_pragmas(tmpdir):
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    with app.app_context():
+        conn = models.db.engine.connect()
+        try:
+            assert conn.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert conn.execute('PRAGMA synchronous').scalar() == 1
+            assert conn.execute('PRAGMA busy_timeout').scalar() == 30000
+        finally:
+            conn.close()
@@ -0,0 +1,91 @@
+"""Test for plugin module."""
+import html
+import json
+import os
+
+from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+import pytest
+
+from gbooru_images_download import api
+from gbooru_images_download.plugin import mode_a_tag, mode_google_image
+
+
+CORPUS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'corpus')
+
+
+@pytest.fixture()
+def google_image_text():
+    """Google image page text."""
+    boxes = []
+    for idx in range(3):
+        rg_meta = {
+            'ou': 'http://example.com/{}.jpg'.format(idx % 2),
+            'tu': 'http://example.com/thumb/{}.jpg'.format(idx),
+            'ow': 100 + idx, 'oh': 200, 'pt': 'title <b>{}</b> & "quote"'.format(idx),
+            'ity': '',
+        }
+        boxes.append(
+            '<div class="rg_bx rg_di"><a href="/imgres?x={0}">'
+            '<img src="/thumb/{0}.jpg"></a>'
+            '<div class="rg_meta notranslate">{1}</div></div>'.format(
+                idx, html.escape(json.dumps(rg_meta))))
+    return '<html><head><style>.a{{}}</style></head><body>{}</body></html>'.format(
+        ''.join(boxes))
+
+
+def test_google_image_get_match_results_dict(google_image_text):
+    res = mode_google_image.ModePlugin.get_match_results_dict(text=google_image_text)
+    assert list(res['url']) == ['http://example.com/0.jpg', 'http://example.com/1.jpg']
+    assert res['url']['http://example.com/0.jpg']['thumbnail'] == \
+        ['http://example.com/thumb/0.jpg', 'http://example.com/thumb/2.jpg']
+    # same result as parsing the html tree
+    soup = BeautifulSoup(google_image_text, 'html.parser')
+    rg_meta_list = [json.loads(x.text) for x in soup.select('.rg_bx div.rg_meta')]
+    assert list(mode_google_image.iter_rg_meta(google_image_text)) == rg_meta_list
+    assert ('gi pt', 'title <b>1</b> & "quote"') in \
+        res['url']['http://example.com/1.jpg']['tag']
+    assert ('gi ity', '') not in res['url']['http://example.com/1.jpg']['tag']
+
+
+def test_a_tag_get_match_results_dict_html_parser(monkeypatch):
+    text = \
+        '<p>text<a class="c1 c2" href="/1.html">1</a>' \
+        '<a href="http://example.com/2.html" target="_blank" title="t">2</a></p>'
+    res = mode_a_tag.ModePlugin.get_match_results_dict(text=text, url='http://example.com')
+    assert res['url'] == {
+        'http://example.com/1.html': {
+            'thumbnail': [], 'tag': [('a tag class', 'c1'), ('a tag class', 'c2')]},
+        'http://example.com/2.html': {'thumbnail': [], 'tag': [('a tag title', 't')]},
+    }
+    monkeypatch.setattr(api, 'get_default_html_parser', lambda: 'html.parser')
+    assert api.get_html_parser() == 'html.parser'
+    assert res == \
+        mode_a_tag.ModePlugin.get_match_results_dict(text=text, url='http://example.com')
+
+
+def test_html_parsers_same_result(monkeypatch):
+    if not builder_registry.lookup('lxml'):
+        pytest.skip('lxml is not installed')
+
+    def read_corpus(name):
+        with open(os.path.join(CORPUS_FOLDER, name)) as f:
+            return f.read()
+
+    res = {}
+    for features in ('lxml', 'html.parser'):
+        monkeypatch.setattr(api, 'get_html_parser', lambda: features)
+        res[features] = (
+            mode_google_image.ModePlugin.get_match_results_dict(
+                text=read_corpus('google_image.html')),
+            mode_a_tag.ModePlugin.get_match_results_dict(
+                text=read_corpus('a_tag.html'), url='https://example.com/gallery/'),
+            api.parse_img_search_html(api.get_soup(read_corpus('img_search.html'))),
+        )
+    assert all(x['url'] for x in res['lxml'][:2])
+    assert res['lxml'][2]['TextMatch']
+    assert res['lxml'] == res['html.parser']
+
+
+def test_get_soup_features():
+    assert str(api.get_soup('<p>1</p>', features='html.parser')) == '<p>1</p>'
@@ -1,13 +1,15 @@
 """Test server."""
+import json
 import logging
 import os
 import tempfile
 import unittest
 
+from sqlalchemy import event
 import pytest
 import vcr
 
-from gbooru_images_download import models
+from gbooru_images_download import ajax, filters, models, views
 from gbooru_images_download.__main__ import create_app
 
 
@@ -46,5 +48,138 @@ class ServerTestCase(unittest.TestCase):
         assert retval.data.decode()
 
 
+def test_ajax_lookup(tmpdir):
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    app.config['WTF_CSRF_ENABLED'] = False
+    models.db.session.remove()
+    session = models.db.session
+    admin = app.extensions['admin'][0]
+    admin.add_view(views.MatchResultView(models.MatchResult, session))
+    url_view = views.UrlView(models.Url, session)
+    admin.add_view(url_view)
+    admin.add_view(views.ResponseView(models.Response, session))
+    items = [('http://example.com/ajax/{}.jpg'.format(idx), [], [
+        ('ajax namespace', 'ajax tag {}'.format(idx)), ('', 'other tag {}'.format(idx))
+    ]) for idx in range(60)]
+    models.bulk_create_match_results(session, items)
+    session.commit()
+    client = app.test_client()
+    resp = client.get('/url/ajax/lookup/?name=tags&query=ajax+tag+1&limit=10')
+    assert resp.status_code == 200
+    data = json.loads(resp.data.decode())
+    assert sorted(x[1] for x in data)[:2] == \
+        ['ajax namespace:ajax tag 1', 'ajax namespace:ajax tag 10']
+    assert len(data) == 10
+    # limit is bounded
+    resp = client.get('/url/ajax/lookup/?name=tags&query=ajax&limit=1000')
+    assert len(json.loads(resp.data.decode())) == ajax.MAX_PAGE_SIZE
+    tag_m = session.query(models.Tag).filter_by(value='ajax tag 3').one()
+    flt_idx = [isinstance(x, filters.TagFilter) for x in url_view._filters].index(True)
+    resp = client.get('/url/?flt0_{}={}'.format(flt_idx, tag_m.id))
+    assert resp.status_code == 200
+    assert 'http://example.com/ajax/3.jpg' in resp.data.decode()
+    assert 'http://example.com/ajax/4.jpg' not in resp.data.decode()
+    assert 'ajax-lookup:tags' in resp.data.decode()
+    assert client.get('/matchresult/').status_code == 200
+    assert client.get('/response/parser').status_code == 200
+    url_m = session.query(models.Url).filter_by(value='http://example.com/ajax/3.jpg').one()
+    resp_m = models.Response(url=url_m, method='get', status_code=200)
+    session.add(resp_m)
+    session.commit()
+    resp = client.get('/response/parser?id={}'.format(resp_m.id))
+    assert resp.status_code == 200
+    assert 'id:{} url:http://example.com/ajax/3.jpg'.format(resp_m.id) in resp.data.decode()
+    resp = client.get('/response/ajax/lookup/?name=response&query=http://example.com/ajax/')
+    assert json.loads(resp.data.decode()) == \
+        [[resp_m.id, 'id:{} url:http://example.com/ajax/3.jpg'.format(resp_m.id)]]
+
+
 if __name__ == '__main__':
     unittest.main()
+
+
+def test_near_duplicates_view(tmpdir):
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    models.db.session.remove()
+    session = models.db.session
+    admin = app.extensions['admin'][0]
+    admin.add_view(views.ImageFileView(models.ImageFile, session))
+    admin.add_view(views.UrlView(models.Url, session))
+    img_file = models.ImageFile(checksum='near1', dhash=0b1111)
+    session.add_all([
+        img_file, models.ImageFile(checksum='near2', dhash=0b1110),
+        models.ImageFile(checksum='far', dhash=-1),
+        models.Url(value='http://example.com/near.jpg', dhash=0b0111),
+    ])
+    session.commit()
+    client = app.test_client()
+    resp = client.get('/imagefile/near-duplicates?id={}&max_distance=2'.format(img_file.id))
+    assert resp.status_code == 200
+    data = resp.data.decode()
+    assert 'near2' in data
+    assert 'http://example.com/near.jpg' in data
+    assert 'far' not in data
+    resp = client.get('/imagefile/')
+    assert resp.status_code == 200
+    assert '/imagefile/near-duplicates?id={}'.format(img_file.id) in resp.data.decode()
+
+
+def test_list_views_query_count(tmpdir):
+    app = create_app('sqlite:///' + tmpdir.join('temp.db').strpath)
+    app.config['WTF_CSRF_ENABLED'] = False
+    models.db.session.remove()
+    session = models.db.session
+    admin = app.extensions['admin'][0]
+    for view_cls, model in (
+            (views.MatchResultView, models.MatchResult), (views.TagView, models.Tag),
+            (views.SearchQueryView, models.SearchQuery), (views.ResponseView, models.Response),
+            (views.UrlView, models.Url)):
+        admin.add_view(view_cls(model, session))
+    client = app.test_client()
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args)
+
+    def add_rows(start, stop):
+        for idx in range(start, stop):
+            mr_m = models.bulk_create_match_results(session, [(
+                'http://example.com/list/{}.jpg'.format(idx),
+                ['http://example.com/list/thumb/{}.jpg'.format(idx)],
+                [('list namespace', 'tag {}'.format(idx))])])[0]
+            session.add(models.SearchQuery(
+                search_term='list {}'.format(idx), match_results=[mr_m]))
+            session.add(models.Response(
+                url=mr_m.url, final_url=mr_m.thumbnail_url, method='get', status_code=200,
+                headers={'content-type': ('Content-Type', 'image/jpeg')}))
+        session.commit()
+        session.expunge_all()
+
+    def get_statement_counts():
+        counts = {}
+        event.listen(models.db.engine, 'before_cursor_execute', count_statement)
+        try:
+            for path in ('matchresult', 'tag', 'searchquery', 'response', 'url'):
+                del statements[:]
+                resp = client.get('/{}/'.format(path))
+                assert resp.status_code == 200, path
+                counts[path] = len(statements)
+        finally:
+            event.remove(models.db.engine, 'before_cursor_execute', count_statement)
+        return counts
+
+    add_rows(0, 1)
+    counts = get_statement_counts()
+    add_rows(1, 10)
+    # number of query don't depend on the number of rows
+    assert get_statement_counts() == counts
+    assert 'image/jpeg' in client.get('/url/').data.decode()
+    assert 'search_term_equals=list+0&flt1_search_query_page_equals=1">1</a>' in \
+        client.get('/searchquery/').data.decode()
+    # list rows are loaded with raiseload, new request get new session like in server
+    session.remove()
+    # delete action use the same query as the list
+    ids = [x[0] for x in session.query(models.MatchResult.id).limit(3)]
+    resp = client.post('/matchresult/action/', data={'action': 'delete', 'rowid': ids})
+    assert resp.status_code == 302
+    assert session.query(models.MatchResult).count() == 7
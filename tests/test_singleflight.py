@@ -0,0 +1,180 @@
+"""Test for singleflight module."""
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from gbooru_images_download import models, singleflight
+
+
+def test_key_lock(tmpdir):
+    key_lock = singleflight.KeyLock(tmpdir.strpath)
+    events = []
+    waited = []
+
+    def work(key, name):
+        with key_lock.lock(key) as item:
+            waited.append((name, item))
+            events.append(('start', name))
+            time.sleep(0.05)
+            events.append(('end', name))
+
+    threads = [threading.Thread(target=work, args=('a', x)) for x in range(3)]
+    threads.append(threading.Thread(target=work, args=('b', 3)))
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    # same key run one at a time, other key run concurrently
+    a_events = [x for x in events if x[1] != 3]
+    assert a_events == [(x, y) for y in (0, 1, 2) for x in ('start', 'end')]
+    assert events.index(('start', 3)) < events.index(('end', 0))
+    assert sorted(waited) == [(0, False), (1, True), (2, True), (3, False)]
+    assert key_lock._entries == {}
+    with key_lock.lock('a'):
+        assert not lock_in_thread(key_lock, 'a', timeout=0.01)
+
+
+def lock_in_thread(key_lock, key, timeout):
+    """Try to lock key from other thread, return False on timeout."""
+    res = []
+
+    def work():
+        try:
+            with key_lock.lock(key, timeout=timeout):
+                res.append(True)
+        except TimeoutError:
+            res.append(False)
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    return res[0]
+
+
+def test_key_lock_stripe(tmpdir, monkeypatch):
+    monkeypatch.setattr(singleflight, 'STRIPE_LENGTH', 1)
+    key_lock = singleflight.KeyLock(tmpdir.strpath)
+    keys = ['key{}'.format(x) for x in range(50)]
+    stripe = singleflight.get_stripe(keys[0])
+    same_stripe = [x for x in keys if singleflight.get_stripe(x) == stripe]
+    assert len(same_stripe) > 1
+    # the same thread can hold other key on the same stripe, other thread wait for the stripe
+    with key_lock.lock(same_stripe[0]), key_lock.lock(same_stripe[1]) as waited:
+        assert not waited
+        assert not lock_in_thread(key_lock, same_stripe[1], timeout=0.01)
+    assert lock_in_thread(key_lock, same_stripe[1], timeout=0.01)
+    assert key_lock._entries == {}
+    monkeypatch.setattr(singleflight, 'key_lock', key_lock)
+    with singleflight.lock_many(keys):
+        pass
+    # lock file is per stripe
+    assert {x.basename for x in tmpdir.listdir()} <= \
+        {'{:x}.lock'.format(x) for x in range(16)}
+
+
+@pytest.mark.skipif(singleflight.fcntl is None, reason='fcntl is not available')
+def test_key_lock_process(tmpdir):
+    ready = tmpdir.join('ready')
+    code = '\n'.join([
+        'import time',
+        'from gbooru_images_download import singleflight',
+        'with singleflight.KeyLock({!r}).lock("a"):'.format(tmpdir.strpath),
+        '    open({!r}, "w").close()'.format(ready.strpath),
+        '    time.sleep(0.3)',
+    ])
+    proc = subprocess.Popen([sys.executable, '-c', code])
+    try:
+        for _ in range(100):
+            if ready.exists():
+                break
+            time.sleep(0.05)
+        start = time.monotonic()
+        with singleflight.KeyLock(tmpdir.strpath).lock('a') as waited:
+            assert waited
+            assert time.monotonic() - start > 0.1
+    finally:
+        proc.wait()
+
+
+def test_search_query_create(tmp_db, monkeypatch, tmpdir):
+    tmp_db.session.remove()
+    monkeypatch.setattr(singleflight, 'key_lock', singleflight.KeyLock(tmpdir.strpath))
+    app = tmp_db.get_app()
+    session = tmp_db.session
+    mode = models.Plugin(name='fake mode', category='mode')
+    session.add(mode)
+    session.commit()
+    mode_id = mode.id
+    calls = []
+
+    class FakePlugin:
+        def get_match_results(self, search_term, page, session, use_cache, max_retries):
+            calls.append(search_term)
+            time.sleep(0.1)
+            return models.bulk_create_match_results(
+                session, [('http://example.com/singleflight.jpg', [], [])])
+
+    class FakeManager:
+        def getPluginByName(self, name, category):
+            return type('PluginInfo', (), {'plugin_object': FakePlugin()})
+
+    monkeypatch.setattr(models, 'get_plugin_manager', FakeManager)
+
+    class Field:
+        def __init__(self, data):
+            self.data = data
+
+    res = []
+
+    def work():
+        with app.app_context():
+            thread_session = tmp_db.session
+            form = type('Form', (), {
+                'search_term': Field('single flight'), 'page': Field(1),
+                'mode': Field(thread_session.query(models.Plugin).get(mode_id))})
+            res.append(models.SearchQuery.create(form, thread_session).id)
+            tmp_db.session.remove()
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ['single flight']
+    assert len(set(res)) == 1
+    assert session.query(models.SearchQuery).filter_by(search_term='single flight').count() == 1
+
+
+def test_search_query_create_many_lock(tmp_db, monkeypatch):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    mode = models.Plugin(name='fake mode', category='mode')
+    session.add(mode)
+    session.commit()
+    locked = []
+
+    class FakePlugin(models.ModePlugin):
+        def get_match_items_many(self, queries, session, use_cache):
+            return [[] for _ in queries]
+
+    class FakeManager:
+        def getPluginByName(self, name, category):
+            return type('PluginInfo', (), {'plugin_object': FakePlugin()})
+
+    lock_many = singleflight.lock_many
+
+    def record_lock_many(keys, timeout=None):
+        locked.append((len(keys), timeout))
+        return lock_many(keys, timeout=timeout)
+
+    monkeypatch.setattr(models, 'get_plugin_manager', FakeManager)
+    monkeypatch.setattr(singleflight, 'lock_many', record_lock_many)
+    queries = [('query {}'.format(x), 1, mode) for x in range(25)]
+    res = list(models.SearchQuery.create_many(queries, session, chunk_size=100))
+    assert len(res) == 25 and all(res)
+    # queries are locked on small chunks with bounded wait
+    assert locked == [(x, singleflight.LOCK_TIMEOUT) for x in (10, 10, 5)]
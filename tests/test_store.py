@@ -0,0 +1,34 @@
+"""Test for store module."""
+import pytest
+
+from gbooru_images_download import store
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_blob_store(tmpdir, compression):
+    if compression == 'zstd' and store.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    blob_store = store.BlobStore(tmpdir.strpath, compression=compression)
+    data = b'<html>' + b'a' * 100000 + b'</html>'
+    digest, size = blob_store.put(data)
+    assert size == len(data)
+    assert digest in blob_store
+    assert blob_store.get(digest) == data
+    assert b''.join(blob_store.iter_chunks(digest, chunk_size=1000)) == data
+    # identical blob is stored once
+    assert blob_store.put(data) == (digest, size)
+    assert len(tmpdir.listdir()) == 1
+    assert len(tmpdir.listdir()[0].listdir()) == 1
+    with pytest.raises(KeyError):
+        blob_store.get('0' * 64)
+
+
+def test_blob_store_remove_unused(tmpdir):
+    blob_store = store.BlobStore(tmpdir.strpath, compression='gzip')
+    digests = [blob_store.put(x)[0] for x in (b'a', b'b', b'c')]
+    assert sorted(blob_store.iter_digests()) == sorted(digests)
+    # new blob is kept
+    assert blob_store.remove_unused(lambda x: [], min_age=60) == 0
+    assert blob_store.remove_unused(lambda x: [y for y in x if y == digests[0]], chunk_size=2) == 2
+    assert list(blob_store.iter_digests()) == [digests[0]]
+    assert not blob_store.remove(digests[1])
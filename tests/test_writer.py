@@ -0,0 +1,127 @@
+"""Test writer module."""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gbooru_images_download import jobs, models, views, writer
+
+
+@pytest.fixture()
+def write_behind(tmp_db):
+    """Enable write-behind writer on tmp db app."""
+    tmp_db.session.remove()
+    app = tmp_db.get_app()
+    app.extensions['write_behind'] = res = writer.WriteBehind(app, flush_interval=0.05)
+    yield res
+    res.stop()
+    del app.extensions['write_behind']
+
+
+def test_write_behind(tmp_db):
+    tmp_db.session.remove()
+    app = tmp_db.get_app()
+    write_behind = writer.WriteBehind(app, batch_size=50, flush_interval=0.05)
+    urls = ['http://example.com/{}.jpg'.format(x) for x in range(100)]
+    try:
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            url_ids = list(executor.map(
+                lambda x: write_behind.write(views.get_or_create_url_id, x), urls + urls))
+        assert url_ids[:100] == url_ids[100:]
+        assert len(set(url_ids)) == 100
+        # every write is committed, with fewer transactions than writes
+        assert write_behind.writes == 200
+        assert write_behind.commits < 200
+        session = tmp_db.session
+        assert {str(x.value): x.id for x in session.query(models.Url)} == \
+            dict(zip(urls, url_ids))
+    finally:
+        write_behind.stop()
+
+
+def test_write_behind_error(tmp_db):
+    tmp_db.session.remove()
+    app = tmp_db.get_app()
+    write_behind = writer.WriteBehind(app, flush_interval=0.05)
+
+    def fail(session):
+        raise ValueError('write error')
+
+    try:
+        futures = [
+            write_behind.submit(views.get_or_create_url_id, 'http://example.com/1.jpg'),
+            write_behind.submit(fail),
+            write_behind.submit(views.get_or_create_url_id, 'http://example.com/2.jpg'),
+        ]
+        with pytest.raises(ValueError):
+            futures[1].result(10)
+        assert futures[0].result(10) and futures[2].result(10)
+    finally:
+        write_behind.stop()
+    assert tmp_db.session.query(models.Url).count() == 2
+
+
+def test_write_without_writer(tmp_db):
+    tmp_db.session.remove()
+    session = tmp_db.session
+    assert writer.get_writer() is None
+    url_id = writer.write(session, views.get_or_create_url_id, 'http://example.com/1.jpg')
+    session.commit()
+    tmp_db.session.remove()
+    assert tmp_db.session.query(models.Url).get(url_id)
+
+
+def test_write_with_write_lock(tmp_db, write_behind):
+    session = tmp_db.session
+    session.add(models.Url(value='http://example.com/locked.jpg'))
+    session.flush()
+    assert writer.holds_write_lock(session)
+    # writer would wait for the lock of the session, so it is written on the session instead
+    url_id = writer.write(session, views.get_or_create_url_id, 'http://example.com/1.jpg')
+    assert write_behind.writes == 0
+    session.commit()
+    assert not writer.holds_write_lock(session)
+    assert session.query(models.Url).get(url_id)
+
+
+def test_response_create_with_writer(tmp_db, write_behind, http_server):
+    session = tmp_db.session
+    for idx in range(3):
+        http_server['folder'].join('{}.html'.format(idx)).write(
+            '<a href="/{0}.jpg">{0}</a>'.format(idx))
+    urls = [http_server['url'] + '{}.html'.format(x) for x in range(3)]
+    model = models.Response.create(urls[0], 'get', session)
+    assert write_behind.writes == 1
+    assert (model.status_code, model.text) == (200, '<a href="/0.jpg">0</a>')
+    assert model.url.netloc.url_count == 1
+    # fresh record is used without write, stale record is revalidated
+    res = models.Response.create_many(urls, 'get', session, cache_ttl=0)
+    assert write_behind.writes == 2
+    assert res[0][0].status_code == 304
+    assert res[0][1].text == '<a href="/0.jpg">0</a>'
+    assert [x[0].text for x in res[1:]] == ['<a href="/1.jpg">1</a>', '<a href="/2.jpg">2</a>']
+    # search query
+    mode = {x.name: x for x in models.update_plugin_models(session)}['a tag']
+    session.commit()
+    queries = [(urls[1], 1, mode), ('ftp://example.com/1.html', 1, mode), (urls[1], 1, mode)]
+    res = list(models.SearchQuery.create_many(queries, session))
+    assert res[0] is res[2]
+    assert res[1] is False
+    assert [str(x.url.value) for x in res[0].match_results] == [http_server['url'] + '1.jpg']
+    assert session.query(models.SearchQuery).count() == 1
+    # page response and search query rows
+    assert write_behind.writes == 4
+
+
+def test_run_job_with_writer(tmp_db, write_behind, monkeypatch):
+    session = tmp_db.session
+    monkeypatch.setitem(jobs.JOB_HANDLERS, 'test', lambda session, value: {'value': value})
+    monkeypatch.setitem(jobs.JOB_HANDLERS, 'fail', lambda session: 1 / 0)
+    for kind, kwargs in (('test', {'value': 1}), ('fail', {})):
+        models.enqueue_job(session, kind, **kwargs)
+    session.commit()
+    job = jobs.run_job(session, models.claim_job(session, 'w1'))
+    assert (job.status, job.result, job.finished_at is not None) == \
+        (models.Job.STATUS_DONE, {'value': 1}, True)
+    job = jobs.run_job(session, models.claim_job(session, 'w1'))
+    assert (job.status, job.error) == (models.Job.STATUS_FAILED, 'division by zero')
+    assert write_behind.writes == 2